@@ -1,6 +1,15 @@
 from flask import Flask
 from app.config import load_configurations, configure_logging
-from .views import webhook_blueprint
+from .views import metrics_blueprint, webhook_blueprint
+from .services.ingestion import init_ingestion
+from .services.dedup import init_dedup
+from .services.admission import init_admission
+from .services.graph_client import init_graph_client
+from .services.outbox import init_outbox
+from .services.tenants import init_tenants
+from .services.coalescer import init_coalescer
+from .services.media import init_media
+from .services.status_metrics import init_status_metrics
 
 
 def create_app():
@@ -12,5 +21,44 @@ def create_app():
 
     # Import and register blueprints, if any
     app.register_blueprint(webhook_blueprint)
+    if app.config["METRICS_ENABLED"]:
+        app.register_blueprint(metrics_blueprint)
+
+    # Text extraction for image/audio/document messages. Its process pool
+    # forks workers, so it is started first, before anything starts a thread;
+    # workers of a pre-fork server start their own right after the fork
+    init_media(app)
+
+    # Pooled keep-alive client for the Graph API
+    init_graph_client(app)
+
+    # phone_number_id -> credentials and assistant for each business number
+    init_tenants(app)
+
+    # Durable queue in front of it when OUTBOX_DB_PATH is set
+    init_outbox(app)
+
+    # Seen-set of message IDs for dropping webhook redeliveries
+    init_dedup(app)
+
+    # Per-sender and global rate limits checked before the assistant runs
+    init_admission(app)
+
+    # Delivery/read latency aggregation from status callbacks
+    init_status_metrics(app)
+
+    # Per-sender debounce before the assistant is invoked
+    init_coalescer(app)
+
+    # Background worker pool for INGESTION_MODE=queue, or the shared broker
+    # and partition consumers for INGESTION_MODE=cluster
+    init_ingestion(app)
+
+    # Import the OpenAI SDK now rather than on the first message; its clients
+    # are still created on first use in each worker process
+    if app.config["RESPONSE_BACKEND"] == "openai":
+        from .services.openai_service import preload
+
+        preload()
 
     return app
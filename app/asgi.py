@@ -0,0 +1,481 @@
+"""
+asyncio-native ASGI application with the same /webhook contract as the Flask app.
+
+Usage:
+    uvicorn --factory app.asgi:create_asgi_app --host 0.0.0.0 --port 8000
+
+Configuration, signature checks and the webhook pipeline (parsing, deduplication,
+admission, status aggregation, reply formatting) are shared with the Flask app;
+the blocking parts of it run in worker threads. Replies go out through the
+AsyncOpenAI client and an aiohttp Graph API client, so a waiting conversation
+costs a coroutine instead of a thread.
+"""
+
+import asyncio
+import json
+import logging
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import aiohttp
+
+from app.config import configure_logging, load_configurations
+from app.decorators.security import build_signature_keys, check_signature
+from app.services.admission import build_admission
+from app.services.broker import ClusterQueue, build_consumer, create_broker
+from app.services.coalescer import MessageCoalescer
+from app.services.dedup import MessageDeduplicator
+from app.services.media import build_pipeline
+from app.services.outbox import Outbox, tenant_sender
+from app.services.status_metrics import StatusAggregator
+from app.services.tenants import build_registry
+from app.utils.metrics import component_metrics, metrics, sample, stage_timer
+from app.utils.reply_chunker import ReplyChunker, split_message
+from app.utils.webhook_parser import MessageEvent
+from app.utils.webhook_pipeline import (
+    NOT_WHATSAPP,
+    STATUS,
+    InvalidWebhook,
+    parse_webhook,
+    process_text_for_whatsapp,
+    record_statuses,
+    reply_parts,
+    screen_message,
+)
+from app.utils.whatsapp_utils import generate_response, get_text_message_input
+
+
+class WebhookApp:
+    def __init__(self, config):
+        self.config = config
+        self.signature_keys = build_signature_keys(
+            [config["APP_SECRET"], *config["PREVIOUS_APP_SECRETS"]]
+        )
+        self.media = build_pipeline(config)
+        if self.media is not None:
+            # Its pool forks workers, so before any thread is started
+            self.media.start()
+        if config["RESPONSE_BACKEND"] == "openai":
+            # SDK imports at startup; clients are created on first use
+            from app.services.openai_service import preload
+
+            preload()
+        self.tenants = build_registry(config)
+        self.dedup = (
+            MessageDeduplicator(
+                ttl=config["DEDUP_TTL"],
+                maxsize=config["DEDUP_MAX_SIZE"],
+                db_path=config["DEDUP_DB_PATH"],
+            )
+            if config["DEDUP_ENABLED"]
+            else None
+        )
+        self.admission = build_admission(config)
+        self.coalescer = None
+        if config["COALESCE_WINDOW"] > 0:
+            # Timer threads hand each merged turn back to the event loop
+            self.coalescer = MessageCoalescer(
+                None,
+                self._respond_coalesced,
+                window=config["COALESCE_WINDOW"],
+                max_wait=config["COALESCE_MAX_WAIT"],
+            )
+        self.status_metrics = StatusAggregator(
+            db_path=config["STATUS_DB_PATH"],
+            batch_size=config["STATUS_FLUSH_BATCH"],
+            flush_interval=config["STATUS_FLUSH_INTERVAL"],
+        )
+        self.outbox = None
+        if config["OUTBOX_DB_PATH"]:
+            # The outbox sends from its own threads, on the blocking clients
+            self.outbox = Outbox(
+                config["OUTBOX_DB_PATH"],
+                tenant_sender(self.tenants),
+                max_attempts=config["OUTBOX_MAX_ATTEMPTS"],
+                send_concurrency=config["OUTBOX_SEND_CONCURRENCY"],
+            )
+        self.cluster = None
+        if config["INGESTION_MODE"] == "cluster":
+            # Consumer threads hand each event back to the event loop
+            broker = create_broker(config["BROKER_URL"])
+            self.cluster = ClusterQueue(
+                broker,
+                config["BROKER_PARTITIONS"],
+                build_consumer(config, broker, self._process_from_broker),
+                dedup=self.dedup,
+            )
+        self._loop = None
+        # Background replies in queue mode; the set also keeps the tasks alive
+        self._tasks = set()
+        self._accepting = True
+        self._queue_stats = {"enqueued": 0, "rejected": 0, "high_watermark": 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["path"] == "/metrics" and self.config["METRICS_ENABLED"]:
+                await self.metrics_get(send)
+            elif scope["path"] != "/webhook":
+                await self._respond(send, 404, {"status": "error", "message": "Not found"})
+            elif scope["method"] == "GET":
+                await self.verify(scope, send)
+            elif scope["method"] == "POST":
+                await self.webhook_post(scope, receive, send)
+            else:
+                await self._respond(send, 405, {"status": "error", "message": "Method not allowed"})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.outbox is not None:
+                    # Resume sending whatever a previous run left queued
+                    self.outbox.start()
+                self._loop = asyncio.get_running_loop()
+                if self.cluster is not None and self.cluster.consumer is not None:
+                    self.cluster.consumer.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Let in-flight background replies finish before closing the pool
+                self._accepting = False
+                if self._tasks:
+                    await asyncio.wait(
+                        self._tasks, timeout=self.config["INGESTION_DRAIN_TIMEOUT"]
+                    )
+                if self.cluster is not None:
+                    await asyncio.to_thread(
+                        self.cluster.shutdown, self.config["INGESTION_DRAIN_TIMEOUT"]
+                    )
+                await self.tenants.aclose()
+                if self.media is not None:
+                    await asyncio.to_thread(self.media.shutdown)
+                if self.outbox is not None:
+                    await asyncio.to_thread(self.outbox.shutdown)
+                self.status_metrics.flush()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _respond(self, send, status, body, content_type=None):
+        if isinstance(body, str):
+            payload = body.encode("utf-8")
+            content_type = content_type or b"text/plain; charset=utf-8"
+        else:
+            payload, content_type = json.dumps(body).encode("utf-8"), b"application/json"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", content_type),
+                    (b"content-length", str(len(payload)).encode("ascii")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
+
+    async def _read_body(self, scope, receive):
+        """
+        Read the request body, or return None once it exceeds the size limit.
+        Raises ValueError for a malformed Content-Length header.
+        """
+        max_bytes = self.config["MAX_WEBHOOK_BODY_BYTES"]
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            content_length = int(content_length)
+            if content_length < 0:
+                raise ValueError(f"negative Content-Length {content_length}")
+            if content_length > max_bytes:
+                return None
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > max_bytes:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    # Required webhook verifictaion for WhatsApp
+    async def verify(self, scope, send):
+        params = parse_qs(scope["query_string"].decode("latin-1"))
+        mode = params.get("hub.mode", [None])[0]
+        token = params.get("hub.verify_token", [None])[0]
+        challenge = params.get("hub.challenge", [""])[0]
+        if mode and token:
+            if mode == "subscribe" and token == self.config["VERIFY_TOKEN"]:
+                logging.info("WEBHOOK_VERIFIED")
+                await self._respond(send, 200, challenge)
+            else:
+                logging.info("VERIFICATION_FAILED")
+                await self._respond(
+                    send, 403, {"status": "error", "message": "Verification failed"}
+                )
+        else:
+            logging.info("MISSING_PARAMETER")
+            await self._respond(send, 400, {"status": "error", "message": "Missing parameters"})
+
+    async def webhook_post(self, scope, receive, send):
+        try:
+            raw = await self._read_body(scope, receive)
+        except ValueError:
+            logging.info("Malformed Content-Length header!")
+            metrics.inc("errors", kind="bad_content_length")
+            await self._respond(send, 400, {"status": "error", "message": "Invalid Content-Length"})
+            return
+        if raw is None:
+            logging.info("Webhook body too large!")
+            metrics.inc("errors", kind="body_too_large")
+            await self._respond(send, 413, {"status": "error", "message": "Payload too large"})
+            return
+
+        signature = dict(scope["headers"]).get(b"x-hub-signature-256", b"").decode("latin-1")
+        if signature.startswith("sha256="):
+            signature = signature[7:]
+        with stage_timer("signature"):
+            valid = check_signature(self.signature_keys, raw, signature)
+        if not valid:
+            logging.info("Signature verification failed!")
+            metrics.inc("errors", kind="invalid_signature")
+            await self._respond(send, 403, {"status": "error", "message": "Invalid signature"})
+            return
+
+        try:
+            kind, events = parse_webhook(raw)
+        except InvalidWebhook as e:
+            await self._respond(send, 400, {"status": "error", "message": str(e)})
+            return
+
+        await self.record_statuses(events)
+        if kind == STATUS:
+            metrics.inc("webhooks", kind="status")
+            await self._respond(send, 200, {"status": "ok"})
+            return
+
+        if kind == NOT_WHATSAPP:
+            await self._respond(
+                send, 404, {"status": "error", "message": "Not a WhatsApp API event"}
+            )
+            return
+
+        metrics.inc("webhooks", kind="message")
+        self._loop = asyncio.get_running_loop()
+        if self.cluster is not None:
+            if not await asyncio.to_thread(self.cluster.submit, events):
+                # Broker unavailable: let Meta retry later
+                metrics.inc("errors", kind="queue_full")
+                await self._respond(send, 503, {"status": "error", "message": "Busy"})
+                return
+        elif self.config["INGESTION_MODE"] == "queue":
+            if not self._accepting or len(self._tasks) >= self.config["INGESTION_QUEUE_SIZE"]:
+                # Same limit as the Flask WebhookQueue: let Meta retry later
+                self._queue_stats["rejected"] += 1
+                logging.warning("Webhook queue full, rejecting event")
+                metrics.inc("errors", kind="queue_full")
+                await self._respond(send, 503, {"status": "error", "message": "Busy"})
+                return
+            # Acknowledge now, reply in the background
+            task = asyncio.create_task(self.process_events(events))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._queue_stats["enqueued"] += 1
+            self._queue_stats["high_watermark"] = max(
+                self._queue_stats["high_watermark"], len(self._tasks)
+            )
+        else:
+            await self.process_events(events)
+        await self._respond(send, 200, {"status": "ok"})
+
+    async def record_statuses(self, events):
+        if self.status_metrics.db_path:
+            # A record can flush the batch to SQLite
+            await asyncio.to_thread(record_statuses, self.status_metrics, events)
+        else:
+            record_statuses(self.status_metrics, events)
+
+    def _process_from_broker(self, event):
+        # Runs on a broker consumer thread, which waits for the reply
+        asyncio.run_coroutine_threadsafe(
+            self.process_events([event], from_broker=True), self._loop
+        ).result()
+
+    def _respond_coalesced(self, wa_id, name, text, phone_number_id):
+        # Runs on a coalescer timer thread, which waits so turns stay in order
+        asyncio.run_coroutine_threadsafe(
+            self.respond_to_message(wa_id, name, text, phone_number_id), self._loop
+        ).result()
+
+    async def process_events(self, events, from_broker=False):
+        for event in events:
+            if not isinstance(event, MessageEvent):
+                continue
+            # Dedup and admission may block on SQLite. Broker events were
+            # deduplicated when they were published.
+            accepted, notice = await asyncio.to_thread(
+                screen_message,
+                event,
+                None if from_broker else self.dedup,
+                self.admission,
+                self.tenants,
+                self.media is not None,
+            )
+            if notice is not None:
+                tenant, reply = notice
+                await self.send_message(get_text_message_input(event.wa_id, reply), tenant)
+            if not accepted:
+                continue
+            text = event.text
+            if text is None:
+                text = await self.media_text(event)
+                if text is None:
+                    logging.info(f"No text in {event.type} message {event.id}")
+                    continue
+            # Merge bursts of short messages into one assistant turn; broker
+            # events are answered before they are acknowledged
+            if self.coalescer is not None and not from_broker:
+                self.coalescer.submit(event.wa_id, event.name, text, event.phone_number_id)
+                continue
+            try:
+                await self.respond_to_message(
+                    event.wa_id, event.name, text, event.phone_number_id
+                )
+            except Exception:
+                logging.exception(f"Failed to reply to message {event.id}")
+                metrics.inc("errors", kind="handler")
+
+    async def media_text(self, event):
+        """
+        Text of a media message from the media pipeline, which downloads on
+        the blocking per-tenant client and processes in its own processes.
+        """
+        tenant = self.tenants.get(event.phone_number_id)
+        if tenant is None:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        submitted = self.media.submit(
+            event.type,
+            event.media,
+            self.tenants.graph_client(tenant),
+            lambda text: loop.call_soon_threadsafe(future.set_result, text),
+        )
+        if not submitted:
+            logging.warning(f"Media pipeline full, dropping {event.type} message {event.id}")
+            metrics.inc("errors", kind="media_busy")
+            return None
+        return await future
+
+    async def respond_to_message(self, wa_id, name, message_body, phone_number_id=None):
+        tenant = self.tenants.get(phone_number_id)
+        if tenant is None:
+            logging.warning(f"No tenant configured for phone number ID {phone_number_id}")
+            metrics.inc("errors", kind="unknown_tenant")
+            return
+        recipient = wa_id
+        if self.config["RESPONSE_BACKEND"] == "openai" and self.config["REPLY_STREAMING"]:
+            from app.services.openai_service import async_generate_response_stream
+
+            await self.send_streamed_reply(
+                recipient,
+                async_generate_response_stream(message_body, wa_id, name, tenant),
+                tenant,
+            )
+            return
+
+        if self.config["RESPONSE_BACKEND"] == "openai":
+            from app.services.openai_service import async_generate_response
+
+            parts = reply_parts(
+                await async_generate_response(message_body, wa_id, name, tenant),
+                self.config["REPLY_MARKDOWN"],
+            )
+        else:
+            parts = split_message(generate_response(message_body))
+
+        for part in parts:
+            await self.send_message(get_text_message_input(recipient, part), tenant)
+
+    async def send_streamed_reply(self, recipient, pieces, tenant=None):
+        """
+        Send each complete sentence-aligned chunk of a streamed reply in order.
+        """
+        chunker = ReplyChunker(min_length=self.config["REPLY_CHUNK_MIN_CHARS"])
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = True
+
+        async def send_chunks(chunks):
+            nonlocal first
+            for chunk in chunks:
+                with stage_timer("text_processing"):
+                    text = process_text_for_whatsapp(chunk, self.config["REPLY_MARKDOWN"])
+                if not text:
+                    continue
+                if first:
+                    metrics.observe("first_chunk_seconds", loop.time() - start)
+                    first = False
+                await self.send_message(get_text_message_input(recipient, text), tenant)
+
+        async for piece in pieces:
+            await send_chunks(chunker.feed(piece))
+        await send_chunks(chunker.close())
+
+    async def send_message(self, data, tenant=None):
+        tenant = tenant or self.tenants.default
+        if self.outbox is not None:
+            try:
+                await asyncio.to_thread(
+                    self.outbox.enqueue, data, sender_id=tenant.phone_number_id
+                )
+                return
+            except RuntimeError as e:
+                logging.error(f"Could not queue message, sending directly: {e}")
+                metrics.inc("errors", kind="outbox_enqueue")
+        try:
+            with stage_timer("send"):
+                status, body = await self.tenants.async_graph_client(tenant).send_message(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Request failed due to: {e}")
+            metrics.inc("errors", kind="send_failed")
+            return
+        if status >= 400:
+            logging.error(f"Request failed with status {status}: {body[:200]!r}")
+            metrics.inc("errors", kind="send_failed")
+            return
+        metrics.inc("messages_sent")
+        logging.info(f"Status: {status}")
+        if sample(self.config["LOG_BODY_SAMPLE_RATE"]):
+            logging.info(f"Body: {body.decode('utf-8', 'replace')}")
+
+    async def metrics_get(self, send):
+        gauges = component_metrics(
+            {
+                "dedup": self.dedup,
+                "admission": self.admission,
+                "coalescer": self.coalescer,
+                "status": self.status_metrics,
+                "outbox": self.outbox,
+                "tenants": self.tenants,
+                "media": self.media,
+            }
+        )
+        gauges["ingestion"] = {
+            "in_flight": len(self._tasks),
+            "capacity": self.config["INGESTION_QUEUE_SIZE"],
+            **self._queue_stats,
+        }
+        if self.cluster is not None:
+            gauges["ingestion"].update(await asyncio.to_thread(self.cluster.metrics))
+        await self._respond(
+            send, 200, metrics.render(gauges), b"text/plain; version=0.0.4"
+        )
+
+
+def create_asgi_app():
+    settings = SimpleNamespace(config={})
+    load_configurations(settings)
+    configure_logging()
+    return WebhookApp(settings.config)
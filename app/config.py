@@ -3,17 +3,272 @@ import os
 from dotenv import load_dotenv
 import logging
 
+_TRUE = ("true", "1", "yes", "on")
+_FALSE = ("false", "0", "no", "off", "")
+
+
+class ConfigError(ValueError):
+    """
+    Invalid settings in the environment, listed all at once.
+    """
+
+
+class _Env:
+    """
+    Typed reads of environment variables. A value that does not parse or is out
+    of range is recorded in `errors` and its default used, so every mistake is
+    reported together.
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.errors = []
+
+    def str(self, name, default=None):
+        return self.environ.get(name, default)
+
+    def optional(self, name):
+        # Unset and empty both mean "off"
+        return self.environ.get(name) or None
+
+    def choice(self, name, default, choices):
+        value = self.environ.get(name, default)
+        if value not in choices:
+            self.errors.append(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+            return default
+        return value
+
+    def bool(self, name, default):
+        value = self.environ.get(name)
+        if value is None:
+            return default
+        if value.lower() in _TRUE:
+            return True
+        if value.lower() not in _FALSE:
+            self.errors.append(f"{name} must be true or false, got {value!r}")
+        return False
+
+    def _number(self, kind, name, default, minimum, maximum):
+        value = self.environ.get(name)
+        if value is None:
+            return default
+        try:
+            number = kind(value)
+        except ValueError:
+            expected = "an integer" if kind is int else "a number"
+            self.errors.append(f"{name} must be {expected}, got {value!r}")
+            return default
+        too_low = minimum is not None and number < minimum
+        if too_low or (maximum is not None and number > maximum):
+            bounds = f">= {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+            self.errors.append(f"{name} must be {bounds}, got {value!r}")
+            return default
+        return number
+
+    def int(self, name, default, minimum=None, maximum=None):
+        return self._number(int, name, default, minimum, maximum)
+
+    def float(self, name, default, minimum=None, maximum=None):
+        return self._number(float, name, default, minimum, maximum)
+
+    def list(self, name, default=""):
+        return [item for item in self.environ.get(name, default).split(",") if item]
+
+
+def read_settings(environ=None):
+    """
+    Parse and validate every setting. Raises ConfigError listing all invalid
+    variables.
+    """
+    env = _Env(os.environ if environ is None else environ)
+    config = {}
+    config["ACCESS_TOKEN"] = env.str("ACCESS_TOKEN")
+    config["YOUR_PHONE_NUMBER"] = env.str("YOUR_PHONE_NUMBER")
+    config["APP_ID"] = env.str("APP_ID")
+    config["APP_SECRET"] = env.str("APP_SECRET")
+    # Older secrets still accepted while rotating APP_SECRET (comma-separated)
+    config["PREVIOUS_APP_SECRETS"] = env.list("PREVIOUS_APP_SECRETS")
+    config["MAX_WEBHOOK_BODY_BYTES"] = env.int("MAX_WEBHOOK_BODY_BYTES", 1024 * 1024, minimum=1)
+    config["RECIPIENT_WAID"] = env.str("RECIPIENT_WAID")
+    config["VERSION"] = env.str("VERSION")
+    config["PHONE_NUMBER_ID"] = env.str("PHONE_NUMBER_ID")
+    config["VERIFY_TOKEN"] = env.str("VERIFY_TOKEN")
+    # "echo" replies in upper case, "openai" answers with the OpenAI assistant
+    config["RESPONSE_BACKEND"] = env.choice("RESPONSE_BACKEND", "echo", ("echo", "openai"))
+
+    # Webhook ingestion: "sync" processes inside the request, "queue" hands
+    # events to a background worker pool and acknowledges immediately,
+    # "cluster" publishes them to the shared broker below.
+    config["INGESTION_MODE"] = env.choice(
+        "INGESTION_MODE", "sync", ("sync", "queue", "cluster")
+    )
+    config["INGESTION_WORKERS"] = env.int("INGESTION_WORKERS", 4, minimum=1)
+    config["INGESTION_QUEUE_SIZE"] = env.int("INGESTION_QUEUE_SIZE", 1000, minimum=1)
+    config["INGESTION_DRAIN_TIMEOUT"] = env.float("INGESTION_DRAIN_TIMEOUT", 30, minimum=0)
+    # Cluster mode: message events are partitioned by wa_id, and each node's
+    # BROKER_CONSUMERS threads lease a share of the partitions. A node that
+    # stops heartbeating loses its leases after BROKER_LEASE_SECONDS.
+    config["BROKER_URL"] = env.str("BROKER_URL", "sqlite:///broker.db")
+    config["BROKER_PARTITIONS"] = env.int("BROKER_PARTITIONS", 32, minimum=1)
+    config["BROKER_CONSUMERS"] = env.int("BROKER_CONSUMERS", 4, minimum=0)
+    config["BROKER_LEASE_SECONDS"] = env.float("BROKER_LEASE_SECONDS", 15, minimum=1)
+    config["BROKER_POLL_INTERVAL"] = env.float("BROKER_POLL_INTERVAL", 0.1, minimum=0.001)
+
+    # Skip webhook redeliveries of message IDs we already handled. Set
+    # DEDUP_DB_PATH to share the seen-set between worker processes.
+    config["DEDUP_ENABLED"] = env.bool("DEDUP_ENABLED", True)
+    config["DEDUP_TTL"] = env.float("DEDUP_TTL", 3600, minimum=0)
+    config["DEDUP_MAX_SIZE"] = env.int("DEDUP_MAX_SIZE", 10000, minimum=1)
+    config["DEDUP_DB_PATH"] = env.optional("DEDUP_DB_PATH")
+
+    # Admission control before any assistant work: per-sender and global token
+    # buckets, with part of the global one reserved for existing conversations.
+    # Set ADMISSION_DB_PATH to share the buckets between worker processes.
+    config["ADMISSION_ENABLED"] = env.bool("ADMISSION_ENABLED", False)
+    config["ADMISSION_SENDER_PER_MINUTE"] = env.float(
+        "ADMISSION_SENDER_PER_MINUTE", 6, minimum=0.001
+    )
+    config["ADMISSION_SENDER_BURST"] = env.float("ADMISSION_SENDER_BURST", 10, minimum=1)
+    config["ADMISSION_GLOBAL_PER_SECOND"] = env.float(
+        "ADMISSION_GLOBAL_PER_SECOND", 5, minimum=0.001
+    )
+    config["ADMISSION_GLOBAL_BURST"] = env.float("ADMISSION_GLOBAL_BURST", 20, minimum=1)
+    config["ADMISSION_RESERVED_SHARE"] = env.float(
+        "ADMISSION_RESERVED_SHARE", 0.3, minimum=0, maximum=1
+    )
+    config["ADMISSION_KNOWN_TTL"] = env.float("ADMISSION_KNOWN_TTL", 86400, minimum=0)
+    config["ADMISSION_DB_PATH"] = env.optional("ADMISSION_DB_PATH")
+    # Canned replies to shed messages, at most one per sender per interval
+    config["ADMISSION_SENDER_REPLY"] = env.str(
+        "ADMISSION_SENDER_REPLY",
+        "You're sending messages faster than I can answer. "
+        "Please wait a moment before sending more.",
+    )
+    config["ADMISSION_BUSY_REPLY"] = env.str(
+        "ADMISSION_BUSY_REPLY",
+        "I'm getting a lot of messages right now. Please try again in a few minutes.",
+    )
+    config["ADMISSION_NOTICE_INTERVAL"] = env.float("ADMISSION_NOTICE_INTERVAL", 300, minimum=0)
+
+    # Pooled Graph API client used for outbound sends
+    config["GRAPH_API_BASE_URL"] = env.str("GRAPH_API_BASE_URL", "https://graph.facebook.com")
+    config["GRAPH_POOL_SIZE"] = env.int("GRAPH_POOL_SIZE", 10, minimum=1)
+    config["GRAPH_TIMEOUT"] = env.float("GRAPH_TIMEOUT", 10, minimum=0.001)
+    config["GRAPH_MAX_RETRIES"] = env.int("GRAPH_MAX_RETRIES", 3, minimum=0)
+
+    # Buffer a sender's messages for COALESCE_WINDOW seconds of quiet (capped
+    # at COALESCE_MAX_WAIT) and answer them as one turn. 0 disables it.
+    config["COALESCE_WINDOW"] = env.float("COALESCE_WINDOW", 0, minimum=0)
+    config["COALESCE_MAX_WAIT"] = env.float("COALESCE_MAX_WAIT", 5, minimum=0)
+
+    # Delivery/read status aggregation, optionally flushed in batches to SQLite
+    config["STATUS_DB_PATH"] = env.optional("STATUS_DB_PATH")
+    config["STATUS_FLUSH_BATCH"] = env.int("STATUS_FLUSH_BATCH", 500, minimum=1)
+    config["STATUS_FLUSH_INTERVAL"] = env.float("STATUS_FLUSH_INTERVAL", 10, minimum=0)
+
+    # Several business numbers on one deployment: a JSON file mapping each
+    # phone_number_id to its credentials and assistant, re-read when it changes.
+    # Unset serves only PHONE_NUMBER_ID with the credentials above.
+    config["TENANTS_FILE"] = env.optional("TENANTS_FILE")
+    config["TENANTS_RELOAD_INTERVAL"] = env.float("TENANTS_RELOAD_INTERVAL", 5, minimum=0)
+
+    # Durable outbound queue: replies are committed to this SQLite file and sent
+    # by a background worker with retries. Unset sends directly.
+    config["OUTBOX_DB_PATH"] = env.optional("OUTBOX_DB_PATH")
+    config["OUTBOX_MAX_ATTEMPTS"] = env.int("OUTBOX_MAX_ATTEMPTS", 8, minimum=1)
+    config["OUTBOX_SEND_CONCURRENCY"] = env.int("OUTBOX_SEND_CONCURRENCY", 8, minimum=1)
+
+    # Inbound image/audio/document messages: files are cached in MEDIA_CACHE_DIR
+    # (unset ignores media messages as before) and turned into text by
+    # processors running in MEDIA_WORKERS processes. MEDIA_PROCESSORS overrides
+    # them per type, e.g. "audio=mypackage.stt:transcribe,document=".
+    config["MEDIA_CACHE_DIR"] = env.optional("MEDIA_CACHE_DIR")
+    config["MEDIA_CACHE_MAX_BYTES"] = env.int("MEDIA_CACHE_MAX_BYTES", 1024**3, minimum=0)
+    config["MEDIA_MAX_BYTES"] = env.int("MEDIA_MAX_BYTES", 25 * 1024 * 1024, minimum=1)
+    config["MEDIA_WORKERS"] = env.int("MEDIA_WORKERS", 2, minimum=1)
+    config["MEDIA_MAX_PENDING"] = env.int("MEDIA_MAX_PENDING", 16, minimum=1)
+    config["MEDIA_PROCESSORS"] = env.str("MEDIA_PROCESSORS", "")
+    config["MEDIA_WHISPER_MODEL"] = env.str("MEDIA_WHISPER_MODEL", "base")
+
+    # Send long assistant answers in sentence-aligned chunks while they are still
+    # being generated. Chunks after the first wait for REPLY_CHUNK_MIN_CHARS.
+    config["REPLY_STREAMING"] = env.bool("REPLY_STREAMING", False)
+    config["REPLY_CHUNK_MIN_CHARS"] = env.int("REPLY_CHUNK_MIN_CHARS", 300, minimum=1)
+    # Convert all of the assistant's markdown (headings, lists, links, code) to
+    # WhatsApp formatting; false only drops citations and converts **bold**
+    config["REPLY_MARKDOWN"] = env.bool("REPLY_MARKDOWN", True)
+
+    # Serve counters and stage timings at /metrics in Prometheus text format
+    config["METRICS_ENABLED"] = env.bool("METRICS_ENABLED", False)
+    # Fraction of Graph API response bodies to log (1 logs every one)
+    config["LOG_BODY_SAMPLE_RATE"] = env.float(
+        "LOG_BODY_SAMPLE_RATE", 0.01, minimum=0, maximum=1
+    )
+
+    # OpenAI settings, used by app.services.openai_service
+    config["OPENAI_API_KEY"] = env.str("OPENAI_API_KEY")
+    config["OPENAI_ASSISTANT_ID"] = env.str("OPENAI_ASSISTANT_ID")
+    # "stream" waits on run events, "poll" falls back to adaptive backoff polling
+    config["RUN_COMPLETION_MODE"] = env.choice(
+        "RUN_COMPLETION_MODE", "stream", ("stream", "poll")
+    )
+    config["RUN_DEADLINE"] = env.float("RUN_DEADLINE", 60, minimum=0.001)
+    config["THREAD_STORE_URL"] = env.str("THREAD_STORE_URL", "sqlite:///threads.db")
+    config["ASSISTANT_CACHE_TTL"] = env.float("ASSISTANT_CACHE_TTL", 300, minimum=0)
+    # Answer repeat FAQ questions from a local cache instead of running the assistant
+    config["RESPONSE_CACHE_ENABLED"] = env.bool("RESPONSE_CACHE_ENABLED", False)
+    config["RESPONSE_CACHE_TTL"] = env.float("RESPONSE_CACHE_TTL", 86400, minimum=0)
+    config["RESPONSE_CACHE_SIZE"] = env.int("RESPONSE_CACHE_SIZE", 1000, minimum=1)
+    config["RESPONSE_CACHE_SIMILARITY"] = env.float(
+        "RESPONSE_CACHE_SIMILARITY", 0, minimum=0, maximum=1
+    )
+    # Rephrasings are matched against this many most recently used questions
+    config["RESPONSE_CACHE_SCAN_LIMIT"] = env.int("RESPONSE_CACHE_SCAN_LIMIT", 256, minimum=1)
+    # Shorter normalized questions ("ok", "👍") are never cached
+    config["RESPONSE_CACHE_MIN_LENGTH"] = env.int("RESPONSE_CACHE_MIN_LENGTH", 8, minimum=1)
+    config["KNOWLEDGE_FILES"] = env.list("KNOWLEDGE_FILES", "data/airbnb-faq.pdf")
+    # Answer from a local index with one chat completion instead of an Assistants run
+    config["LOCAL_RETRIEVAL_INDEX"] = env.optional("LOCAL_RETRIEVAL_INDEX")
+    config["LOCAL_RETRIEVAL_MODEL"] = env.str("LOCAL_RETRIEVAL_MODEL", "gpt-4o-mini")
+    # Seconds between checks for a rebuilt index on disk
+    config["LOCAL_RETRIEVAL_RELOAD_INTERVAL"] = env.float(
+        "LOCAL_RETRIEVAL_RELOAD_INTERVAL", 5, minimum=0
+    )
+    # "assistants" answers on an OpenAI thread; "chat" sends one chat completion
+    # with the local history, kept within HISTORY_TOKEN_BUDGET by summarizing
+    config["CONVERSATION_BACKEND"] = env.choice(
+        "CONVERSATION_BACKEND", "assistants", ("assistants", "chat")
+    )
+    config["CHAT_MODEL"] = env.str("CHAT_MODEL", "gpt-4o-mini")
+    # Local copy of every conversation, required by the chat backend
+    config["HISTORY_DB_PATH"] = env.optional("HISTORY_DB_PATH") or (
+        "history.db" if config["CONVERSATION_BACKEND"] == "chat" else None
+    )
+    config["HISTORY_TOKEN_BUDGET"] = env.int("HISTORY_TOKEN_BUDGET", 3000, minimum=100)
+    config["HISTORY_SUMMARY_MODEL"] = env.str("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+
+    if env.errors:
+        raise ConfigError("Invalid configuration:\n  " + "\n  ".join(env.errors))
+    return config
+
+
+_settings = None
+
+
+def get_settings(reload=False):
+    """
+    Settings from the environment and .env, read and validated once per
+    process; `reload=True` reads them again.
+    """
+    global _settings
+    if _settings is None or reload:
+        load_dotenv()
+        _settings = read_settings()
+    return _settings
+
 
 def load_configurations(app):
-    load_dotenv()
-    app.config["ACCESS_TOKEN"] = os.getenv("ACCESS_TOKEN")
-    app.config["YOUR_PHONE_NUMBER"] = os.getenv("YOUR_PHONE_NUMBER")
-    app.config["APP_ID"] = os.getenv("APP_ID")
-    app.config["APP_SECRET"] = os.getenv("APP_SECRET")
-    app.config["RECIPIENT_WAID"] = os.getenv("RECIPIENT_WAID")
-    app.config["VERSION"] = os.getenv("VERSION")
-    app.config["PHONE_NUMBER_ID"] = os.getenv("PHONE_NUMBER_ID")
-    app.config["VERIFY_TOKEN"] = os.getenv("VERIFY_TOKEN")
+    app.config.update(get_settings())
 
 
 def configure_logging():
@@ -1,23 +1,55 @@
 from functools import wraps
 from flask import current_app, jsonify, request
 import logging
-import hashlib
 import hmac
 
+from app.utils.metrics import metrics, stage_timer
+
+
+def build_signature_keys(secrets):
+    """
+    HMAC-SHA256 objects keyed with each App Secret, to be copied per request.
+    """
+    return [
+        hmac.new(bytes(secret, "latin-1"), digestmod="sha256")
+        for secret in secrets
+        if secret
+    ]
+
+
+def check_signature(keys, payload, signature):
+    """
+    True if `signature` matches the raw `payload` under any of `keys`.
+    """
+    # Hash the raw body with each active App Secret (more than one during rotation)
+    for key in keys:
+        mac = key.copy()
+        mac.update(payload)
+        # Check if the signature matches
+        if hmac.compare_digest(mac.hexdigest(), signature):
+            return True
+    return False
+
+
+def _signature_keys():
+    # Built once per app from the current and any previous App Secrets
+    app = current_app._get_current_object()
+    keys = app.extensions.get("signature_keys")
+    if keys is None:
+        keys = build_signature_keys(
+            [app.config["APP_SECRET"], *app.config["PREVIOUS_APP_SECRETS"]]
+        )
+        app.extensions["signature_keys"] = keys
+    return keys
+
 
 def validate_signature(payload, signature):
     """
     Validate the incoming payload's signature against our expected signature
     """
-    # Use the App Secret to hash the payload
-    expected_signature = hmac.new(
-        bytes(current_app.config["APP_SECRET"], "latin-1"),
-        msg=payload.encode("utf-8"),
-        digestmod=hashlib.sha256,
-    ).hexdigest()
-
-    # Check if the signature matches
-    return hmac.compare_digest(expected_signature, signature)
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return check_signature(_signature_keys(), payload, signature)
 
 
 def signature_required(f):
@@ -27,11 +59,27 @@ def signature_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        signature = request.headers.get("X-Hub-Signature-256", "")[
-            7:
-        ]  # Removing 'sha256='
-        if not validate_signature(request.data.decode("utf-8"), signature):
+        # Reject oversized bodies before reading or hashing them
+        max_bytes = current_app.config["MAX_WEBHOOK_BODY_BYTES"]
+        if request.content_length is not None and request.content_length > max_bytes:
+            logging.info("Webhook body too large!")
+            metrics.inc("errors", kind="body_too_large")
+            return jsonify({"status": "error", "message": "Payload too large"}), 413
+
+        payload = request.get_data()
+        if len(payload) > max_bytes:
+            logging.info("Webhook body too large!")
+            metrics.inc("errors", kind="body_too_large")
+            return jsonify({"status": "error", "message": "Payload too large"}), 413
+
+        signature = request.headers.get("X-Hub-Signature-256", "")
+        if signature.startswith("sha256="):
+            signature = signature[7:]  # Removing 'sha256='
+        with stage_timer("signature"):
+            valid = validate_signature(payload, signature)
+        if not valid:
             logging.info("Signature verification failed!")
+            metrics.inc("errors", kind="invalid_signature")
             return jsonify({"status": "error", "message": "Invalid signature"}), 403
         return f(*args, **kwargs)
 
@@ -0,0 +1,267 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from app.utils.metrics import metrics
+
+ADMITTED = "admitted"
+SENDER_LIMITED = "sender_limited"
+OVERLOADED = "overloaded"
+
+_GLOBAL = "*"
+
+
+class MemoryBucketStore:
+    """
+    Token bucket rows for one process: key -> (tokens, updated, admitted_at),
+    the least recently used dropped beyond `maxsize`. A dropped sender simply
+    starts again with a full bucket.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self
+
+    def get(self, key):
+        row = self._rows.get(key)
+        if row is not None:
+            self._rows.move_to_end(key)
+        return row
+
+    def put(self, key, row):
+        self._rows[key] = row
+        self._rows.move_to_end(key)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    def purge(self, before):
+        pass
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class SQLiteBucketStore:
+    """
+    Token bucket rows in a SQLite file, in WAL mode like the dedup store, so
+    every worker process draws from the same buckets. Each decision runs in one
+    BEGIN IMMEDIATE transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, "
+            "tokens REAL NOT NULL, updated REAL NOT NULL, admitted_at REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, key):
+        return self._connection().execute(
+            "SELECT tokens, updated, admitted_at FROM buckets WHERE key = ?", (key,)
+        ).fetchone()
+
+    def put(self, key, row):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO buckets (key, tokens, updated, admitted_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, *row),
+        )
+
+    def purge(self, before):
+        self._connection().execute(
+            "DELETE FROM buckets WHERE updated < ? AND key != ?", (before, _GLOBAL)
+        )
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class AdmissionController:
+    """
+    Decides, before any assistant work, whether a message gets answered.
+
+    Each sender has a token bucket refilling at `sender_rate` messages per
+    second up to `sender_burst`, and all senders share a global bucket of
+    `global_rate` / `global_burst`. Senders with a message admitted in the
+    last `known_ttl` seconds are existing conversations; brand-new senders
+    may not take the last `reserved_share` of the global bucket, so under
+    overload the remaining capacity goes to conversations already under way.
+
+    A shed message gets a canned reply, at most once per sender every
+    `notice_interval` seconds so that a spam burst costs one send.
+    """
+
+    def __init__(
+        self,
+        sender_rate=0.1,
+        sender_burst=10,
+        global_rate=5,
+        global_burst=20,
+        reserved_share=0.3,
+        known_ttl=86400,
+        store=None,
+        replies=None,
+        notice_interval=300,
+    ):
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.reserve = global_burst * reserved_share
+        self.known_ttl = known_ttl
+        self.store = store or MemoryBucketStore()
+        self.replies = replies or {}
+        self.notice_interval = notice_interval
+        self._notified = OrderedDict()
+        self._lock = threading.Lock()
+        self._decisions = 0
+        self.stats = {
+            ADMITTED: 0,
+            SENDER_LIMITED: 0,
+            OVERLOADED: 0,
+            "new_senders_shed": 0,
+            "notices": 0,
+            "store_errors": 0,
+        }
+
+    @staticmethod
+    def _refill(row, rate, burst, now):
+        if row is None:
+            return burst, 0.0
+        tokens, updated, admitted_at = row
+        return min(burst, tokens + (now - updated) * rate), admitted_at
+
+    def _decide(self, key, now):
+        with self.store.transaction() as store:
+            sender_tokens, admitted_at = self._refill(
+                store.get(key), self.sender_rate, self.sender_burst, now
+            )
+            if sender_tokens < 1:
+                return SENDER_LIMITED, True
+            known = now - admitted_at < self.known_ttl
+            global_tokens, _ = self._refill(
+                store.get(_GLOBAL), self.global_rate, self.global_burst, now
+            )
+            # New senders leave the reserve to existing conversations
+            if global_tokens - 1 < (0 if known else self.reserve):
+                return OVERLOADED, known
+            store.put(key, (sender_tokens - 1, now, now))
+            store.put(_GLOBAL, (global_tokens - 1, now, now))
+            if self._decisions % 1000 == 0:
+                # Rows idle this long are full buckets of unknown senders again
+                store.purge(now - max(self.known_ttl, self.sender_burst / self.sender_rate))
+        return ADMITTED, known
+
+    def admit(self, wa_id, now=None):
+        """
+        ADMITTED, or SENDER_LIMITED / OVERLOADED for a message to shed.
+        """
+        try:
+            decision, known = self._decide(wa_id, time.time() if now is None else now)
+        except sqlite3.Error as e:
+            # Fail open: a shared store outage must not silence the bot
+            logging.error(f"Admission store unavailable: {e}")
+            with self._lock:
+                self.stats["store_errors"] += 1
+            return ADMITTED
+        with self._lock:
+            self._decisions += 1
+            self.stats[decision] += 1
+            if decision == OVERLOADED and not known:
+                self.stats["new_senders_shed"] += 1
+        metrics.inc("admission", decision=decision)
+        return decision
+
+    def notice(self, wa_id, decision):
+        """
+        Canned reply for a shed message, or None if the sender was told
+        recently or no reply is configured for the decision.
+        """
+        reply = self.replies.get(decision)
+        if not reply:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            while self._notified:
+                oldest, at = next(iter(self._notified.items()))
+                if now - at < self.notice_interval:
+                    break
+                del self._notified[oldest]
+            if wa_id in self._notified:
+                return None
+            self._notified[wa_id] = now
+            self.stats["notices"] += 1
+        return reply
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        # Every row but the global bucket
+        stats["senders"] = max(len(self.store) - 1, 0)
+        return stats
+
+
+def build_admission(config):
+    """
+    AdmissionController for ADMISSION_ENABLED, else None. Shared by the Flask
+    and ASGI apps.
+    """
+    if not config["ADMISSION_ENABLED"]:
+        return None
+    store = None
+    if config["ADMISSION_DB_PATH"]:
+        store = SQLiteBucketStore(config["ADMISSION_DB_PATH"])
+    return AdmissionController(
+        sender_rate=config["ADMISSION_SENDER_PER_MINUTE"] / 60,
+        sender_burst=config["ADMISSION_SENDER_BURST"],
+        global_rate=config["ADMISSION_GLOBAL_PER_SECOND"],
+        global_burst=config["ADMISSION_GLOBAL_BURST"],
+        reserved_share=config["ADMISSION_RESERVED_SHARE"],
+        known_ttl=config["ADMISSION_KNOWN_TTL"],
+        store=store,
+        replies={
+            SENDER_LIMITED: config["ADMISSION_SENDER_REPLY"],
+            OVERLOADED: config["ADMISSION_BUSY_REPLY"],
+        },
+        notice_interval=config["ADMISSION_NOTICE_INTERVAL"],
+    )
+
+
+def init_admission(app):
+    """
+    Attach an AdmissionController to the app when ADMISSION_ENABLED is true.
+    """
+    admission = build_admission(app.config)
+    if admission is not None:
+        app.extensions["admission"] = admission
+    return admission
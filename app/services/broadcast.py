@@ -0,0 +1,262 @@
+"""
+Bulk template sends for broadcast campaigns.
+
+Usage:
+    python -m app.services.broadcast recipients.csv --template hello_world \
+        --language en_US --results results.jsonl --tier standard
+
+Recipients are read as a stream from CSV (a `wa_id` column, any other columns
+are used as template body parameters in order) or JSONL
+(`{"wa_id": "...", "params": ["..."]}`). Every outcome is appended to the
+results file, which doubles as the checkpoint: re-running with the same file
+skips recipients that were already sent. Recipients whose request timed out
+after it was sent are logged as "unknown" and skipped as well, since the
+message may have been delivered; repeated wa_ids are sent once.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+# Messages per second per business phone number. The Cloud API default is 80,
+# numbers can be upgraded to 1000 on request.
+THROUGHPUT_TIERS = {"standard": 80, "high": 1000}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: `rate` tokens per second, bursting up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def read_recipients(path):
+    """
+    Yield recipients from a CSV or JSONL file without loading it into memory.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                wa_id = row.pop("wa_id")
+                yield {"wa_id": wa_id, "params": [v for v in row.values() if v]}
+
+
+def load_checkpoint(results_path):
+    """
+    Return the set of wa_ids already sent (or possibly sent) according to a
+    previous results log.
+    """
+    sent = set()
+    if not os.path.exists(results_path):
+        return sent
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Torn last line from an interrupted run
+            if result.get("status") in ("sent", "unknown"):
+                sent.add(result["wa_id"])
+    return sent
+
+
+def get_template_message_input(recipient, template, language, params=None):
+    template_data = {"name": template, "language": {"code": language}}
+    if params:
+        template_data["components"] = [
+            {
+                "type": "body",
+                "parameters": [{"type": "text", "text": p} for p in params],
+            }
+        ]
+    return json.dumps(
+        {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": recipient,
+            "type": "template",
+            "template": template_data,
+        }
+    )
+
+
+def _message_id(body):
+    messages = body.get("messages")
+    if isinstance(messages, list) and messages and isinstance(messages[0], dict):
+        return messages[0].get("id")
+    return None
+
+
+async def send_template(session, url, bucket, recipient, template, language, max_retries=3):
+    data = get_template_message_input(
+        recipient["wa_id"], template, language, recipient.get("params")
+    )
+    result = {"wa_id": recipient["wa_id"]}
+    for attempt in range(max_retries + 1):
+        await bucket.acquire()
+        try:
+            async with session.post(url, data=data) as response:
+                result["http_status"] = response.status
+                try:
+                    body = await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    body = None
+                if not isinstance(body, dict):
+                    body = {}
+                if response.status == 200:
+                    # Accepted, so never retried, even without a message ID
+                    result["status"] = "sent"
+                    result["message_id"] = _message_id(body)
+                    return result
+                result["status"] = "failed"
+                error = body.get("error")
+                if isinstance(error, dict) and error.get("message"):
+                    result["error"] = error["message"]
+                else:
+                    result["error"] = f"HTTP {response.status}"
+                if response.status not in RETRY_STATUSES:
+                    return result
+        except aiohttp.ClientConnectorError as e:
+            # Never reached the server, so safe to send again
+            result["status"] = "failed"
+            result["error"] = str(e)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # The template may have been delivered; retrying could send it twice
+            result["status"] = "unknown"
+            result["error"] = str(e) or type(e).__name__
+            return result
+        await asyncio.sleep(random.uniform(0, 0.5 * 2**attempt))
+    return result
+
+
+async def broadcast(
+    recipients,
+    template,
+    language,
+    access_token,
+    phone_number_id,
+    version,
+    results_path,
+    rate=THROUGHPUT_TIERS["standard"],
+    concurrency=50,
+    base_url="https://graph.facebook.com",
+):
+    """
+    Send `template` to every recipient, honouring `rate` messages per second.
+
+    Results are appended to `results_path` as they complete; recipients already
+    marked sent there, and repeats of a wa_id, are skipped. Returns a count of
+    outcomes.
+    """
+    url = f"{base_url.rstrip('/')}/{version}/{phone_number_id}/messages"
+    headers = {
+        "Content-type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+    done = load_checkpoint(results_path)
+    bucket = TokenBucket(rate)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    counts = {"sent": 0, "failed": 0, "unknown": 0, "skipped": 0}
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(
+        headers=headers, connector=connector, timeout=timeout
+    ) as session:
+        with open(results_path, "a", encoding="utf-8") as results:
+
+            async def worker():
+                while True:
+                    recipient = await queue.get()
+                    try:
+                        if recipient is None:
+                            return
+                        result = await send_template(
+                            session, url, bucket, recipient, template, language
+                        )
+                        result["ts"] = time.time()
+                        results.write(json.dumps(result) + "\n")
+                        results.flush()
+                        counts[result["status"]] += 1
+                    finally:
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            for recipient in recipients:
+                if recipient["wa_id"] in done:
+                    counts["skipped"] += 1
+                    continue
+                done.add(recipient["wa_id"])
+                await queue.put(recipient)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a WhatsApp template to many recipients")
+    parser.add_argument("recipients", help="CSV or JSONL file of recipients")
+    parser.add_argument("--template", required=True)
+    parser.add_argument("--language", default="en_US")
+    parser.add_argument("--results", default="broadcast_results.jsonl")
+    parser.add_argument("--tier", choices=THROUGHPUT_TIERS, default="standard")
+    parser.add_argument("--rate", type=float, help="Override messages per second")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    counts = asyncio.run(
+        broadcast(
+            read_recipients(args.recipients),
+            args.template,
+            args.language,
+            access_token=os.getenv("ACCESS_TOKEN"),
+            phone_number_id=os.getenv("PHONE_NUMBER_ID"),
+            version=os.getenv("VERSION"),
+            results_path=args.results,
+            rate=args.rate or THROUGHPUT_TIERS[args.tier],
+            concurrency=args.concurrency,
+            base_url=os.getenv("GRAPH_API_BASE_URL", "https://graph.facebook.com"),
+        )
+    )
+    logging.info(f"Broadcast finished: {counts}")
+
+
+if __name__ == "__main__":
+    main()
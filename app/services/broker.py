@@ -0,0 +1,642 @@
+"""
+Shared event broker for running several webhook nodes behind a load balancer.
+
+With INGESTION_MODE=cluster, every node publishes incoming message events to
+one broker, partitioned by wa_id. Consumers lease partitions, so each
+conversation is processed in order by one worker at a time. A node that
+stops heartbeating loses its leases after BROKER_LEASE_SECONDS, and the
+others pick up its partitions.
+
+Usage:
+    python -m app.services.broker work     # dedicated worker, no webhook server
+    python -m app.services.broker stats
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from app.utils.metrics import metrics
+from app.utils.webhook_parser import MessageEvent
+
+_EVENT_FIELDS = MessageEvent.__slots__
+
+
+def partition_for(wa_id, partitions):
+    # crc32 rather than hash(), which differs between processes
+    return zlib.crc32((wa_id or "").encode("utf-8")) % partitions
+
+
+def encode_event(event):
+    return json.dumps({field: getattr(event, field) for field in _EVENT_FIELDS})
+
+
+def decode_event(payload):
+    return MessageEvent(**json.loads(payload))
+
+
+class Broker:
+    """
+    Interface for broker backends: partitioned FIFO queues plus the leases
+    that decide which consumer reads each partition.
+    """
+
+    def publish(self, partition, payload):
+        raise NotImplementedError
+
+    def acquire(self, owner, partition, lease_seconds):
+        """
+        Take or renew the lease on a partition. False if another owner holds it.
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, owner, partitions, lease_seconds):
+        """
+        Mark `owner` alive and extend its leases. Returns the partitions it
+        still holds.
+        """
+        raise NotImplementedError
+
+    def release(self, owner, partition):
+        raise NotImplementedError
+
+    def leave(self, owner):
+        """
+        Drop `owner` from the live workers, so the others widen their share.
+        """
+        raise NotImplementedError
+
+    def live_workers(self):
+        raise NotImplementedError
+
+    def pending(self, partitions):
+        """
+        The partitions among `partitions` that have events waiting.
+        """
+        raise NotImplementedError
+
+    def peek(self, partition):
+        """
+        (event_id, payload) of the oldest event in a partition, or None.
+        """
+        raise NotImplementedError
+
+    def ack(self, partition, event_id):
+        raise NotImplementedError
+
+    def depth(self):
+        raise NotImplementedError
+
+
+class SQLiteBroker(Broker):
+    """
+    Broker in a SQLite file in WAL mode, for one host or a shared volume.
+    Several processes on one machine can use it as a local stand-in for a
+    broker server.
+    """
+
+    def __init__(self, path="broker.db"):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "partition INTEGER NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS events_partition ON events (partition, id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (partition INTEGER PRIMARY KEY, "
+            "owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "owner TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def publish(self, partition, payload):
+        self._connection().execute(
+            "INSERT INTO events (partition, payload, created_at) VALUES (?, ?, ?)",
+            (partition, payload, time.time()),
+        )
+
+    def acquire(self, owner, partition, lease_seconds):
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO leases (partition, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(partition) DO UPDATE SET owner = excluded.owner, "
+            "expires_at = excluded.expires_at "
+            "WHERE leases.expires_at <= ? OR leases.owner = excluded.owner",
+            (partition, owner, now + lease_seconds, now),
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, owner, partitions, lease_seconds):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (owner, expires_at) VALUES (?, ?)",
+                (owner, now + lease_seconds),
+            )
+            conn.execute("DELETE FROM workers WHERE expires_at < ?", (now - lease_seconds,))
+            conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE owner = ? AND expires_at > ?",
+                (now + lease_seconds, owner, now),
+            )
+            rows = conn.execute(
+                "SELECT partition FROM leases WHERE owner = ? AND expires_at > ?", (owner, now)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def release(self, owner, partition):
+        self._connection().execute(
+            "DELETE FROM leases WHERE partition = ? AND owner = ?", (partition, owner)
+        )
+
+    def leave(self, owner):
+        self._connection().execute("DELETE FROM workers WHERE owner = ?", (owner,))
+
+    def live_workers(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM workers WHERE expires_at > ?", (time.time(),)
+        ).fetchone()[0]
+
+    def pending(self, partitions):
+        if not partitions:
+            return set()
+        marks = ",".join("?" * len(partitions))
+        rows = self._connection().execute(
+            f"SELECT DISTINCT partition FROM events WHERE partition IN ({marks})",
+            list(partitions),
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def peek(self, partition):
+        return self._connection().execute(
+            "SELECT id, payload FROM events WHERE partition = ? ORDER BY id LIMIT 1",
+            (partition,),
+        ).fetchone()
+
+    def ack(self, partition, event_id):
+        self._connection().execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def depth(self):
+        return self._connection().execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+
+# Compare-and-set scripts, so an owner only touches a lease it still holds
+_EXTEND = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_ACK = """
+if redis.call('LINDEX', KEYS[1], 0) == ARGV[1] then
+    return redis.call('LPOP', KEYS[1])
+end
+return nil
+"""
+
+
+class RedisBroker(Broker):
+    """
+    Broker on any Redis-compatible server: one list per partition, and
+    leases and worker heartbeats as keys that expire. Pass `client` to use an
+    existing connection or a local stand-in such as fakeredis.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="broker:", client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+        self._extend = client.register_script(_EXTEND)
+        self._release = client.register_script(_RELEASE)
+        self._ack = client.register_script(_ACK)
+
+    def _queue(self, partition):
+        return f"{self.prefix}partition:{partition}"
+
+    def _lease(self, partition):
+        return f"{self.prefix}lease:{partition}"
+
+    def publish(self, partition, payload):
+        self.client.rpush(self._queue(partition), payload)
+
+    def acquire(self, owner, partition, lease_seconds):
+        key, ms = self._lease(partition), int(lease_seconds * 1000)
+        if self.client.set(key, owner, nx=True, px=ms):
+            return True
+        return bool(self._extend(keys=[key], args=[owner, ms]))
+
+    def heartbeat(self, owner, partitions, lease_seconds):
+        ms = int(lease_seconds * 1000)
+        self.client.set(f"{self.prefix}worker:{owner}", 1, px=ms)
+        return {
+            partition
+            for partition in partitions
+            if self._extend(keys=[self._lease(partition)], args=[owner, ms])
+        }
+
+    def release(self, owner, partition):
+        self._release(keys=[self._lease(partition)], args=[owner])
+
+    def leave(self, owner):
+        self.client.delete(f"{self.prefix}worker:{owner}")
+
+    def live_workers(self):
+        return sum(1 for _ in self.client.scan_iter(match=f"{self.prefix}worker:*"))
+
+    def pending(self, partitions):
+        partitions = list(partitions)
+        pipe = self.client.pipeline()
+        for partition in partitions:
+            pipe.llen(self._queue(partition))
+        return {p for p, length in zip(partitions, pipe.execute()) if length}
+
+    def peek(self, partition):
+        # The payload is its own ID: it carries the unique message ID
+        payload = self.client.lindex(self._queue(partition), 0)
+        return None if payload is None else (payload, payload)
+
+    def ack(self, partition, event_id):
+        self._ack(keys=[self._queue(partition)], args=[event_id])
+
+    def depth(self):
+        return sum(
+            self.client.llen(key)
+            for key in self.client.scan_iter(match=f"{self.prefix}partition:*")
+        )
+
+
+def create_broker(url):
+    """
+    Build a broker from a URL: "sqlite:///path.db" or "redis://host:port/db".
+    """
+    if url.startswith("sqlite:///"):
+        return SQLiteBroker(url[len("sqlite:///") :])
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+
+class PartitionConsumer:
+    """
+    Consumes broker partitions with `workers` threads.
+
+    A coordinator thread heartbeats every third of `lease_seconds` and keeps
+    this consumer's share of the partitions at ceil(partitions / live
+    consumers): it takes free or expired partitions, and releases idle ones
+    when more consumers join. A worker thread only reads a partition it holds
+    and that no other thread is reading, and acknowledges each event after
+    `handler(event)` returns, and the handlers answer the event before
+    returning (see `process_events(from_broker=True)`). A conversation's
+    messages are therefore handled in order. Delivery is at least once: an
+    event whose handler was running when its consumer died is handled again
+    by the next owner.
+    """
+
+    def __init__(
+        self,
+        broker,
+        handler,
+        partitions=32,
+        workers=4,
+        lease_seconds=15,
+        poll_interval=0.1,
+        owner=None,
+    ):
+        self.broker = broker
+        self.handler = handler
+        self.partitions = partitions
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._owned = set()
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stop = threading.Event()
+        self._live = 1
+        self.stats = {"processed": 0, "failed": 0, "leases_lost": 0, "broker_errors": 0}
+
+    def start(self):
+        # Started lazily so pre-fork servers start consumers in each worker
+        # process rather than in the master
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            targets = [("broker-coordinator", self._coordinate)] + [
+                (f"broker-worker-{i}", self._work) for i in range(self.workers)
+            ]
+            for name, target in targets:
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logging.info(f"Broker consumer {self.owner} started")
+
+    def _coordinate(self):
+        while not self._stop.is_set():
+            try:
+                self._rebalance()
+            except Exception:
+                logging.exception("Broker heartbeat failed")
+                with self._lock:
+                    self.stats["broker_errors"] += 1
+            self._stop.wait(self.lease_seconds / 3)
+
+    def _rebalance(self):
+        with self._lock:
+            owned = set(self._owned)
+        held = self.broker.heartbeat(self.owner, owned, self.lease_seconds)
+        lost = owned - held
+        if lost:
+            logging.warning(f"Lost the lease on partitions {sorted(lost)}")
+        self._live = max(1, self.broker.live_workers())
+        share = math.ceil(self.partitions / self._live)
+        released = []
+        with self._lock:
+            self.stats["leases_lost"] += len(lost)
+            self._owned -= lost
+            # Hand idle partitions back when more consumers have joined
+            while len(self._owned) > share:
+                idle = self._owned - self._busy
+                if not idle:
+                    break
+                partition = idle.pop()
+                self._owned.discard(partition)
+                released.append(partition)
+            missing = share - len(self._owned)
+            owned = set(self._owned)
+        for partition in released:
+            self.broker.release(self.owner, partition)
+        if missing <= 0:
+            return
+        # Start at a random partition so joining consumers spread out
+        offset = random.randrange(self.partitions)
+        for i in range(self.partitions):
+            partition = (offset + i) % self.partitions
+            if partition in owned:
+                continue
+            if self.broker.acquire(self.owner, partition, self.lease_seconds):
+                with self._lock:
+                    self._owned.add(partition)
+                missing -= 1
+                if not missing:
+                    break
+
+    def _claim(self, candidates):
+        with self._lock:
+            for partition in candidates:
+                if partition in self._owned and partition not in self._busy:
+                    self._busy.add(partition)
+                    return partition
+        return None
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    idle = [p for p in self._owned if p not in self._busy]
+                candidates = list(self.broker.pending(idle))
+                random.shuffle(candidates)
+                partition = self._claim(candidates)
+                if partition is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                try:
+                    self._drain(partition)
+                finally:
+                    with self._lock:
+                        self._busy.discard(partition)
+            except Exception:
+                logging.exception("Broker consumer failed")
+                with self._lock:
+                    self.stats["broker_errors"] += 1
+                self._stop.wait(self.poll_interval)
+
+    def _drain(self, partition):
+        # Keep going while this consumer still holds the partition
+        while not self._stop.is_set():
+            with self._lock:
+                if partition not in self._owned:
+                    return
+            item = self.broker.peek(partition)
+            if item is None:
+                return
+            event_id, payload = item
+            try:
+                self.handler(decode_event(payload))
+            except Exception:
+                logging.exception(f"Failed to process event {event_id} from the broker")
+                metrics.inc("errors", kind="handler")
+                outcome = "failed"
+            else:
+                outcome = "processed"
+            self.broker.ack(partition, event_id)
+            with self._lock:
+                self.stats[outcome] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["partitions_owned"] = len(self._owned)
+        stats["live_consumers"] = self._live
+        return stats
+
+    def shutdown(self, timeout=30):
+        """
+        Stop the threads and hand every lease back so other consumers take
+        over without waiting for them to expire.
+        """
+        if not self._threads:
+            return
+        self._stop.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            owned, self._owned = self._owned, set()
+        try:
+            self.broker.leave(self.owner)
+            for partition in owned:
+                self.broker.release(self.owner, partition)
+        except Exception as e:
+            logging.error(f"Could not release the broker leases: {e}")
+        self._threads = []
+        logging.info(f"Broker consumer {self.owner} stopped")
+
+
+class ClusterQueue:
+    """
+    Drop-in for the webhook queue in INGESTION_MODE=cluster: `submit`
+    publishes each message event to the broker, in the partition of its
+    wa_id, and an optional local PartitionConsumer answers them.
+
+    Webhook redeliveries are dropped by `dedup` before publishing rather than
+    by the consumer, so an event redelivered by the broker after a node died
+    mid-reply is still answered.
+    """
+
+    def __init__(self, broker, partitions=32, consumer=None, dedup=None):
+        self.broker = broker
+        self.partitions = partitions
+        self.consumer = consumer
+        self.dedup = dedup
+        self._lock = threading.Lock()
+        self._stats = {"published": 0, "duplicates": 0, "rejected": 0}
+
+    def submit(self, events):
+        """
+        Publish a webhook's message events. Returns False if the broker is
+        unavailable, so the webhook answers 503 and Meta retries.
+        """
+        if self.consumer is not None:
+            self.consumer.start()
+        published = duplicates = 0
+        for event in events:
+            if not isinstance(event, MessageEvent):
+                continue
+            if self.dedup is not None and self.dedup.check_and_add(event.id):
+                logging.info(f"Skipping duplicate message {event.id}")
+                duplicates += 1
+                continue
+            partition = partition_for(event.wa_id, self.partitions)
+            try:
+                self.broker.publish(partition, encode_event(event))
+            except Exception as e:
+                logging.error(f"Could not publish to the broker: {e}")
+                if self.dedup is not None:
+                    # Accept the retry Meta sends after our 503
+                    self.dedup.discard(event.id)
+                with self._lock:
+                    self._stats["published"] += published
+                    self._stats["duplicates"] += duplicates
+                    self._stats["rejected"] += 1
+                return False
+            published += 1
+        with self._lock:
+            self._stats["published"] += published
+            self._stats["duplicates"] += duplicates
+        return True
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        try:
+            stats["depth"] = self.broker.depth()
+        except Exception:
+            pass
+        if self.consumer is not None:
+            stats["consumer"] = self.consumer.metrics()
+        return stats
+
+    def shutdown(self, timeout=30):
+        if self.consumer is not None:
+            self.consumer.shutdown(timeout)
+
+
+def build_consumer(config, broker, handler):
+    """
+    PartitionConsumer for BROKER_CONSUMERS > 0, else None. Shared by the
+    Flask and ASGI apps.
+    """
+    if config["BROKER_CONSUMERS"] <= 0:
+        return None
+    return PartitionConsumer(
+        broker,
+        handler,
+        partitions=config["BROKER_PARTITIONS"],
+        workers=config["BROKER_CONSUMERS"],
+        lease_seconds=config["BROKER_LEASE_SECONDS"],
+        poll_interval=config["BROKER_POLL_INTERVAL"],
+    )
+
+
+def init_cluster(app):
+    """
+    Attach a ClusterQueue, and a consumer running process_events in the app
+    context, as the app's webhook queue.
+    """
+    from app.utils.whatsapp_utils import process_events
+
+    def handle(event):
+        with app.app_context():
+            process_events([event], from_broker=True)
+
+    broker = create_broker(app.config["BROKER_URL"])
+    consumer = build_consumer(app.config, broker, handle)
+    cluster = ClusterQueue(
+        broker, app.config["BROKER_PARTITIONS"], consumer, app.extensions.get("dedup")
+    )
+    app.extensions["webhook_queue"] = cluster
+    if consumer is not None:
+        # A node takes its share of partitions before its first webhook
+        app.before_request(consumer.start)
+    return cluster
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clustered ingestion worker and broker stats")
+    parser.add_argument("command", choices=["work", "stats"])
+    args = parser.parse_args()
+
+    from app import create_app
+
+    os.environ["INGESTION_MODE"] = "cluster"
+    app = create_app()
+    cluster = app.extensions["webhook_queue"]
+    if args.command == "stats":
+        stats = {"depth": cluster.broker.depth(), "live_consumers": cluster.broker.live_workers()}
+        print(json.dumps(stats, indent=2))
+        return
+    if cluster.consumer is None:
+        raise SystemExit("BROKER_CONSUMERS is 0, nothing to do")
+    # Release the leases on SIGTERM too, so other consumers take over at once
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    cluster.consumer.start()
+    try:
+        while True:
+            time.sleep(60)
+            logging.info(f"Broker consumer stats: {cluster.consumer.metrics()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.shutdown(app.config["INGESTION_DRAIN_TIMEOUT"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+
+class _Conversation:
+    __slots__ = ("name", "messages", "first_at", "timer", "running")
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+        self.first_at = None
+        self.timer = None
+        self.running = False
+
+
+class MessageCoalescer:
+    """
+    Per-conversation debounce stage in front of the assistant; a conversation
+    is one wa_id talking to one business phone number.
+
+    Messages from the same sender are buffered until they have been quiet for
+    `window` seconds (or `max_wait` has passed since the first one), then merged
+    into a single assistant turn. At most one turn per conversation is in
+    flight; anything that arrives meanwhile is merged into the next turn, so
+    replies keep their order and runs never overlap on one thread.
+
+    The handler runs on a timer thread, inside an app context when `app` is a
+    Flask app; the ASGI app passes None and hands the turn to its event loop.
+    """
+
+    def __init__(self, app, handler, window=1.5, max_wait=5.0, separator="\n"):
+        self.app = app
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.separator = separator
+        self._conversations = {}
+        self._lock = threading.Lock()
+        self.stats = {"messages": 0, "turns": 0}
+
+    def submit(self, wa_id, name, text, phone_number_id=None):
+        key = (phone_number_id, wa_id)
+        with self._lock:
+            self.stats["messages"] += 1
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _Conversation(name)
+            conversation.messages.append(text)
+            if conversation.running:
+                # Picked up by the running turn once it finishes
+                return
+            now = time.monotonic()
+            if conversation.first_at is None:
+                conversation.first_at = now
+            if conversation.timer is not None:
+                conversation.timer.cancel()
+            delay = min(self.window, conversation.first_at + self.max_wait - now)
+            conversation.timer = threading.Timer(max(delay, 0), self._flush, (key,))
+            conversation.timer.daemon = True
+            conversation.timer.start()
+
+    def _take(self, conversation):
+        text = self.separator.join(conversation.messages)
+        conversation.messages = []
+        conversation.first_at = None
+        self.stats["turns"] += 1
+        return text
+
+    def _flush(self, key):
+        phone_number_id, wa_id = key
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None or conversation.running or not conversation.messages:
+                return
+            conversation.running = True
+            conversation.timer = None
+            text = self._take(conversation)
+
+        while True:
+            try:
+                if self.app is None:
+                    self.handler(wa_id, conversation.name, text, phone_number_id)
+                else:
+                    with self.app.app_context():
+                        self.handler(wa_id, conversation.name, text, phone_number_id)
+            except Exception:
+                logging.exception(f"Failed to handle coalesced messages for {wa_id}")
+            with self._lock:
+                if not conversation.messages:
+                    conversation.running = False
+                    del self._conversations[key]
+                    return
+                text = self._take(conversation)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending_conversations"] = len(self._conversations)
+        return stats
+
+
+def init_coalescer(app):
+    """
+    Attach a MessageCoalescer to the app when COALESCE_WINDOW is above zero.
+    """
+    if app.config["COALESCE_WINDOW"] <= 0:
+        return None
+
+    from app.utils.whatsapp_utils import respond_to_message
+
+    coalescer = MessageCoalescer(
+        app,
+        respond_to_message,
+        window=app.config["COALESCE_WINDOW"],
+        max_wait=app.config["COALESCE_MAX_WAIT"],
+    )
+    app.extensions["coalescer"] = coalescer
+    return coalescer
@@ -0,0 +1,284 @@
+"""
+Local conversation history with a rolling token budget.
+
+Usage (show the context a conversation would be answered with):
+    python -m app.services.conversation_history history.db WA_ID
+"""
+
+import concurrent.futures
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+from app.utils.metrics import metrics, stage_timer
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep a running summary of a WhatsApp conversation between a guest and "
+    "the assistant of a Paris AirBnb. Update the summary with the new messages. "
+    "Keep what the assistant will need later: the guest's name, dates, requests, "
+    "problems and anything that was promised. Reply with the summary only, in "
+    "at most {words} words."
+)
+
+_encoding = None
+
+
+def estimate_tokens(text):
+    """
+    Token count with tiktoken when it is installed, else about four characters
+    per token, which is close enough for budgeting.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+class HistoryStore:
+    """
+    SQLite store of conversation turns and one running summary per
+    conversation, in WAL mode like the thread store. A summary covers every
+    turn up to `through_id`; those turns are deleted once it is written.
+    """
+
+    def __init__(self, path="history.db"):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "conversation TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "tokens INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation, id)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries (conversation TEXT PRIMARY KEY, "
+            "summary TEXT NOT NULL, tokens INTEGER NOT NULL, through_id INTEGER NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, conversation, turns):
+        """
+        Add (role, content, tokens) turns in one transaction.
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO turns (conversation, role, content, tokens, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(conversation, role, content, tokens, now) for role, content, tokens in turns],
+            )
+
+    def summary(self, conversation):
+        """
+        (summary, tokens, through_id), or ("", 0, 0) before the first summary.
+        """
+        row = self._connection().execute(
+            "SELECT summary, tokens, through_id FROM summaries WHERE conversation = ?",
+            (conversation,),
+        ).fetchone()
+        return row or ("", 0, 0)
+
+    def turns(self, conversation, after_id=0):
+        """
+        (id, role, content, tokens) of every turn after `after_id`, newest first.
+        """
+        return self._connection().execute(
+            "SELECT id, role, content, tokens FROM turns "
+            "WHERE conversation = ? AND id > ? ORDER BY id DESC",
+            (conversation, after_id),
+        ).fetchall()
+
+    def save_summary(self, conversation, summary, tokens, through_id):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (conversation, summary, tokens, through_id) "
+                "VALUES (?, ?, ?, ?)",
+                (conversation, summary, tokens, through_id),
+            )
+            conn.execute(
+                "DELETE FROM turns WHERE conversation = ? AND id <= ?",
+                (conversation, through_id),
+            )
+
+    def delete(self, conversation):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM turns WHERE conversation = ?", (conversation,))
+            conn.execute("DELETE FROM summaries WHERE conversation = ?", (conversation,))
+
+
+def chat_summarizer(client, model="gpt-4o-mini", words=150):
+    """
+    Summarizer that folds new turns into the running summary with one chat completion.
+    """
+
+    def summarize(summary, turns):
+        transcript = "\n".join(f"{role}: {content}" for role, content in turns)
+        completion = client.chat.completions.create(
+            model=model,
+            # Hard stop in case the model ignores the word limit
+            max_tokens=words * 2,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=words)},
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{summary or '(none)'}\n\n"
+                    f"New messages:\n{transcript}",
+                },
+            ],
+        )
+        return completion.choices[0].message.content
+
+    return summarize
+
+
+class ConversationHistory:
+    """
+    Keeps each conversation's prompt context within `budget_tokens`.
+
+    The context is the running summary plus as many of the newest turns as fit
+    in the budget. Once the turns not yet summarized exceed what fits, the
+    older ones are folded into the summary in the background, leaving about
+    `recent_share` of the budget of recent turns verbatim. A turn never waits
+    for a summary: until it is written, turns that no longer fit are simply
+    left out, so the prompt size is bounded either way.
+    """
+
+    def __init__(self, store, summarizer, budget_tokens=3000, recent_share=0.5):
+        self.store = store
+        self.summarizer = summarizer
+        self.budget_tokens = budget_tokens
+        self.recent_tokens = int(budget_tokens * recent_share)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="summarizer"
+        )
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.stats = {"turns": 0, "summaries": 0, "summary_failures": 0}
+
+    def context(self, conversation):
+        """
+        (summary, [(role, content), ...] oldest first) within the token budget.
+        """
+        summary, summary_tokens, through_id = self.store.summary(conversation)
+        available = self.budget_tokens - summary_tokens
+        messages = []
+        for _, role, content, tokens in self.store.turns(conversation, through_id):
+            available -= tokens
+            if available < 0:
+                break
+            messages.append((role, content))
+        messages.reverse()
+        return summary, messages
+
+    def record(self, conversation, user_message, reply):
+        """
+        Store a user message and the reply to it, then summarize in the
+        background if the conversation has outgrown its budget.
+        """
+        self.store.append(
+            conversation,
+            [
+                ("user", user_message, estimate_tokens(user_message)),
+                ("assistant", reply, estimate_tokens(reply)),
+            ],
+        )
+        self.stats["turns"] += 1
+        _, summary_tokens, through_id = self.store.summary(conversation)
+        unsummarized = sum(row[3] for row in self.store.turns(conversation, through_id))
+        if summary_tokens + unsummarized > self.budget_tokens:
+            self._schedule(conversation)
+
+    def _schedule(self, conversation):
+        with self._lock:
+            if conversation in self._pending:
+                return
+            self._pending.add(conversation)
+        self._executor.submit(self._summarize, conversation)
+
+    def _summarize(self, conversation):
+        try:
+            summary, _, through_id = self.store.summary(conversation)
+            turns = self.store.turns(conversation, through_id)
+            # Newest turns up to recent_tokens stay verbatim
+            kept, split = 0, len(turns)
+            for index, (_, _, _, tokens) in enumerate(turns):
+                kept += tokens
+                if kept > self.recent_tokens:
+                    split = index
+                    break
+            older = turns[split:][::-1]
+            if not older:
+                return
+            with stage_timer("history_summary"):
+                summary = self.summarizer(
+                    summary, [(role, content) for _, role, content, _ in older]
+                )
+            self.store.save_summary(
+                conversation, summary, estimate_tokens(summary), older[-1][0]
+            )
+            self.stats["summaries"] += 1
+        except Exception:
+            logging.exception(f"Could not summarize conversation {conversation}")
+            self.stats["summary_failures"] += 1
+            metrics.inc("errors", kind="history_summary")
+        finally:
+            with self._lock:
+                self._pending.discard(conversation)
+
+    def metrics(self):
+        stats = dict(self.stats)
+        stats["summaries_pending"] = len(self._pending)
+        return stats
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def chat_messages(instructions, summary, history, message_body):
+    """
+    Chat-completion messages: instructions and summary as the system prompt,
+    then the budgeted history and the new message.
+    """
+    system = instructions
+    if summary:
+        system = f"{system}\n\nSummary of the conversation so far:\n{summary}"
+    messages = [{"role": "system", "content": system}]
+    messages.extend({"role": role, "content": content} for role, content in history)
+    messages.append({"role": "user", "content": message_body})
+    return messages
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m app.services.conversation_history DB_PATH CONVERSATION")
+    history = ConversationHistory(HistoryStore(sys.argv[1]), summarizer=None)
+    summary, turns = history.context(sys.argv[2])
+    print(f"Summary: {summary or '(none)'}\n")
+    for role, content in turns:
+        print(f"{role}: {content}\n")
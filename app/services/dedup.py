@@ -0,0 +1,136 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MessageDeduplicator:
+    """
+    Bounded TTL/LRU set of WhatsApp message IDs that have already been handled.
+
+    Meta redelivers webhooks when we are slow to acknowledge them. The in-memory
+    set catches retries that land on the same process; with a `db_path` the IDs
+    are also recorded in a SQLite file so several worker processes share one view.
+    """
+
+    def __init__(self, ttl=3600, maxsize=10000, db_path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.db_path = db_path
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        if db_path:
+            with self._connection() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS seen_messages ("
+                    "message_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+                )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _purge_expired(self, now):
+        # Entries are kept in insertion order, which is also expiry order.
+        while self._seen:
+            message_id, expires_at = next(iter(self._seen.items()))
+            if expires_at > now:
+                break
+            del self._seen[message_id]
+
+    def _claim_shared(self, message_id, now):
+        """
+        Atomically record the ID in the shared store. Returns False if another
+        process already recorded it and it has not expired.
+        """
+        try:
+            cursor = self._connection().execute(
+                "INSERT INTO seen_messages (message_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(message_id) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE seen_messages.expires_at <= ?",
+                (message_id, now + self.ttl, now),
+            )
+        except sqlite3.Error as e:
+            # Fail open: a duplicate reply is better than a dropped message.
+            logging.error(f"Deduplication store unavailable: {e}")
+            return True
+        if self.misses % 1000 == 0:
+            self._connection().execute(
+                "DELETE FROM seen_messages WHERE expires_at <= ?", (now,)
+            )
+        return cursor.rowcount == 1
+
+    def check_and_add(self, message_id):
+        """
+        Return True if the message ID was already seen, otherwise record it and
+        return False.
+        """
+        if not message_id:
+            return False
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            if message_id in self._seen:
+                self.hits += 1
+                return True
+            self._seen[message_id] = now + self.ttl
+            while len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+
+        if self.db_path and not self._claim_shared(message_id, now):
+            with self._lock:
+                self.hits += 1
+            return True
+
+        with self._lock:
+            self.misses += 1
+        return False
+
+    def discard(self, message_id):
+        """
+        Forget a message ID claimed by check_and_add, so that a redelivery of
+        a message we failed to accept is handled after all.
+        """
+        with self._lock:
+            self._seen.pop(message_id, None)
+        if self.db_path:
+            try:
+                self._connection().execute(
+                    "DELETE FROM seen_messages WHERE message_id = ?", (message_id,)
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Deduplication store unavailable: {e}")
+
+    def metrics(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._seen),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def init_dedup(app):
+    """
+    Attach a MessageDeduplicator to the app unless DEDUP_ENABLED is false.
+    """
+    if not app.config["DEDUP_ENABLED"]:
+        return None
+    dedup = MessageDeduplicator(
+        ttl=app.config["DEDUP_TTL"],
+        maxsize=app.config["DEDUP_MAX_SIZE"],
+        db_path=app.config["DEDUP_DB_PATH"],
+    )
+    app.extensions["dedup"] = dedup
+    return dedup
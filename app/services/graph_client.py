@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.utils.metrics import metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# A timed-out read may mean the server already acted on the request, so only
+# these are retried after one; other requests only when they never got sent
+IDEMPOTENT_METHODS = {"GET", "HEAD"}
+
+
+class GraphAPIClient:
+    """
+    Long-lived client for the WhatsApp Cloud (Graph) API.
+
+    Owns a pooled keep-alive `requests.Session`, so replies reuse open TLS
+    connections to graph.facebook.com instead of handshaking on every send.
+    Headers and the messages endpoint are built once. Requests that fail with
+    429/5xx or could not connect are retried with jittered exponential
+    backoff, as are GETs whose response timed out.
+    Point `base_url` at a local stub server to exercise it offline.
+    """
+
+    def __init__(
+        self,
+        access_token,
+        phone_number_id,
+        version,
+        base_url="https://graph.facebook.com",
+        pool_size=10,
+        timeout=10,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=8.0,
+    ):
+        self.base_url = f"{base_url.rstrip('/')}/{version}"
+        self.messages_url = f"{self.base_url}/{phone_number_id}/messages"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "Content-type": "application/json",
+                "Authorization": f"Bearer {access_token}",
+            }
+        )
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            # Full jitter keeps many workers from retrying in lockstep
+            delay = random.uniform(0, self.backoff_base * (2**attempt))
+        return min(delay, self.backoff_max)
+
+    def request(self, method, url, max_retries=None, **kwargs):
+        """
+        Send a request with retries (`max_retries` overrides the client's).
+        Returns the final response, or raises the last connection error once
+        retries are exhausted.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        kwargs.setdefault("timeout", self.timeout)
+        retryable = (
+            (requests.ConnectionError, requests.Timeout)
+            if method in IDEMPOTENT_METHODS
+            else (requests.ConnectionError,)  # includes ConnectTimeout
+        )
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except retryable as e:
+                if attempt >= max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logging.warning(f"Graph API {method} failed ({e}), retrying in {delay:.2f}s")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                # Hands a streamed response's connection back to the pool
+                response.close()
+                logging.warning(
+                    f"Graph API returned {response.status_code}, retrying in {delay:.2f}s"
+                )
+            self.retries += 1
+            metrics.inc("retries", target="graph_api")
+            attempt += 1
+            time.sleep(delay)
+
+    def send_message(self, data, max_retries=None):
+        """
+        POST a JSON-encoded message payload to the phone number's messages endpoint.
+        """
+        return self.request("POST", self.messages_url, max_retries=max_retries, data=data)
+
+    def get_media(self, media_id):
+        """
+        Look up an inbound media object: its short-lived download URL, MIME type,
+        sha256 and file size.
+        """
+        return self.request("GET", f"{self.base_url}/{media_id}")
+
+    def download(self, url):
+        """
+        GET a media download URL as a streamed response; the caller reads it in
+        chunks with `iter_content` and closes it.
+        """
+        return self.request("GET", url, stream=True)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncGraphAPIClient:
+    """
+    asyncio counterpart of GraphAPIClient on a pooled aiohttp session, for the
+    ASGI app. The session is created on first use inside the running loop.
+    """
+
+    def __init__(
+        self,
+        access_token,
+        phone_number_id,
+        version,
+        base_url="https://graph.facebook.com",
+        pool_size=100,
+        timeout=10,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=8.0,
+    ):
+        self.base_url = f"{base_url.rstrip('/')}/{version}"
+        self.messages_url = f"{self.base_url}/{phone_number_id}/messages"
+        self.headers = {
+            "Content-type": "application/json",
+            "Authorization": f"Bearer {access_token}",
+        }
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def request(self, method, url, **kwargs):
+        """
+        Send a request with retries. Returns (status, body bytes), or raises the
+        last connection error once retries are exhausted.
+        """
+        import aiohttp
+
+        session = self._get_session()
+        retryable = (
+            (aiohttp.ClientError, asyncio.TimeoutError)
+            if method in IDEMPOTENT_METHODS
+            else (aiohttp.ClientConnectorError,)
+        )
+        attempt = 0
+        while True:
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After")
+            except retryable as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, self.backoff_base * (2**attempt))
+                logging.warning(f"Graph API {method} failed ({e}), retrying in {delay:.2f}s")
+            else:
+                if status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    return status, body
+                if retry_after and retry_after.isdigit():
+                    delay = float(retry_after)
+                else:
+                    delay = random.uniform(0, self.backoff_base * (2**attempt))
+                logging.warning(f"Graph API returned {status}, retrying in {delay:.2f}s")
+            self.retries += 1
+            metrics.inc("retries", target="graph_api")
+            attempt += 1
+            await asyncio.sleep(min(delay, self.backoff_max))
+
+    async def send_message(self, data):
+        return await self.request("POST", self.messages_url, data=data)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+def init_graph_client(app):
+    """
+    Attach a shared GraphAPIClient built from the app config.
+    """
+    client = GraphAPIClient(
+        access_token=app.config["ACCESS_TOKEN"],
+        phone_number_id=app.config["PHONE_NUMBER_ID"],
+        version=app.config["VERSION"],
+        base_url=app.config["GRAPH_API_BASE_URL"],
+        pool_size=app.config["GRAPH_POOL_SIZE"],
+        timeout=app.config["GRAPH_TIMEOUT"],
+        max_retries=app.config["GRAPH_MAX_RETRIES"],
+    )
+    app.extensions["graph_client"] = client
+    return client
@@ -0,0 +1,156 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from app.utils.metrics import metrics
+
+_STOP = object()
+
+
+class WebhookQueue:
+    """
+    Bounded in-process queue of parsed webhook events, drained by a pool of
+    worker threads.
+
+    The webhook view only has to call `submit`, which never blocks: when the queue
+    is full the event is rejected so the view can answer 503 and let Meta retry
+    later instead of piling up request threads.
+    """
+
+    def __init__(self, app, handler, workers=4, maxsize=1000):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+            "high_watermark": 0,
+            "wait_seconds_total": 0.0,
+        }
+
+    def _ensure_started(self):
+        # Started lazily so pre-fork servers spawn the threads in each worker
+        # process rather than in the master.
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"webhook-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, events):
+        """
+        Enqueue a webhook's events. Returns False if the queue is full or shutting down.
+        """
+        if not self._accepting:
+            return False
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((events, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._stats["rejected"] += 1
+            logging.warning("Webhook queue full, rejecting event")
+            return False
+        with self._lock:
+            self._stats["enqueued"] += 1
+            depth = self.queue.qsize()
+            if depth > self._stats["high_watermark"]:
+                self._stats["high_watermark"] = depth
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                events, enqueued_at = item
+                waited = time.monotonic() - enqueued_at
+                try:
+                    with self.app.app_context():
+                        self.handler(events)
+                except Exception:
+                    logging.exception("Failed to process queued webhook event")
+                    metrics.inc("errors", kind="handler")
+                    outcome = "failed"
+                else:
+                    outcome = "processed"
+                with self._lock:
+                    self._stats[outcome] += 1
+                    self._stats["wait_seconds_total"] += waited
+            finally:
+                self.queue.task_done()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+        done = stats["processed"] + stats["failed"]
+        stats["depth"] = self.queue.qsize()
+        stats["capacity"] = self.queue.maxsize
+        stats["workers"] = self.workers
+        stats["avg_wait_seconds"] = stats["wait_seconds_total"] / done if done else 0.0
+        return stats
+
+    def shutdown(self, timeout=30):
+        """
+        Stop accepting events and let the workers drain what is already queued.
+        """
+        self._accepting = False
+        if not self._threads:
+            return
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            # Sentinels queue up behind the remaining events.
+            try:
+                self.queue.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        remaining = self.queue.qsize()
+        if remaining:
+            logging.warning(f"Webhook queue shut down with {remaining} events left")
+        else:
+            logging.info("Webhook queue drained")
+        self._threads = []
+
+
+def init_ingestion(app):
+    """
+    Attach a WebhookQueue to the app when INGESTION_MODE is "queue", or a
+    broker-backed ClusterQueue when it is "cluster".
+    """
+    if app.config["INGESTION_MODE"] == "cluster":
+        from app.services.broker import init_cluster
+
+        cluster = init_cluster(app)
+        atexit.register(cluster.shutdown, app.config["INGESTION_DRAIN_TIMEOUT"])
+        return cluster
+    if app.config["INGESTION_MODE"] != "queue":
+        return None
+
+    from app.utils.whatsapp_utils import process_events
+
+    webhook_queue = WebhookQueue(
+        app,
+        process_events,
+        workers=app.config["INGESTION_WORKERS"],
+        maxsize=app.config["INGESTION_QUEUE_SIZE"],
+    )
+    app.extensions["webhook_queue"] = webhook_queue
+    atexit.register(webhook_queue.shutdown, app.config["INGESTION_DRAIN_TIMEOUT"])
+    return webhook_queue
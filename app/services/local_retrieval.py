@@ -0,0 +1,318 @@
+"""
+Local retrieval over knowledge files, as an alternative to hosted Assistant retrieval.
+
+Usage:
+    python -m app.services.local_retrieval build data/airbnb-faq.pdf --index knowledge_index
+    python -m app.services.local_retrieval query "What's the Wi-Fi password?" --index knowledge_index
+
+`build` is incremental: files whose sha256 is unchanged keep their chunks and
+vectors, only new or modified files are extracted and embedded again.
+"""
+
+import argparse
+import array
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from app.services.response_cache import hashed_embedding, normalize
+
+DIMS = 512
+_SENTENCE_END = re.compile(r"(?<=[.?!])\s+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def extract_text(path):
+    """
+    Plain text of a PDF, Markdown or text file, with whitespace collapsed.
+    """
+    if path.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise ImportError("Indexing PDF files requires pypdf: pip install pypdf")
+        text = " ".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    else:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def chunk_text(text, size=600, overlap=1):
+    """
+    Split text into chunks of about `size` characters on sentence boundaries,
+    repeating the last `overlap` sentences at the start of the next chunk.
+    """
+    sentences = [s for s in _SENTENCE_END.split(text) if s]
+    chunks, current = [], []
+    length = 0
+    for sentence in sentences:
+        if current and length + len(sentence) > size:
+            chunks.append(" ".join(current))
+            current = current[-overlap:] if overlap else []
+            length = sum(len(s) + 1 for s in current)
+        current.append(sentence)
+        length += len(sentence) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def dense_embedding(text, dims=DIMS):
+    vector = [0.0] * dims
+    for i, v in hashed_embedding(normalize(text), dims).items():
+        vector[i] = v
+    return vector
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class LocalIndex:
+    """
+    On-disk hybrid index: BM25 over chunk terms plus a memory-mapped float32
+    matrix of chunk embeddings.
+
+    Layout of `path`:
+        manifest.json  source files with their sha256 and chunk ranges
+        chunks.jsonl   one {"source", "text"} record per chunk
+        vectors.f32    len(chunks) x DIMS float32 rows
+
+    A running app picks up an index rebuilt by the CLI: `search` reloads it
+    when the manifest or vectors file changes, checked at most every
+    `reload_interval` seconds. An index that fails to load is logged and the
+    previous one stays in use.
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75, alpha=0.5, reload_interval=5.0):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.alpha = alpha  # weight of BM25 vs vector similarity
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mmap = None
+        self.vectors = None
+        self._signature = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self.load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _files_signature(self):
+        # build() replaces the manifest last, so a change to it (or to the
+        # vectors) means a complete new index is on disk
+        signature = []
+        for name in ("manifest.json", "vectors.f32"):
+            try:
+                stat = os.stat(self._file(name))
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def load(self):
+        signature = self._files_signature()
+        manifest, chunks, mapped, vectors = {"dims": DIMS, "sources": {}}, [], None, None
+        if os.path.exists(self._file("manifest.json")):
+            with open(self._file("manifest.json"), encoding="utf-8") as f:
+                manifest = json.load(f)
+            with open(self._file("chunks.jsonl"), encoding="utf-8") as f:
+                chunks = [json.loads(line) for line in f]
+            if chunks:
+                with open(self._file("vectors.f32"), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                vectors = memoryview(mapped).cast("f")
+                if len(vectors) != len(chunks) * manifest["dims"]:
+                    vectors.release()
+                    mapped.close()
+                    raise ValueError(f"Index {self.path} is being rebuilt")
+        terms = [Counter(normalize(c["text"]).split()) for c in chunks]
+        doc_freq = Counter()
+        for chunk_terms in terms:
+            doc_freq.update(chunk_terms.keys())
+        lengths = [sum(t.values()) for t in terms]
+        # Swap everything at once. The previous mapping is not closed here: a
+        # search may still be reading it, and it is unmapped once unreferenced.
+        with self._lock:
+            self.manifest = manifest
+            self.chunks = chunks
+            self._mmap = mapped
+            self.vectors = vectors
+            self.terms = terms
+            self.doc_freq = doc_freq
+            self.lengths = lengths
+            self.avg_length = sum(lengths) / len(lengths) if lengths else 0.0
+            self._signature = signature
+
+    def maybe_reload(self):
+        """
+        Reload the index if its files changed since it was loaded.
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        if self._files_signature() == self._signature:
+            return
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Could not reload the local index from {self.path}: {e}")
+            return
+        self.reloads += 1
+        logging.info(f"Reloaded the local index from {self.path}: {len(self.chunks)} chunks")
+
+    def build(self, files):
+        """
+        (Re)index `files`, reusing chunks and vectors of unchanged files.
+        Returns the number of files that had to be re-embedded.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        dims = self.manifest["dims"]
+        old_sources = self.manifest["sources"]
+        sources, chunks, vectors = {}, [], array.array("f")
+        rebuilt = 0
+        for path in files:
+            sha = _sha256(path)
+            start = len(chunks)
+            previous = old_sources.get(path)
+            if previous and previous["sha256"] == sha and self.vectors is not None:
+                first, last = previous["start"], previous["end"]
+                chunks.extend(self.chunks[first:last])
+                vectors.extend(self.vectors[first * dims : last * dims])
+            else:
+                rebuilt += 1
+                for text in chunk_text(extract_text(path)):
+                    chunks.append({"source": path, "text": text})
+                    vectors.extend(dense_embedding(text, dims))
+            sources[path] = {"sha256": sha, "start": start, "end": len(chunks)}
+
+        # Write next to the live files and swap them in atomically
+        with open(self._file("chunks.jsonl.tmp"), "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk) + "\n")
+        with open(self._file("vectors.f32.tmp"), "wb") as f:
+            vectors.tofile(f)
+        with open(self._file("manifest.json.tmp"), "w", encoding="utf-8") as f:
+            json.dump({"dims": dims, "sources": sources}, f)
+        # The live mapping keeps the replaced vectors file readable for
+        # searches still running against it
+        for name in ("chunks.jsonl", "vectors.f32", "manifest.json"):
+            os.replace(self._file(name + ".tmp"), self._file(name))
+        self.load()
+        return rebuilt
+
+    def _bm25(self, query_terms, terms, doc_freq, n, length, avg_length):
+        score = 0.0
+        for term in query_terms:
+            tf = terms.get(term)
+            if not tf:
+                continue
+            idf = math.log(1 + (n - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+            score += idf * tf * (self.k1 + 1) / (tf + norm)
+        return score
+
+    def search(self, query, k=4):
+        """
+        Top-k chunks for `query` as (score, chunk) pairs, best first.
+        """
+        self.maybe_reload()
+        # One consistent snapshot, even if a reload swaps the index meanwhile
+        with self._lock:
+            chunks, vectors, dims = self.chunks, self.vectors, self.manifest["dims"]
+            terms, doc_freq = self.terms, self.doc_freq
+            lengths, avg_length = self.lengths, self.avg_length
+        if not chunks:
+            return []
+        query_terms = set(normalize(query).split())
+        query_vector = hashed_embedding(normalize(query), dims)
+        n = len(chunks)
+        bm25 = [
+            self._bm25(query_terms, terms[i], doc_freq, n, lengths[i], avg_length)
+            for i in range(n)
+        ]
+        top_bm25 = max(bm25) or 1.0
+        scored = []
+        for i, chunk in enumerate(chunks):
+            row = i * dims
+            similarity = sum(v * vectors[row + j] for j, v in query_vector.items())
+            score = self.alpha * bm25[i] / top_bm25 + (1 - self.alpha) * similarity
+            scored.append((score, chunk))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored[:k]
+
+
+def knowledge_instructions(question, index, instructions, k=4):
+    """
+    System prompt with the top-k local passages for `question` appended.
+    """
+    passages = "\n\n".join(chunk["text"] for _, chunk in index.search(question, k))
+    return f"{instructions}\n\nKnowledge base excerpts:\n{passages}"
+
+
+def _context_messages(question, index, instructions, k):
+    return [
+        {"role": "system", "content": knowledge_instructions(question, index, instructions, k)},
+        {"role": "user", "content": question},
+    ]
+
+
+def answer_with_context(client, question, index, instructions, model="gpt-4o-mini", k=4):
+    """
+    Answer with one chat-completion call, grounded in the top-k local passages.
+    """
+    completion = client.chat.completions.create(
+        model=model, messages=_context_messages(question, index, instructions, k)
+    )
+    return completion.choices[0].message.content
+
+
+async def async_answer_with_context(
+    client, question, index, instructions, model="gpt-4o-mini", k=4
+):
+    """
+    `answer_with_context` for an `AsyncOpenAI` client. The search runs in a
+    worker thread, off the event loop.
+    """
+    messages = await asyncio.to_thread(_context_messages, question, index, instructions, k)
+    completion = await client.chat.completions.create(model=model, messages=messages)
+    return completion.choices[0].message.content
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the local knowledge index")
+    parser.add_argument("command", choices=["build", "query"])
+    parser.add_argument("args", nargs="+", help="files to index, or the query text")
+    parser.add_argument("--index", default="knowledge_index")
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    index = LocalIndex(args.index)
+    if args.command == "build":
+        rebuilt = index.build(args.args)
+        print(f"Indexed {len(index.chunks)} chunks, re-embedded {rebuilt} file(s)")
+    else:
+        for score, chunk in index.search(" ".join(args.args), args.k):
+            print(f"{score:.3f}  {chunk['text'][:120]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+import atexit
+import base64
+import binascii
+import concurrent.futures
+import hashlib
+import importlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+import uuid
+
+from app.utils.metrics import metrics, stage_timer
+
+CHUNK_SIZE = 64 * 1024
+# Longest extracted text handed to the assistant for one message
+MAX_EXTRACTED_CHARS = 4000
+
+DEFAULT_PROCESSORS = {
+    "audio": "app.services.media:transcribe_audio",
+    "document": "app.services.media:extract_document_text",
+}
+
+# Set in each worker process by _init_worker
+_worker_options = {}
+_whisper_model = None
+
+# Pipelines whose pools were started with start(), restarted in forked
+# children; and whether this process is forking its own pool workers, which
+# inherit True and never start pools themselves
+_started_pipelines = []
+_launching_workers = False
+
+
+def _init_worker(options):
+    _worker_options.update(options)
+
+
+def _restart_after_fork():
+    # Runs in the child of a pre-fork server right after the fork, while it
+    # still has a single thread
+    if _launching_workers:
+        return
+    for pipeline in _started_pipelines:
+        pipeline._after_fork()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def transcribe_audio(path, mime_type):
+    """
+    Local speech-to-text for audio and voice notes with faster-whisper. The
+    model is loaded once per worker process.
+    """
+    global _whisper_model
+    if _whisper_model is None:
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise ImportError(
+                "Transcribing audio requires faster-whisper: pip install faster-whisper"
+            )
+        _whisper_model = WhisperModel(
+            _worker_options.get("whisper_model", "base"), device="cpu", compute_type="int8"
+        )
+    segments, _ = _whisper_model.transcribe(path)
+    return " ".join(segment.text.strip() for segment in segments)
+
+
+def extract_document_text(path, mime_type):
+    """
+    Text of a PDF or plain-text document; other formats yield nothing.
+    """
+    from app.services.local_retrieval import extract_text
+
+    if mime_type == "application/pdf" or mime_type.startswith("text/"):
+        return extract_text(path)
+    return ""
+
+
+def load_processors(spec=""):
+    """
+    Parse "audio=package.module:function,document=..." into message type ->
+    processor. Processors run in worker processes, so they must be importable
+    module-level functions taking (path, mime_type) and returning text.
+    """
+    paths = dict(DEFAULT_PROCESSORS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        message_type, _, path = item.partition("=")
+        paths[message_type.strip()] = path.strip()
+    processors = {}
+    for message_type, path in paths.items():
+        if not path:
+            # "audio=" turns a default processor off
+            continue
+        module, _, function = path.partition(":")
+        processors[message_type] = getattr(importlib.import_module(module), function)
+    return processors
+
+
+def _normalize_sha256(value):
+    """
+    Hex digest from the sha256 Meta sends (hex from the media endpoint, base64
+    in some webhook payloads), or None if it is neither.
+    """
+    if not value:
+        return None
+    if len(value) == 64:
+        try:
+            bytes.fromhex(value)
+            return value.lower()
+        except ValueError:
+            pass
+    try:
+        digest = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return digest.hex() if len(digest) == 32 else None
+
+
+def _extension(mime_type):
+    return mimetypes.guess_extension(mime_type.split(";")[0].strip()) or ""
+
+
+def describe(message_type, media, extracted):
+    """
+    The text the assistant sees for a media message, or None if there is
+    nothing to answer.
+    """
+    caption = (media.get("caption") or "").strip()
+    extracted = (extracted or "").strip()[:MAX_EXTRACTED_CHARS]
+    if message_type == "audio":
+        return extracted or None
+    if message_type == "document" and extracted:
+        name = media.get("filename") or "document"
+        return "\n\n".join(filter(None, (caption, f"[Document: {name}]\n{extracted}")))
+    return caption or None
+
+
+class MediaPipeline:
+    """
+    Turns inbound image/audio/document messages into text for the assistant.
+
+    Media is only fetched when a processor exists for its type. The download
+    URL is resolved through the Graph API and the file is streamed to disk in
+    CHUNK_SIZE pieces, hashed on the way, and stored under its sha256, so media
+    that is delivered again, forwarded or re-sent is neither downloaded nor
+    processed twice. Processors run in a process pool of `workers` so CPU-bound
+    transcription or extraction never holds the GIL of the webhook workers.
+
+    The pool forks its workers, so `start` it before the process starts any
+    other thread: a child forked from a multithreaded process can inherit
+    locks held by threads that do not exist in it. The apps start it at
+    startup, and each worker of a pre-fork server starts its own right after
+    the fork rather than inheriting executors whose threads stayed in the
+    master. A pipeline that was never started creates its pools on first use,
+    and a process pool broken by a crashed worker is replaced.
+
+    At most `max_pending` media messages are in flight; `submit` refuses more
+    instead of queueing without bound. The cache is kept under
+    `cache_max_bytes` by deleting the least recently used files.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        processors=None,
+        workers=2,
+        max_pending=16,
+        max_bytes=25 * 1024 * 1024,
+        cache_max_bytes=1024**3,
+        process_timeout=300,
+        worker_options=None,
+    ):
+        self.processors = processors if processors is not None else load_processors()
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.cache_max_bytes = cache_max_bytes
+        self.process_timeout = process_timeout
+        self.worker_options = worker_options or {}
+        self.dirs = {}
+        for name in ("blobs", "ids", "text", "tmp"):
+            self.dirs[name] = os.path.join(cache_dir, name)
+            os.makedirs(self.dirs[name], exist_ok=True)
+        self._lock = threading.Lock()
+        # Striped locks so two deliveries of one media ID download and process it once
+        self._key_locks = [threading.Lock() for _ in range(64)]
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.workers = workers
+        self._threads = None
+        self._pool = None
+        self._pid = None
+        self._unavailable = set()
+        self._cache_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(self.dirs["blobs"])
+        )
+        self.stats = {
+            "downloads": 0,
+            "download_bytes": 0,
+            "cache_hits": 0,
+            "text_cache_hits": 0,
+            "processed": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+
+    def start(self):
+        """
+        Create this process's executors and fork the pool's workers now.
+        """
+        self._executors()
+        if self not in _started_pipelines:
+            _started_pipelines.append(self)
+
+    def _after_fork(self):
+        # Locks held by other threads of the parent stay locked in the child
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(64)]
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self.start()
+
+    def _executors(self):
+        """
+        (thread pool, process pool) of this process, created on first use.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._threads = concurrent.futures.ThreadPoolExecutor(
+                        self.max_pending, thread_name_prefix="media"
+                    )
+                    self._pool = self._new_pool()
+                    self._pid = pid
+        return self._threads, self._pool
+
+    def _new_pool(self):
+        # fork, not spawn: spawned workers would re-run run.py's create_app()
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.worker_options,),
+        )
+        # A fork-context pool forks all of its workers on the first submit
+        global _launching_workers
+        _launching_workers = True
+        try:
+            pool.submit(int).result()
+        finally:
+            _launching_workers = False
+        return pool
+
+    def _run_processor(self, processor, path, mime_type):
+        _, pool = self._executors()
+        try:
+            return pool.submit(processor, path, mime_type).result(timeout=self.process_timeout)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (OOM, segfault); replace the pool and try once more
+            with self._lock:
+                if self._pool is pool:
+                    logging.warning("Media process pool broken, starting a new one")
+                    self._pool = self._new_pool()
+                    pool.shutdown(wait=False)
+                pool = self._pool
+            return pool.submit(processor, path, mime_type).result(timeout=self.process_timeout)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _blob_path(self, sha256, extension):
+        return os.path.join(self.dirs["blobs"], sha256 + extension)
+
+    def _id_path(self, media_id):
+        return os.path.join(self.dirs["ids"], hashlib.sha256(media_id.encode()).hexdigest())
+
+    def _cached_path(self, media, extension):
+        sha256 = _normalize_sha256(media.get("sha256"))
+        if sha256 is None:
+            try:
+                with open(self._id_path(media["id"]), encoding="ascii") as f:
+                    sha256 = f.read().strip()
+            except OSError:
+                return None
+        path = self._blob_path(sha256, extension)
+        if not os.path.exists(path):
+            return None
+        # Mark as recently used for pruning
+        os.utime(path)
+        return path
+
+    def _key_lock(self, media):
+        return self._key_locks[hash(media["id"]) % len(self._key_locks)]
+
+    def fetch(self, media, client):
+        """
+        Local path of a media object, downloading it on a cache miss.
+        """
+        with self._key_lock(media):
+            return self._fetch(media, client)
+
+    def _fetch(self, media, client):
+        extension = _extension(media.get("mime_type", ""))
+        path = self._cached_path(media, extension)
+        if path is not None:
+            self._count("cache_hits")
+            return path
+        with stage_timer("media_download"):
+            return self._download(media["id"], extension, client)
+
+    def _download(self, media_id, extension, client):
+        response = client.get_media(media_id)
+        response.raise_for_status()
+        info = response.json()
+        expected = _normalize_sha256(info.get("sha256"))
+        if expected and os.path.exists(self._blob_path(expected, extension)):
+            self._record_id(media_id, expected)
+            self._count("cache_hits")
+            return self._blob_path(expected, extension)
+        if int(info.get("file_size") or 0) > self.max_bytes:
+            raise ValueError(f"Media {media_id} is {info['file_size']} bytes")
+
+        tmp_path = os.path.join(self.dirs["tmp"], uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        response = client.download(info["url"])
+        try:
+            response.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"Media {media_id} is over {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            if expected and sha256 != expected:
+                raise ValueError(f"Media {media_id} failed its sha256 check")
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            response.close()
+
+        path = self._blob_path(sha256, extension)
+        os.replace(tmp_path, path)
+        self._record_id(media_id, sha256)
+        with self._lock:
+            self.stats["downloads"] += 1
+            self.stats["download_bytes"] += size
+            self._cache_bytes += size
+            over = self._cache_bytes > self.cache_max_bytes
+        if over:
+            self._prune()
+        return path
+
+    def _record_id(self, media_id, sha256):
+        with open(self._id_path(media_id), "w", encoding="ascii") as f:
+            f.write(sha256)
+
+    def _prune(self):
+        """
+        Delete the least recently used files until the cache is at 90% of its limit.
+        """
+        with self._lock:
+            entries = sorted(os.scandir(self.dirs["blobs"]), key=lambda e: e.stat().st_mtime)
+            target = self.cache_max_bytes * 0.9
+            for entry in entries:
+                if self._cache_bytes <= target:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                self._cache_bytes -= size
+                sha256 = os.path.splitext(entry.name)[0]
+                text_path = os.path.join(self.dirs["text"], f"{sha256}.txt")
+                if os.path.exists(text_path):
+                    os.remove(text_path)
+
+    def _extract(self, processor, path, mime_type):
+        sha256 = os.path.splitext(os.path.basename(path))[0]
+        text_path = os.path.join(self.dirs["text"], f"{sha256}.txt")
+        try:
+            with open(text_path, encoding="utf-8") as f:
+                text = f.read()
+            self._count("text_cache_hits")
+            return text
+        except OSError:
+            pass
+        with stage_timer("media_processing"):
+            text = self._run_processor(processor, path, mime_type)
+        tmp_path = os.path.join(self.dirs["tmp"], uuid.uuid4().hex)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, text_path)
+        self._count("processed")
+        return text
+
+    def process(self, message_type, media, client):
+        """
+        Text for a media message (see `describe`), or None. Failures are
+        logged and leave only the caption.
+        """
+        processor = self.processors.get(message_type)
+        extracted = None
+        if processor is not None and message_type not in self._unavailable:
+            mime_type = media.get("mime_type", "").split(";")[0].strip()
+            try:
+                with self._key_lock(media):
+                    extracted = self._extract(processor, self._fetch(media, client), mime_type)
+            except ImportError as e:
+                # A processor missing its dependency will not start working
+                logging.error(f"Disabling {message_type} processing: {e}")
+                self._unavailable.add(message_type)
+            except Exception as e:
+                logging.error(f"Could not process {message_type} {media.get('id')}: {e}")
+                self._count("failed")
+                metrics.inc("errors", kind="media")
+        return describe(message_type, media, extracted)
+
+    def submit(self, message_type, media, client, callback):
+        """
+        Process a media message in the background and call `callback(text)`
+        with the result. Returns False, without calling it, when `max_pending`
+        messages are already in flight.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            return False
+
+        def run():
+            text = None
+            try:
+                text = self.process(message_type, media, client)
+            finally:
+                try:
+                    callback(text)
+                except Exception:
+                    logging.exception(f"Failed to handle {message_type} {media.get('id')}")
+                finally:
+                    self._slots.release()
+
+        threads, _ = self._executors()
+        threads.submit(run)
+        return True
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["cache_bytes"] = self._cache_bytes
+        stats["in_flight"] = self.max_pending - self._slots._value
+        return stats
+
+    def shutdown(self):
+        # Only this process's executors; a parent's were never started here
+        if self._pid != os.getpid():
+            return
+        self._threads.shutdown(wait=True)
+        self._pool.shutdown()
+
+
+def build_pipeline(config):
+    """
+    MediaPipeline from the app config, or None when MEDIA_CACHE_DIR is unset.
+    """
+    if not config["MEDIA_CACHE_DIR"]:
+        return None
+    return MediaPipeline(
+        config["MEDIA_CACHE_DIR"],
+        processors=load_processors(config["MEDIA_PROCESSORS"]),
+        workers=config["MEDIA_WORKERS"],
+        max_pending=config["MEDIA_MAX_PENDING"],
+        max_bytes=config["MEDIA_MAX_BYTES"],
+        cache_max_bytes=config["MEDIA_CACHE_MAX_BYTES"],
+        worker_options={"whisper_model": config["MEDIA_WHISPER_MODEL"]},
+    )
+
+
+def init_media(app):
+    """
+    Attach a MediaPipeline when MEDIA_CACHE_DIR is set.
+    """
+    pipeline = build_pipeline(app.config)
+    if pipeline is not None:
+        # Before init_outbox, init_ingestion or the server start any thread
+        pipeline.start()
+        app.extensions["media"] = pipeline
+        atexit.register(pipeline.shutdown)
+    return pipeline
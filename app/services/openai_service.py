@@ -1,19 +1,115 @@
-from openai import OpenAI
-import shelve
-from dotenv import load_dotenv
+import asyncio
 import os
-import time
 import logging
+import threading
+import time
+
+from app.services.run_completion import (
+    RunFailed,
+    async_complete_run,
+    async_stream_run_text,
+    complete_run,
+    stream_run_text,
+)
+from app.services.thread_store import create_thread_store
+from app.services.response_cache import ResponseCache
+from app.services.local_retrieval import (
+    LocalIndex,
+    answer_with_context,
+    async_answer_with_context,
+    knowledge_instructions,
+)
+from app.services.conversation_history import (
+    ConversationHistory,
+    HistoryStore,
+    chat_messages,
+    chat_summarizer,
+)
+from app.config import get_settings
+from app.utils.metrics import metrics, stage_timer
+
+# Read and validated with the rest of the configuration, once per process
+settings = get_settings()
+OPENAI_API_KEY = settings["OPENAI_API_KEY"]
+OPENAI_ASSISTANT_ID = settings["OPENAI_ASSISTANT_ID"]
+RUN_COMPLETION_MODE = settings["RUN_COMPLETION_MODE"]
+RUN_DEADLINE = settings["RUN_DEADLINE"]
+THREAD_STORE_URL = settings["THREAD_STORE_URL"]
+ASSISTANT_CACHE_TTL = settings["ASSISTANT_CACHE_TTL"]
+RESPONSE_CACHE_ENABLED = settings["RESPONSE_CACHE_ENABLED"]
+RESPONSE_CACHE_TTL = settings["RESPONSE_CACHE_TTL"]
+RESPONSE_CACHE_SIZE = settings["RESPONSE_CACHE_SIZE"]
+RESPONSE_CACHE_SIMILARITY = settings["RESPONSE_CACHE_SIMILARITY"]
+RESPONSE_CACHE_MIN_LENGTH = settings["RESPONSE_CACHE_MIN_LENGTH"]
+RESPONSE_CACHE_SCAN_LIMIT = settings["RESPONSE_CACHE_SCAN_LIMIT"]
+KNOWLEDGE_FILES = settings["KNOWLEDGE_FILES"]
+LOCAL_RETRIEVAL_INDEX = settings["LOCAL_RETRIEVAL_INDEX"]
+LOCAL_RETRIEVAL_MODEL = settings["LOCAL_RETRIEVAL_MODEL"]
+LOCAL_RETRIEVAL_RELOAD_INTERVAL = settings["LOCAL_RETRIEVAL_RELOAD_INTERVAL"]
+CONVERSATION_BACKEND = settings["CONVERSATION_BACKEND"]
+CHAT_MODEL = settings["CHAT_MODEL"]
+HISTORY_DB_PATH = settings["HISTORY_DB_PATH"]
+HISTORY_TOKEN_BUDGET = settings["HISTORY_TOKEN_BUDGET"]
+HISTORY_SUMMARY_MODEL = settings["HISTORY_SUMMARY_MODEL"]
+
+
+class _ProcessClient:
+    """
+    An OpenAI client built on first use in each process. The openai package is
+    only imported then, and a client inherited from a pre-fork parent (and
+    its connection pool) is replaced rather than shared.
+    """
+
+    def __init__(self, class_name):
+        self.class_name = class_name
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    import openai
+
+                    self._client = getattr(openai, self.class_name)(api_key=OPENAI_API_KEY)
+                    self._pid = pid
+        return self._client
+
+
+_client = _ProcessClient("OpenAI")
+_async_client = _ProcessClient("AsyncOpenAI")
+
+
+def get_client():
+    return _client.get()
+
 
-load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
-client = OpenAI(api_key=OPENAI_API_KEY)
+def get_async_client():
+    return _async_client.get()
+
+
+def preload():
+    """
+    Import the openai package and the API resources used here, without keeping
+    a client. Called at app startup so the first message does not pay for the
+    imports and pre-fork servers share them between workers.
+    """
+    import openai
+
+    for client in (openai.OpenAI(api_key="preload"), openai.AsyncOpenAI(api_key="preload")):
+        # Resources are imported on first attribute access
+        client.beta.assistants, client.beta.threads.messages, client.beta.threads.runs
+        client.chat.completions, client.files
+
+
+ASSISTANT_INSTRUCTIONS = "You're a helpful WhatsApp assistant that can assist guests that are staying in our Paris AirBnb. Use your knowledge base to best respond to customer queries. If you don't know the answer, say simply that you cannot help with question and advice to contact the host directly. Be friendly and funny."
 
 
 def upload_file(path):
     # Upload a file with an "assistants" purpose
-    file = client.files.create(
+    file = get_client().files.create(
         file=open("../../data/airbnb-faq.pdf", "rb"), purpose="assistants"
     )
 
@@ -22,9 +118,9 @@ def create_assistant(file):
     """
     You currently cannot set the temperature for Assistant via the API.
     """
-    assistant = client.beta.assistants.create(
+    assistant = get_client().beta.assistants.create(
         name="WhatsApp AirBnb Assistant",
-        instructions="You're a helpful WhatsApp assistant that can assist guests that are staying in our Paris AirBnb. Use your knowledge base to best respond to customer queries. If you don't know the answer, say simply that you cannot help with question and advice to contact the host directly. Be friendly and funny.",
+        instructions=ASSISTANT_INSTRUCTIONS,
         tools=[{"type": "retrieval"}],
         model="gpt-4-1106-preview",
         file_ids=[file.id],
@@ -32,66 +128,503 @@ def create_assistant(file):
     return assistant
 
 
-# Use context manager to ensure the shelf file is closed properly
+class MetadataCache:
+    """
+    Small TTL cache for OpenAI objects that rarely change, such as Assistants.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = loader()
+        with self._lock:
+            self._entries[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def metrics(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+metadata_cache = MetadataCache(ttl=ASSISTANT_CACHE_TTL)
+
+# Round trips the hot path no longer makes: assistants.retrieve calls that
+# would only have returned an ID we already had (every run) or metadata we
+# had cached, and threads.retrieve calls for threads we already know.
+api_call_stats = {"requests": 0, "assistants_retrieve_saved": 0, "threads_retrieve_saved": 0}
+_api_call_stats_lock = threading.Lock()
+
+
+def _count_saved_call(kind):
+    with _api_call_stats_lock:
+        api_call_stats[f"{kind}_retrieve_saved"] += 1
+
+
+def _count_request():
+    with _api_call_stats_lock:
+        api_call_stats["requests"] += 1
+
+
+def get_assistant(assistant_id=None):
+    """
+    Assistant metadata (name, model, instructions), cached for
+    ASSISTANT_CACHE_TTL under its ID. Call
+    `metadata_cache.invalidate(assistant_id)` after updating the assistant.
+    """
+    assistant_id = assistant_id or OPENAI_ASSISTANT_ID
+    retrieved = []
+
+    def retrieve():
+        retrieved.append(assistant_id)
+        return get_client().beta.assistants.retrieve(assistant_id)
+
+    assistant = metadata_cache.get_or_load(assistant_id, retrieve)
+    if not retrieved:
+        _count_saved_call("assistants")
+    return assistant
+
+
+def assistant_instructions(tenant=None):
+    """
+    Instructions of the tenant's assistant, for the answers generated without
+    an assistant run (chat backend and local index). Falls back to
+    ASSISTANT_INSTRUCTIONS without an assistant or when it cannot be retrieved.
+    """
+    import openai
+
+    assistant_id = _assistant_id(tenant)
+    if not assistant_id:
+        return ASSISTANT_INSTRUCTIONS
+    try:
+        instructions = get_assistant(assistant_id).instructions
+    except openai.OpenAIError as e:
+        logging.error(f"Could not retrieve assistant {assistant_id}: {e}")
+        return ASSISTANT_INSTRUCTIONS
+    return instructions or ASSISTANT_INSTRUCTIONS
+
+
+response_cache = (
+    ResponseCache(
+        ttl=RESPONSE_CACHE_TTL,
+        maxsize=RESPONSE_CACHE_SIZE,
+        similarity=RESPONSE_CACHE_SIMILARITY,
+        knowledge_files=KNOWLEDGE_FILES,
+        min_length=RESPONSE_CACHE_MIN_LENGTH,
+        scan_limit=RESPONSE_CACHE_SCAN_LIMIT,
+    )
+    if RESPONSE_CACHE_ENABLED
+    else None
+)
+
+local_index = (
+    LocalIndex(LOCAL_RETRIEVAL_INDEX, reload_interval=LOCAL_RETRIEVAL_RELOAD_INTERVAL)
+    if LOCAL_RETRIEVAL_INDEX
+    else None
+)
+
+_thread_store = None
+
+
+def get_thread_store():
+    # Opened on first use so each worker process gets its own connections
+    global _thread_store
+    if _thread_store is None:
+        _thread_store = create_thread_store(THREAD_STORE_URL)
+    return _thread_store
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    """
+    The ConversationHistory when HISTORY_DB_PATH is set, opened on first use
+    like the thread store.
+    """
+    global _history
+    if _history is None and HISTORY_DB_PATH:
+        with _history_lock:
+            if _history is None:
+                _history = ConversationHistory(
+                    HistoryStore(HISTORY_DB_PATH),
+                    # The summary gets about a quarter of the budget
+                    chat_summarizer(
+                        get_client(), HISTORY_SUMMARY_MODEL, words=HISTORY_TOKEN_BUDGET // 5
+                    ),
+                    budget_tokens=HISTORY_TOKEN_BUDGET,
+                )
+    return _history
+
+
 def check_if_thread_exists(wa_id):
-    with shelve.open("threads_db") as threads_shelf:
-        return threads_shelf.get(wa_id, None)
+    return get_thread_store().get(wa_id)
 
 
 def store_thread(wa_id, thread_id):
-    with shelve.open("threads_db", writeback=True) as threads_shelf:
-        threads_shelf[wa_id] = thread_id
+    get_thread_store().set(wa_id, thread_id)
 
 
-def run_assistant(thread, name):
-    # Retrieve the Assistant
-    assistant = client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
+def _thread_key(wa_id, tenant):
+    return tenant.thread_key(wa_id) if tenant is not None else wa_id
 
-    # Run the assistant
-    run = client.beta.threads.runs.create(
-        thread_id=thread.id,
-        assistant_id=assistant.id,
-        # instructions=f"You are having a conversation with {name}",
-    )
 
-    # Wait for completion
-    # https://platform.openai.com/docs/assistants/how-it-works/runs-and-run-steps#:~:text=under%20failed_at.-,Polling%20for%20updates,-In%20order%20to
-    while run.status != "completed":
-        # Be nice to the API
-        time.sleep(0.5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+def _assistant_id(tenant):
+    if tenant is not None and tenant.assistant_id:
+        return tenant.assistant_id
+    return OPENAI_ASSISTANT_ID
 
-    # Retrieve the Messages
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
-    new_message = messages.data[0].content[0].text.value
-    logging.info(f"Generated message: {new_message}")
-    return new_message
+
+def _uses_shared_answers(tenant):
+    # The response cache and local index are built from this deployment's
+    # KNOWLEDGE_FILES, so only the default tenant answers from them
+    return tenant is None or tenant.is_default
 
 
-def generate_response(message_body, wa_id, name):
+def get_or_create_thread(wa_id, name, tenant=None):
+    return _thread_for(wa_id, name, tenant)[0]
+
+
+def _thread_for(wa_id, name, tenant):
+    """
+    (thread_id, created) for the sender's thread. A reply in a thread created
+    for this message depends on nothing but the question.
+    """
     # Check if there is already a thread_id for the wa_id
-    thread_id = check_if_thread_exists(wa_id)
+    key = _thread_key(wa_id, tenant)
+    with stage_timer("thread_lookup"):
+        thread_id = check_if_thread_exists(key)
 
     # If a thread doesn't exist, create one and store it
     if thread_id is None:
         logging.info(f"Creating new thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.create()
-        store_thread(wa_id, thread.id)
-        thread_id = thread.id
+        thread = get_client().beta.threads.create()
+        store_thread(key, thread.id)
+        return thread.id, True
+
+    # Otherwise, reuse the existing thread; its ID is all we need
+    logging.info(f"Using existing thread for {name} with wa_id {wa_id}")
+    _count_saved_call("threads")
+    return thread_id, False
+
+
+def run_assistant(thread_id, name, assistant_id=None):
+    # The run only needs the assistant ID, so there is no need to retrieve it
+    _count_saved_call("assistants")
+    try:
+        with stage_timer("assistant_run"):
+            new_message = complete_run(
+                get_client(),
+                thread_id,
+                assistant_id or OPENAI_ASSISTANT_ID,
+                mode=RUN_COMPLETION_MODE,
+                deadline=RUN_DEADLINE,
+            )
+    except RunFailed as e:
+        metrics.inc("errors", kind=f"run_{e.status}")
+        raise
+    logging.info(f"Generated message: {new_message}")
+    return new_message
+
+
+def _remember(key, message_body, reply):
+    history = get_history()
+    if history is not None:
+        history.record(key, message_body, reply)
+
+
+async def _async_remember(key, message_body, reply):
+    # Recording writes to SQLite and may start a summary
+    if HISTORY_DB_PATH:
+        await asyncio.to_thread(_remember, key, message_body, reply)
+
+
+def _chat_request(message_body, key, shared, tenant=None):
+    """
+    Chat-completion arguments for the chat backend: the assistant's
+    instructions, local knowledge for the default tenant, and the budgeted
+    history. Returns (arguments, contextual), `contextual` being whether any
+    history went into them.
+    """
+    with stage_timer("history_lookup"):
+        summary, turns = get_history().context(key)
+    instructions = assistant_instructions(tenant)
+    if shared and local_index is not None:
+        with stage_timer("local_retrieval"):
+            instructions = knowledge_instructions(message_body, local_index, instructions)
+    request = {
+        "model": CHAT_MODEL,
+        "messages": chat_messages(instructions, summary, turns, message_body),
+    }
+    return request, bool(summary or turns)
+
+
+def generate_response(message_body, wa_id, name, tenant=None):
+    _count_request()
+    shared = _uses_shared_answers(tenant)
+    cache = response_cache if shared else None
+    key = _thread_key(wa_id, tenant)
+
+    # Repeat questions are answered without touching the API. Cache hits are
+    # not added to the user's thread.
+    if cache is not None:
+        cached = cache.get(message_body)
+        if cached is not None:
+            logging.info(f"Answering {name} with wa_id {wa_id} from cache")
+            _remember(key, message_body, cached)
+            return cached
+
+    if CONVERSATION_BACKEND == "chat":
+        request, contextual = _chat_request(message_body, key, shared, tenant)
+        with stage_timer("chat_completion"):
+            completion = get_client().chat.completions.create(**request)
+        new_message = completion.choices[0].message.content
+        logging.info(f"Generated message: {new_message}")
+
+    elif shared and local_index is not None:
+        contextual = False
+        with stage_timer("local_retrieval"):
+            new_message = answer_with_context(
+                get_client(),
+                message_body,
+                local_index,
+                assistant_instructions(tenant),
+                model=LOCAL_RETRIEVAL_MODEL,
+            )
+        logging.info(f"Generated message from local index: {new_message}")
 
-    # Otherwise, retrieve the existing thread
     else:
-        logging.info(f"Retrieving existing thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.retrieve(thread_id)
-
-    # Add message to thread
-    message = client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=message_body,
-    )
+        thread_id, created = _thread_for(wa_id, name, tenant)
+        contextual = not created
+
+        # Add message to thread
+        message = get_client().beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=message_body,
+        )
 
-    # Run the assistant and get the new message
-    new_message = run_assistant(thread, name)
+        # Run the assistant and get the new message
+        new_message = run_assistant(thread_id, name, _assistant_id(tenant))
+
+    # Answers that depended on the conversation must not reach other users
+    if cache is not None and not contextual:
+        cache.put(message_body, new_message)
+    _remember(key, message_body, new_message)
 
     return new_message
+
+
+def generate_response_stream(message_body, wa_id, name, tenant=None):
+    """
+    `generate_response`, but yields the reply in pieces while the assistant run
+    or chat completion streams it. Cached and local-index answers come as a
+    single piece.
+    """
+    shared = _uses_shared_answers(tenant)
+    cache = response_cache if shared else None
+    chat = CONVERSATION_BACKEND == "chat"
+    if not chat and ((shared and local_index is not None) or RUN_COMPLETION_MODE != "stream"):
+        yield generate_response(message_body, wa_id, name, tenant)
+        return
+
+    _count_request()
+    key = _thread_key(wa_id, tenant)
+    if cache is not None:
+        cached = cache.get(message_body)
+        if cached is not None:
+            logging.info(f"Answering {name} with wa_id {wa_id} from cache")
+            _remember(key, message_body, cached)
+            yield cached
+            return
+
+    parts = []
+    if chat:
+        request, contextual = _chat_request(message_body, key, shared, tenant)
+        for chunk in get_client().chat.completions.create(**request, stream=True):
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+                yield text
+    else:
+        thread_id, created = _thread_for(wa_id, name, tenant)
+        contextual = not created
+        get_client().beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=message_body,
+        )
+        _count_saved_call("assistants")
+        try:
+            for text in stream_run_text(
+                get_client(), thread_id, _assistant_id(tenant), RUN_DEADLINE
+            ):
+                parts.append(text)
+                yield text
+        except RunFailed as e:
+            metrics.inc("errors", kind=f"run_{e.status}")
+            raise
+    new_message = "".join(parts)
+    logging.info(f"Generated message: {new_message}")
+
+    # Answers that depended on the conversation must not reach other users
+    if cache is not None and not contextual:
+        cache.put(message_body, new_message)
+    _remember(key, message_body, new_message)
+
+
+async def async_get_or_create_thread(wa_id, name, tenant=None):
+    return (await _async_thread_for(wa_id, name, tenant))[0]
+
+
+async def _async_thread_for(wa_id, name, tenant):
+    # The thread store is blocking (SQLite or Redis), so it runs in a thread
+    key = _thread_key(wa_id, tenant)
+    with stage_timer("thread_lookup"):
+        thread_id = await asyncio.to_thread(check_if_thread_exists, key)
+    if thread_id is None:
+        logging.info(f"Creating new thread for {name} with wa_id {wa_id}")
+        thread = await get_async_client().beta.threads.create()
+        await asyncio.to_thread(store_thread, key, thread.id)
+        return thread.id, True
+    _count_saved_call("threads")
+    return thread_id, False
+
+
+async def async_generate_response(message_body, wa_id, name, tenant=None):
+    """
+    `generate_response` on the AsyncOpenAI client, for the ASGI app.
+    """
+    _count_request()
+    shared = _uses_shared_answers(tenant)
+    cache = response_cache if shared else None
+    key = _thread_key(wa_id, tenant)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, message_body)
+        if cached is not None:
+            logging.info(f"Answering {name} with wa_id {wa_id} from cache")
+            await _async_remember(key, message_body, cached)
+            return cached
+
+    if CONVERSATION_BACKEND == "chat":
+        request, contextual = await asyncio.to_thread(
+            _chat_request, message_body, key, shared, tenant
+        )
+        with stage_timer("chat_completion"):
+            completion = await get_async_client().chat.completions.create(**request)
+        new_message = completion.choices[0].message.content
+    elif shared and local_index is not None:
+        contextual = False
+        instructions = await asyncio.to_thread(assistant_instructions, tenant)
+        with stage_timer("local_retrieval"):
+            new_message = await async_answer_with_context(
+                get_async_client(),
+                message_body,
+                local_index,
+                instructions,
+                model=LOCAL_RETRIEVAL_MODEL,
+            )
+    else:
+        thread_id, created = await _async_thread_for(wa_id, name, tenant)
+        contextual = not created
+        await get_async_client().beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=message_body,
+        )
+        _count_saved_call("assistants")
+        try:
+            with stage_timer("assistant_run"):
+                new_message = await async_complete_run(
+                    get_async_client(),
+                    thread_id,
+                    _assistant_id(tenant),
+                    mode=RUN_COMPLETION_MODE,
+                    deadline=RUN_DEADLINE,
+                )
+        except RunFailed as e:
+            metrics.inc("errors", kind=f"run_{e.status}")
+            raise
+    logging.info(f"Generated message: {new_message}")
+
+    if cache is not None and not contextual:
+        await asyncio.to_thread(cache.put, message_body, new_message)
+    await _async_remember(key, message_body, new_message)
+
+    return new_message
+
+
+async def async_generate_response_stream(message_body, wa_id, name, tenant=None):
+    """
+    Async counterpart of `generate_response_stream`, for the ASGI app.
+    """
+    shared = _uses_shared_answers(tenant)
+    cache = response_cache if shared else None
+    chat = CONVERSATION_BACKEND == "chat"
+    if not chat and ((shared and local_index is not None) or RUN_COMPLETION_MODE != "stream"):
+        yield await async_generate_response(message_body, wa_id, name, tenant)
+        return
+
+    _count_request()
+    key = _thread_key(wa_id, tenant)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, message_body)
+        if cached is not None:
+            logging.info(f"Answering {name} with wa_id {wa_id} from cache")
+            await _async_remember(key, message_body, cached)
+            yield cached
+            return
+
+    parts = []
+    if chat:
+        request, contextual = await asyncio.to_thread(
+            _chat_request, message_body, key, shared, tenant
+        )
+        async for chunk in await get_async_client().chat.completions.create(**request, stream=True):
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+                yield text
+    else:
+        thread_id, created = await _async_thread_for(wa_id, name, tenant)
+        contextual = not created
+        await get_async_client().beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=message_body,
+        )
+        _count_saved_call("assistants")
+        try:
+            async for text in async_stream_run_text(
+                get_async_client(), thread_id, _assistant_id(tenant), RUN_DEADLINE
+            ):
+                parts.append(text)
+                yield text
+        except RunFailed as e:
+            metrics.inc("errors", kind=f"run_{e.status}")
+            raise
+    new_message = "".join(parts)
+    logging.info(f"Generated message: {new_message}")
+
+    if cache is not None and not contextual:
+        await asyncio.to_thread(cache.put, message_body, new_message)
+    await _async_remember(key, message_body, new_message)
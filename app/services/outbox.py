@@ -0,0 +1,446 @@
+"""
+Durable outbound message queue.
+
+Usage (replay tooling):
+    python -m app.services.outbox stats --db outbox.db
+    python -m app.services.outbox dead --db outbox.db
+    python -m app.services.outbox replay --db outbox.db [--id 12 --id 15 | --all]
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app.services.graph_client import RETRY_STATUSES
+from app.utils.metrics import metrics
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS outbox ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, payload TEXT NOT NULL, "
+    "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, "
+    "next_attempt_at REAL NOT NULL, claimed_until REAL NOT NULL DEFAULT 0, last_error TEXT, "
+    "sender_id TEXT)",
+    "CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, id)",
+    "CREATE TABLE IF NOT EXISTS dead_letters ("
+    "id INTEGER PRIMARY KEY, recipient TEXT NOT NULL, payload TEXT NOT NULL, "
+    "attempts INTEGER NOT NULL, created_at REAL NOT NULL, failed_at REAL NOT NULL, "
+    "last_error TEXT, sender_id TEXT)",
+)
+
+# Oldest message of each recipient that is due and not claimed by another
+# sender. Later messages to the same recipient wait behind it.
+_CLAIMABLE = (
+    "SELECT id, recipient, payload, attempts, sender_id FROM outbox "
+    "WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY recipient) "
+    "AND next_attempt_at <= ? AND claimed_until <= ? ORDER BY id LIMIT ?"
+)
+
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Each commit is fsynced; enqueue batches many messages into one commit
+    conn.execute("PRAGMA synchronous=FULL")
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    # Files created before messages recorded which phone number sends them
+    for table in ("outbox", "dead_letters"):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if "sender_id" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN sender_id TEXT")
+    return conn
+
+
+class _Batch:
+    __slots__ = ("rows", "done", "ids", "error")
+
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        self.ids = []
+        self.error = None
+
+
+class Outbox:
+    """
+    Persistent SQLite queue for outbound WhatsApp messages.
+
+    `enqueue` returns once the message is committed to disk, so a reply that
+    was generated survives timeouts, Graph API outages and restarts. Writes
+    are group-committed: every message that arrives while a commit is in
+    progress goes into the next one, so the number of fsyncs grows with
+    commits rather than with messages.
+
+    A sender thread claims the oldest due message of each recipient, sends them
+    concurrently and records the outcomes in one transaction. A recipient's
+    messages therefore go out in order, and several processes can share one
+    database file without sending a message twice. Failures with 429/5xx or a
+    connection error are retried with jittered exponential backoff. Other 4xx
+    responses, and messages out of attempts, go to the dead_letters table for
+    replay.
+
+    `sender(payload, sender_id)` performs one send and returns the response;
+    `sender_id` is the phone number ID the message was queued for. It may raise
+    LookupError when that number is no longer configured, which dead-letters
+    the message. It should not retry on its own: a send that outlasts
+    `claim_seconds` can be claimed and sent again by another process.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        sender,
+        max_attempts=8,
+        backoff_base=1.0,
+        backoff_max=300.0,
+        send_concurrency=8,
+        claim_seconds=60,
+        poll_interval=1.0,
+    ):
+        self.db_path = db_path
+        self.sender = sender
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.send_concurrency = send_concurrency
+        self.claim_seconds = claim_seconds
+        self.poll_interval = poll_interval
+        self.stats = {
+            "enqueued": 0,
+            "commits": 0,
+            "sent": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+        }
+        self._cond = threading.Condition()
+        self._batch = _Batch()
+        self._wake_sender = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._stopping = False
+        self._start_lock = threading.Lock()
+        connect(db_path).close()
+
+    def _ensure_started(self):
+        # Once per process: a pre-fork server's workers do not inherit the
+        # master's threads, so each starts its own.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # Forked: the parent's batch and wakeups belong to its threads
+                self._cond = threading.Condition()
+                self._batch = _Batch()
+                self._wake_sender = threading.Event()
+                self._threads = []
+            self._pid = pid
+            for target, name in (
+                (self._write_loop, "outbox-writer"),
+                (self._send_loop, "outbox-sender"),
+            ):
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    start = _ensure_started
+
+    def enqueue(self, data, recipient=None, sender_id=None, timeout=10):
+        """
+        Durably queue a JSON-encoded message payload and return its outbox ID.
+        Raises RuntimeError if the outbox is shut down or the commit failed, in
+        which case the message was not stored. Returns None if the commit is
+        still pending after `timeout`; it will be sent once committed.
+        """
+        if recipient is None:
+            recipient = json.loads(data)["to"]
+        self._ensure_started()
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError("Outbox is shut down")
+            batch = self._batch
+            index = len(batch.rows)
+            batch.rows.append((recipient, data, sender_id))
+            self._cond.notify()
+        if not batch.done.wait(timeout):
+            logging.warning(f"Outbox commit still pending after {timeout}s")
+            return None
+        if batch.error is not None:
+            raise RuntimeError(f"Outbox commit failed: {batch.error}")
+        return batch.ids[index]
+
+    def _write_loop(self):
+        conn = connect(self.db_path)
+        while True:
+            with self._cond:
+                while not self._batch.rows and not self._stopping:
+                    self._cond.wait()
+                batch, self._batch = self._batch, _Batch()
+                stopping = self._stopping
+            if batch.rows:
+                self._commit(conn, batch)
+            if stopping:
+                conn.close()
+                return
+
+    def _commit(self, conn, batch):
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for recipient, data, sender_id in batch.rows:
+                cursor = conn.execute(
+                    "INSERT INTO outbox (recipient, payload, created_at, next_attempt_at, "
+                    "sender_id) VALUES (?, ?, ?, ?, ?)",
+                    (recipient, data, now, now, sender_id),
+                )
+                batch.ids.append(cursor.lastrowid)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logging.error(f"Failed to commit {len(batch.rows)} outbound messages: {e}")
+            batch.error = e
+        else:
+            self.stats["enqueued"] += len(batch.rows)
+            self.stats["commits"] += 1
+            self._wake_sender.set()
+        batch.done.set()
+
+    def _claim(self, conn):
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(_CLAIMABLE, (now, now, self.send_concurrency)).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET claimed_until = ? WHERE id = ?",
+                [(now + self.claim_seconds, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def _next_due(self, conn):
+        row = conn.execute(
+            "SELECT MIN(MAX(next_attempt_at, claimed_until)) FROM outbox"
+        ).fetchone()
+        return row[0]
+
+    def _attempt(self, row):
+        message_id, recipient, payload, attempts, sender_id = row
+        try:
+            response = self.sender(payload, sender_id)
+        except requests.RequestException as e:
+            return message_id, "retry", str(e)
+        except LookupError as e:
+            return message_id, "dead", str(e)
+        except Exception as e:
+            # Anything else must not kill the sender thread with rows claimed
+            logging.exception(f"Unexpected error sending outbound message {message_id}")
+            return message_id, "retry", repr(e)
+        if response.status_code < 400:
+            return message_id, "sent", None
+        error = f"{response.status_code}: {response.text[:200]}"
+        if response.status_code in RETRY_STATUSES:
+            return message_id, "retry", error
+        return message_id, "dead", error
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2, delay)
+
+    def _record(self, conn, rows, outcomes):
+        now = time.time()
+        attempts = {row[0]: row[3] + 1 for row in rows}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for message_id, outcome, error in outcomes:
+                if outcome == "retry" and attempts[message_id] >= self.max_attempts:
+                    outcome = "dead"
+                if outcome == "sent":
+                    conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+                elif outcome == "retry":
+                    conn.execute(
+                        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, "
+                        "claimed_until = 0, last_error = ? WHERE id = ?",
+                        (
+                            attempts[message_id],
+                            now + self._backoff(attempts[message_id]),
+                            error,
+                            message_id,
+                        ),
+                    )
+                else:
+                    conn.execute(
+                        "INSERT INTO dead_letters (id, recipient, payload, attempts, created_at, "
+                        "failed_at, last_error, sender_id) "
+                        "SELECT id, recipient, payload, ?, created_at, ?, ?, sender_id "
+                        "FROM outbox WHERE id = ?",
+                        (attempts[message_id], now, error, message_id),
+                    )
+                    conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+                    logging.error(f"Outbound message {message_id} dead-lettered: {error}")
+                self.stats[{"sent": "sent", "retry": "retried", "dead": "dead_lettered"}[outcome]] += 1
+                if outcome != "sent":
+                    metrics.inc("errors", kind=f"outbox_{outcome}")
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _send_loop(self):
+        conn = connect(self.db_path)
+        with ThreadPoolExecutor(self.send_concurrency, thread_name_prefix="outbox-send") as pool:
+            while True:
+                try:
+                    rows = self._claim(conn)
+                    if rows:
+                        outcomes = list(pool.map(self._attempt, rows))
+                        self._record(conn, rows, outcomes)
+                        continue
+                    next_due = self._next_due(conn)
+                except Exception as e:
+                    logging.error(f"Outbox sender error: {e}")
+                    next_due = None
+                if self._stopping:
+                    conn.close()
+                    return
+                wait = self.poll_interval
+                if next_due is not None:
+                    wait = min(wait, max(0.0, next_due - time.time()))
+                self._wake_sender.wait(wait)
+                self._wake_sender.clear()
+
+    def metrics(self):
+        stats = dict(self.stats)
+        try:
+            with sqlite3.connect(self.db_path, timeout=5) as conn:
+                stats["pending"] = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+                stats["dead"] = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        except sqlite3.Error:
+            pass
+        stats["avg_commit_size"] = stats["enqueued"] / stats["commits"] if stats["commits"] else 0.0
+        return stats
+
+    def shutdown(self, timeout=10):
+        """
+        Commit anything still being enqueued and stop the threads. Messages not
+        yet sent stay in the database for the next start.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._wake_sender.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+def dead_letters(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(
+            "SELECT id, recipient, attempts, failed_at, last_error FROM dead_letters ORDER BY id"
+        ).fetchall()
+
+
+def replay(db_path, ids=None):
+    """
+    Move dead letters (all, or only `ids`) back into the outbox with their
+    attempts reset. Returns the number of messages requeued.
+    """
+    conn = connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        where, params = "", []
+        if ids:
+            where = f" WHERE id IN ({','.join('?' * len(ids))})"
+            params = list(ids)
+        now = time.time()
+        # New IDs put replayed messages behind anything already queued
+        cursor = conn.execute(
+            "INSERT INTO outbox (recipient, payload, created_at, next_attempt_at, sender_id) "
+            f"SELECT recipient, payload, created_at, ?, sender_id FROM dead_letters{where} "
+            "ORDER BY id",
+            [now, *params],
+        )
+        count = cursor.rowcount
+        conn.execute(f"DELETE FROM dead_letters{where}", params)
+        conn.execute("COMMIT")
+        return count
+    finally:
+        conn.close()
+
+
+def tenant_sender(tenants):
+    """
+    Outbox sender that sends each message from the tenant it was queued for.
+    """
+
+    def send(payload, sender_id):
+        tenant = tenants.get(sender_id)
+        if tenant is None:
+            raise LookupError(f"No tenant for phone number ID {sender_id}")
+        # One attempt: the outbox owns retries and backoff
+        return tenants.graph_client(tenant).send_message(payload, max_retries=0)
+
+    return send
+
+
+def init_outbox(app):
+    """
+    Route outbound sends through a durable Outbox when OUTBOX_DB_PATH is set.
+    """
+    if not app.config["OUTBOX_DB_PATH"]:
+        return None
+    outbox = Outbox(
+        app.config["OUTBOX_DB_PATH"],
+        tenant_sender(app.extensions["tenants"]),
+        max_attempts=app.config["OUTBOX_MAX_ATTEMPTS"],
+        send_concurrency=app.config["OUTBOX_SEND_CONCURRENCY"],
+    )
+    app.extensions["outbox"] = outbox
+    # Send what a previous run left queued without waiting for a new reply;
+    # workers forked from a preloading master start their own threads
+    outbox.start()
+    app.before_request(outbox.start)
+    atexit.register(outbox.shutdown)
+    return outbox
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect and replay the outbound message queue")
+    parser.add_argument("command", choices=["stats", "dead", "replay"])
+    parser.add_argument("--db", default="outbox.db")
+    parser.add_argument("--id", type=int, action="append", dest="ids")
+    parser.add_argument("--all", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        with sqlite3.connect(args.db) as conn:
+            pending = conn.execute("SELECT COUNT(*), MAX(attempts) FROM outbox").fetchone()
+            dead = conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+        print(f"pending: {pending[0]} (max attempts {pending[1] or 0}), dead letters: {dead}")
+    elif args.command == "dead":
+        for message_id, recipient, attempts, failed_at, error in dead_letters(args.db):
+            failed = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(failed_at))
+            print(f"{message_id}\t{recipient}\t{attempts} attempts\t{failed}\t{error}")
+    else:
+        if not args.ids and not args.all:
+            parser.error("replay needs --id or --all")
+        print(f"Requeued {replay(args.db, None if args.all else args.ids)} messages")
+
+
+if __name__ == "__main__":
+    main()
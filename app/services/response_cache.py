@@ -0,0 +1,191 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from itertools import islice
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """
+    Canonical form used as the exact-match key: lowercase, no punctuation,
+    single spaces. "What's the Wi-Fi password?" == "whats the wifi password".
+    """
+    text = _NON_WORD.sub("", text.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def hashed_embedding(text, dims=512):
+    """
+    Cheap local embedding: hashed word and character-trigram counts, L2
+    normalised. Good enough to match rephrasings of the same short question.
+    """
+    features = Counter()
+    words = text.split()
+    features.update(f"w:{w}" for w in words)
+    padded = f" {text} "
+    features.update(f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2))
+    vector = {}
+    for feature, count in features.items():
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest()
+        index = int.from_bytes(digest, "little") % dims
+        vector[index] = vector.get(index, 0.0) + count
+    norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+    return {i: v / norm for i, v in vector.items()}
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(i, 0.0) for i, v in a.items())
+
+
+def files_fingerprint(paths):
+    """
+    Fingerprint of the knowledge files, so cached answers are dropped when
+    any of them changes.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Answer cache for repeat questions, checked before any OpenAI call.
+
+    Looks up the normalized question first; if `similarity` is set, falls back
+    to the nearest of the `scan_limit` most recently used questions by `embed`
+    and accepts it above that threshold. That scan runs outside the lock.
+    Entries expire after `ttl` seconds, the least recently used are
+    evicted past `maxsize`, and everything is dropped when the fingerprint of
+    `knowledge_files` changes.
+
+    Questions whose normalized form is shorter than `min_length` characters
+    ("👍", "?", "yes") are neither looked up nor stored: they normalize to the
+    same few keys and only make sense within one conversation.
+
+    Answers are shared between all users, so callers only `put` answers that
+    did not depend on the asker's conversation.
+    """
+
+    def __init__(
+        self,
+        ttl=86400,
+        maxsize=1000,
+        similarity=0.0,
+        knowledge_files=(),
+        embed=hashed_embedding,
+        check_interval=30,
+        min_length=8,
+        scan_limit=256,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.similarity = similarity
+        self.knowledge_files = list(knowledge_files)
+        self.embed = embed
+        self.check_interval = check_interval
+        self.min_length = min_length
+        self.scan_limit = scan_limit
+        self._entries = OrderedDict()  # key -> (answer, expires_at, vector)
+        self._lock = threading.Lock()
+        self._fingerprint = files_fingerprint(self.knowledge_files)
+        self._checked_at = time.monotonic()
+        self.stats = {
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "skipped": 0,
+            "invalidations": 0,
+        }
+
+    def _check_knowledge(self, now):
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        fingerprint = files_fingerprint(self.knowledge_files)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._entries.clear()
+            self.stats["invalidations"] += 1
+
+    def _nearest(self, vector, candidates, now):
+        best_key, best_score = None, self.similarity
+        for key, (_, expires_at, other) in candidates:
+            if expires_at <= now or other is None:
+                continue
+            score = cosine(vector, other)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def _key(self, question):
+        key = normalize(question)
+        return key if len(key) >= self.min_length else None
+
+    def get(self, question):
+        key = self._key(question)
+        now = time.monotonic()
+        with self._lock:
+            if key is None:
+                self.stats["skipped"] += 1
+                return None
+            self._check_knowledge(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            if not self.similarity:
+                self.stats["misses"] += 1
+                return None
+            # Most recently used first
+            candidates = list(islice(reversed(self._entries.items()), self.scan_limit))
+        match = self._nearest(self.embed(key), candidates, now)
+        with self._lock:
+            # Evicted or invalidated while the lock was released
+            entry = self._entries.get(match) if match is not None else None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(match)
+            self.stats["semantic_hits"] += 1
+            return entry[0]
+
+    def put(self, question, answer):
+        key = self._key(question)
+        if key is None:
+            return
+        vector = self.embed(key) if self.similarity else None
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats["invalidations"] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
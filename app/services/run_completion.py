@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import threading
+import time
+
+from app.utils.metrics import LatencyHistogram, metrics
+
+# Once a run reaches one of these it will not complete on its own. No tools
+# are handled here, so a run that requires action is cancelled.
+TERMINAL_STATUSES = {
+    "completed",
+    "failed",
+    "cancelled",
+    "expired",
+    "requires_action",
+    "incomplete",
+}
+
+
+class RunFailed(Exception):
+    """
+    Raised when an Assistants run ends in a terminal status other than completed,
+    or does not finish before its deadline.
+    """
+
+    def __init__(self, run_id, status, detail=None):
+        self.run_id = run_id
+        self.status = status
+        super().__init__(f"Run {run_id} ended with status {status}: {detail}")
+
+
+# Run latency per completion mode ("stream" / "poll" / "async_poll")
+run_latency = {}
+_run_latency_lock = threading.Lock()
+
+
+def observe_run_latency(mode, seconds):
+    with _run_latency_lock:
+        histogram = run_latency.get(mode)
+        if histogram is None:
+            # Shared with the registry so /metrics exports it as well
+            histogram = metrics.histogram(
+                "assistant_run_seconds", buckets=LatencyHistogram.BUCKETS, mode=mode
+            )
+            run_latency[mode] = histogram
+    histogram.observe(seconds)
+
+
+def _poll_intervals(initial, maximum, factor):
+    interval = initial
+    while True:
+        yield interval
+        interval = min(interval * factor, maximum)
+
+
+def _run_failed(run):
+    return RunFailed(run.id, run.status, getattr(run, "last_error", None))
+
+
+def _check_final(client, thread_id, run):
+    if run.status == "requires_action":
+        # Left alone it would keep the thread busy until it expires
+        _cancel_quietly(client, thread_id, run.id)
+    if run.status != "completed":
+        raise _run_failed(run)
+    return run
+
+
+def _cancel_quietly(client, thread_id, run_id):
+    try:
+        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logging.warning(f"Could not cancel run {run_id}: {e}")
+
+
+class _StreamDeadline:
+    """
+    Ends a run stream `deadline` seconds after it was opened, even while it is
+    blocked waiting for the next event: the run is cancelled, or it keeps the
+    thread busy for the next message, and the response closed, which makes
+    the pending read fail. The HTTP timeout alone only bounds each read.
+    """
+
+    def __init__(self, client, thread_id, stream, deadline):
+        self.client = client
+        self.thread_id = thread_id
+        self.stream = stream
+        self.deadline = deadline
+        self.expired = False
+        self._timer = threading.Timer(deadline, self._expire)
+        self._timer.daemon = True
+
+    def _expire(self):
+        self.expired = True
+        run = self.stream.current_run
+        if run is not None:
+            _cancel_quietly(self.client, self.thread_id, run.id)
+        self.stream.close()
+
+    def failure(self):
+        run = self.stream.current_run
+        return RunFailed(run.id if run else None, "deadline_exceeded", f"after {self.deadline}s")
+
+    def __enter__(self):
+        self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._timer.cancel()
+
+
+def wait_for_run(
+    client, thread_id, run, deadline=60, initial_interval=0.1, max_interval=1.0, factor=1.5
+):
+    """
+    Poll a run with adaptive backoff until it reaches a terminal status.
+
+    Short runs are picked up within ~100ms, long ones settle at one poll per
+    `max_interval` seconds. Returns the completed run or raises RunFailed.
+    """
+    expires_at = time.monotonic() + deadline
+    intervals = _poll_intervals(initial_interval, max_interval, factor)
+    while run.status not in TERMINAL_STATUSES:
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            _cancel_quietly(client, thread_id, run.id)
+            raise RunFailed(run.id, "deadline_exceeded", f"after {deadline}s")
+        time.sleep(min(next(intervals), remaining))
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    return _check_final(client, thread_id, run)
+
+
+def _latest_message_text(client, thread_id):
+    messages = client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+    return messages.data[0].content[0].text.value
+
+
+def complete_run(client, thread_id, assistant_id, mode="stream", deadline=60):
+    """
+    Run the assistant on a thread and return the text of its reply.
+
+    "stream" consumes the run's server-sent events and returns as soon as the
+    run ends, without any polling. "poll" creates the run and waits on it with
+    adaptive backoff. Streaming falls back to polling on SDKs without it.
+    """
+    if mode == "stream" and not hasattr(client.beta.threads.runs, "stream"):
+        mode = "poll"
+
+    start = time.monotonic()
+    if mode == "stream":
+        with client.beta.threads.runs.stream(
+            thread_id=thread_id, assistant_id=assistant_id, timeout=deadline
+        ) as stream, _StreamDeadline(client, thread_id, stream, deadline) as watchdog:
+            try:
+                stream.until_done()
+            except Exception as e:
+                if not watchdog.expired:
+                    raise
+                raise watchdog.failure() from e
+            if watchdog.expired:
+                raise watchdog.failure()
+            _check_final(client, thread_id, stream.get_final_run())
+            new_message = stream.get_final_messages()[-1].content[0].text.value
+    else:
+        run = client.beta.threads.runs.create(
+            thread_id=thread_id, assistant_id=assistant_id
+        )
+        wait_for_run(client, thread_id, run, deadline=deadline)
+        new_message = _latest_message_text(client, thread_id)
+
+    observe_run_latency(mode, time.monotonic() - start)
+    return new_message
+
+
+def stream_run_text(client, thread_id, assistant_id, deadline=60):
+    """
+    Run the assistant on a thread and yield the reply text as it is generated.
+    Raises RunFailed like `complete_run` once the run ends badly.
+    """
+    start = time.monotonic()
+    with client.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=assistant_id, timeout=deadline
+    ) as stream, _StreamDeadline(client, thread_id, stream, deadline) as watchdog:
+        try:
+            for event in stream:
+                if event.event == "thread.message.delta":
+                    for block in event.data.delta.content or ():
+                        if block.type == "text" and block.text.value:
+                            yield block.text.value
+        except Exception as e:
+            if not watchdog.expired:
+                raise
+            raise watchdog.failure() from e
+        if watchdog.expired:
+            raise watchdog.failure()
+        _check_final(client, thread_id, stream.get_final_run())
+    observe_run_latency("stream", time.monotonic() - start)
+
+
+async def _async_cancel_quietly(client, thread_id, run_id):
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logging.warning(f"Could not cancel run {run_id}: {e}")
+
+
+async def _async_check_final(client, thread_id, run):
+    if run.status == "requires_action":
+        await _async_cancel_quietly(client, thread_id, run.id)
+    if run.status != "completed":
+        raise _run_failed(run)
+    return run
+
+
+async def _async_deadline_exceeded(client, thread_id, stream, deadline):
+    run = stream.current_run
+    if run is not None:
+        await _async_cancel_quietly(client, thread_id, run.id)
+    return RunFailed(run.id if run else None, "deadline_exceeded", f"after {deadline}s")
+
+
+async def async_wait_for_run(
+    client, thread_id, run, deadline=60, initial_interval=0.1, max_interval=1.0, factor=1.5
+):
+    """
+    `wait_for_run` for an `AsyncOpenAI` client, so many runs can wait
+    concurrently on one event loop.
+    """
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + deadline
+    intervals = _poll_intervals(initial_interval, max_interval, factor)
+    while run.status not in TERMINAL_STATUSES:
+        remaining = expires_at - loop.time()
+        if remaining <= 0:
+            await _async_cancel_quietly(client, thread_id, run.id)
+            raise RunFailed(run.id, "deadline_exceeded", f"after {deadline}s")
+        await asyncio.sleep(min(next(intervals), remaining))
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    return await _async_check_final(client, thread_id, run)
+
+
+async def async_complete_run(client, thread_id, assistant_id, mode="stream", deadline=60):
+    """
+    Async counterpart of `complete_run` for an `AsyncOpenAI` client.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    if mode == "stream":
+        async with client.beta.threads.runs.stream(
+            thread_id=thread_id, assistant_id=assistant_id, timeout=deadline
+        ) as stream:
+            try:
+                await asyncio.wait_for(stream.until_done(), deadline)
+            except Exception as e:
+                # wait_for's TimeoutError, or the HTTP read timeout firing first
+                if loop.time() - start < deadline:
+                    raise
+                raise await _async_deadline_exceeded(client, thread_id, stream, deadline) from e
+            await _async_check_final(client, thread_id, await stream.get_final_run())
+            messages = await stream.get_final_messages()
+            new_message = messages[-1].content[0].text.value
+    else:
+        run = await client.beta.threads.runs.create(
+            thread_id=thread_id, assistant_id=assistant_id
+        )
+        await async_wait_for_run(client, thread_id, run, deadline=deadline)
+        messages = await client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+        new_message = messages.data[0].content[0].text.value
+
+    observe_run_latency(f"async_{mode}", loop.time() - start)
+    return new_message
+
+
+async def async_stream_run_text(client, thread_id, assistant_id, deadline=60):
+    """
+    Async counterpart of `stream_run_text` for an `AsyncOpenAI` client.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with client.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=assistant_id, timeout=deadline
+    ) as stream:
+        events = aiter(stream)
+        while True:
+            # One deadline for the whole run, not for each read
+            try:
+                event = await asyncio.wait_for(
+                    anext(events), max(start + deadline - loop.time(), 0)
+                )
+            except StopAsyncIteration:
+                break
+            except Exception as e:
+                if loop.time() - start < deadline:
+                    raise
+                raise await _async_deadline_exceeded(client, thread_id, stream, deadline) from e
+            if event.event == "thread.message.delta":
+                for block in event.data.delta.content or ():
+                    if block.type == "text" and block.text.value:
+                        yield block.text.value
+        await _async_check_final(client, thread_id, await stream.get_final_run())
+    observe_run_latency("async_stream", loop.time() - start)
@@ -0,0 +1,126 @@
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils.metrics import LatencyHistogram
+
+# Sent -> delivered/read latencies range from seconds to days
+STATUS_LATENCY_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+
+class StatusAggregator:
+    """
+    Aggregates WhatsApp sent/delivered/read/failed callbacks in memory.
+
+    Tracks the sent timestamp of recent outbound messages to compute
+    send-to-delivered and send-to-read latency histograms, and, with a
+    `db_path`, writes the raw status rows to SQLite in batches rather than
+    once per callback.
+    """
+
+    def __init__(self, db_path=None, batch_size=500, flush_interval=10, max_tracked=100000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_tracked = max_tracked
+        self._sent_at = OrderedDict()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.counts = {}
+        self.delivered_latency = LatencyHistogram(STATUS_LATENCY_BUCKETS)
+        self.read_latency = LatencyHistogram(STATUS_LATENCY_BUCKETS)
+        if db_path:
+            with sqlite3.connect(db_path) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS message_statuses ("
+                    "message_id TEXT, recipient_id TEXT, status TEXT, timestamp INTEGER)"
+                )
+
+    def record(self, message_id, recipient_id, status, timestamp):
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            timestamp = int(time.time())
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status == "sent":
+                self._sent_at[message_id] = timestamp
+                while len(self._sent_at) > self.max_tracked:
+                    self._sent_at.popitem(last=False)
+            elif status in ("delivered", "read"):
+                sent_at = self._sent_at.get(message_id)
+                if sent_at is not None:
+                    histogram = (
+                        self.delivered_latency if status == "delivered" else self.read_latency
+                    )
+                    histogram.observe(max(0, timestamp - sent_at))
+                if status == "read":
+                    self._sent_at.pop(message_id, None)
+            elif status == "failed":
+                self._sent_at.pop(message_id, None)
+
+            if self.db_path:
+                self._pending.append((message_id, recipient_id, status, timestamp))
+                due = (
+                    len(self._pending) >= self.batch_size
+                    or time.monotonic() - self._last_flush >= self.flush_interval
+                )
+            else:
+                due = False
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered status rows to SQLite in one transaction.
+        """
+        if not self.db_path:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+                self._last_flush = time.monotonic()
+            if not rows:
+                return 0
+            try:
+                with sqlite3.connect(self.db_path, timeout=5) as conn:
+                    conn.executemany(
+                        "INSERT INTO message_statuses VALUES (?, ?, ?, ?)", rows
+                    )
+            except sqlite3.Error as e:
+                logging.error(f"Failed to flush {len(rows)} status rows: {e}")
+                return 0
+            return len(rows)
+
+    def metrics(self):
+        with self._lock:
+            counts = dict(self.counts)
+            tracked = len(self._sent_at)
+            pending = len(self._pending)
+        return {
+            "counts": counts,
+            "tracked_messages": tracked,
+            "pending_rows": pending,
+            "sent_to_delivered_seconds": self.delivered_latency.snapshot(),
+            "sent_to_read_seconds": self.read_latency.snapshot(),
+        }
+
+
+def init_status_metrics(app):
+    """
+    Attach a StatusAggregator to the app.
+    """
+    aggregator = StatusAggregator(
+        db_path=app.config["STATUS_DB_PATH"],
+        batch_size=app.config["STATUS_FLUSH_BATCH"],
+        flush_interval=app.config["STATUS_FLUSH_INTERVAL"],
+    )
+    app.extensions["status_metrics"] = aggregator
+    atexit.register(aggregator.flush)
+    return aggregator
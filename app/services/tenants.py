@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from app.services.graph_client import AsyncGraphAPIClient, GraphAPIClient
+
+
+class Tenant:
+    """
+    One WhatsApp business phone number and what answers it: Graph API
+    credentials, the OpenAI assistant, and the namespace its conversation
+    threads are stored under.
+    """
+
+    __slots__ = (
+        "phone_number_id",
+        "name",
+        "access_token",
+        "version",
+        "assistant_id",
+        "thread_namespace",
+        "is_default",
+    )
+
+    def __init__(
+        self,
+        phone_number_id,
+        access_token,
+        name=None,
+        version=None,
+        assistant_id=None,
+        thread_namespace="",
+        is_default=False,
+    ):
+        self.phone_number_id = str(phone_number_id) if phone_number_id is not None else None
+        self.access_token = access_token
+        self.name = name or self.phone_number_id or "default"
+        self.version = version
+        # None uses the service-wide OPENAI_ASSISTANT_ID
+        self.assistant_id = assistant_id
+        self.thread_namespace = thread_namespace
+        self.is_default = is_default
+
+    def thread_key(self, wa_id):
+        # The default tenant keeps bare wa_ids so existing threads still resolve
+        return f"{self.thread_namespace}:{wa_id}" if self.thread_namespace else wa_id
+
+    @classmethod
+    def from_dict(cls, data, defaults):
+        if not data.get("phone_number_id"):
+            raise ValueError(f"Tenant without phone_number_id: {data}")
+        # Tokens can stay out of the file: "access_token_env": "PARIS_LOFT_TOKEN"
+        token = data.get("access_token") or os.getenv(data.get("access_token_env", ""))
+        if not token:
+            raise ValueError(f"Tenant {data['phone_number_id']} has no access token")
+        return cls(
+            phone_number_id=data["phone_number_id"],
+            access_token=token,
+            name=data.get("name"),
+            version=data.get("version") or defaults.version,
+            assistant_id=data.get("assistant_id") or defaults.assistant_id,
+            thread_namespace=data.get("thread_namespace", data["phone_number_id"]),
+        )
+
+
+def load_tenants(path, defaults):
+    """
+    Read a tenants file: {"tenants": [{"phone_number_id": ..., ...}, ...]}.
+    Returns a dict keyed on phone_number_id.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    entries = data["tenants"] if isinstance(data, dict) else data
+    tenants = {}
+    for entry in entries:
+        tenant = Tenant.from_dict(entry, defaults)
+        tenants[tenant.phone_number_id] = tenant
+    return tenants
+
+
+class TenantRegistry:
+    """
+    phone_number_id -> Tenant lookup for routing webhook events, plus one pooled
+    Graph API client per tenant.
+
+    Without a tenants file every event belongs to the default tenant built from
+    the app config. With one, the file is re-read when its modification time
+    changes (checked at most every `reload_interval` seconds), so numbers can
+    be added or rotated without restarting workers. A file that fails to parse
+    is logged and the previous tenants stay in place.
+    """
+
+    def __init__(self, default, path=None, reload_interval=5.0, client_options=None):
+        self.default = default
+        self.path = path
+        self.reload_interval = reload_interval
+        self.client_options = client_options or {}
+        self._tenants = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = {}
+        self.reloads = 0
+        if path:
+            self._reload(raise_errors=True)
+
+    def _reload(self, raise_errors=False):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            tenants = load_tenants(self.path, self.default)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if raise_errors:
+                raise
+            logging.error(f"Could not reload tenants from {self.path}: {e}")
+            return
+        # Swap in one assignment; lookups never see a half-built registry
+        self._tenants = tenants
+        self._mtime = mtime
+        self.reloads += 1
+        logging.info(f"Loaded {len(tenants)} tenants from {self.path}")
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.reload_interval
+            self._reload()
+
+    def get(self, phone_number_id):
+        """
+        The tenant for a webhook's metadata.phone_number_id, or None if the
+        number is not configured.
+        """
+        if not self.path:
+            return self.default
+        self._maybe_reload()
+        tenant = self._tenants.get(phone_number_id)
+        if tenant is None and phone_number_id in (None, self.default.phone_number_id):
+            return self.default
+        return tenant
+
+    def graph_client(self, tenant):
+        key = (tenant.phone_number_id, tenant.access_token, tenant.version)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = GraphAPIClient(
+                        access_token=tenant.access_token,
+                        phone_number_id=tenant.phone_number_id,
+                        version=tenant.version,
+                        **self.client_options,
+                    )
+                    self._clients[key] = client
+        return client
+
+    def async_graph_client(self, tenant):
+        key = (tenant.phone_number_id, tenant.access_token, tenant.version)
+        client = self._async_clients.get(key)
+        if client is None:
+            options = dict(self.client_options)
+            options["pool_size"] = max(options.get("pool_size", 0), 100)
+            client = self._async_clients[key] = AsyncGraphAPIClient(
+                access_token=tenant.access_token,
+                phone_number_id=tenant.phone_number_id,
+                version=tenant.version,
+                **options,
+            )
+        return client
+
+    def add_client(self, tenant, client):
+        """
+        Register an existing client (e.g. the app's shared one) for a tenant.
+        """
+        self._clients[(tenant.phone_number_id, tenant.access_token, tenant.version)] = client
+
+    async def aclose(self):
+        for client in self._async_clients.values():
+            await client.close()
+        self._async_clients.clear()
+
+    def metrics(self):
+        return {
+            "tenants": len(self._tenants) if self.path else 1,
+            "reloads": self.reloads,
+            "graph_clients": len(self._clients) + len(self._async_clients),
+        }
+
+
+def build_registry(config, shared_client=None):
+    """
+    TenantRegistry from the app config; the env credentials are the default tenant.
+    """
+    default = Tenant(
+        phone_number_id=config["PHONE_NUMBER_ID"],
+        access_token=config["ACCESS_TOKEN"],
+        version=config["VERSION"],
+        is_default=True,
+    )
+    registry = TenantRegistry(
+        default,
+        path=config["TENANTS_FILE"],
+        reload_interval=config["TENANTS_RELOAD_INTERVAL"],
+        client_options={
+            "base_url": config["GRAPH_API_BASE_URL"],
+            "pool_size": config["GRAPH_POOL_SIZE"],
+            "timeout": config["GRAPH_TIMEOUT"],
+            "max_retries": config["GRAPH_MAX_RETRIES"],
+        },
+    )
+    if shared_client is not None:
+        registry.add_client(default, shared_client)
+    return registry
+
+
+def init_tenants(app):
+    """
+    Attach the TenantRegistry, reusing the app's Graph API client for the default tenant.
+    """
+    registry = build_registry(app.config, app.extensions.get("graph_client"))
+    app.extensions["tenants"] = registry
+    return registry
@@ -0,0 +1,202 @@
+"""
+Storage for the wa_id -> OpenAI thread ID mapping.
+
+Usage (migrate an existing shelve file):
+    python -m app.services.thread_store threads_db sqlite:///threads.db
+"""
+
+import logging
+import shelve
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+
+class ThreadStore:
+    """
+    Interface for conversation-state backends.
+    """
+
+    def get(self, wa_id):
+        raise NotImplementedError
+
+    def set(self, wa_id, thread_id):
+        raise NotImplementedError
+
+    def delete(self, wa_id):
+        raise NotImplementedError
+
+
+class MemoryThreadStore(ThreadStore):
+    """
+    Process-local store, for tests and single-process development.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, wa_id):
+        return self._data.get(wa_id)
+
+    def set(self, wa_id, thread_id):
+        self._data[wa_id] = thread_id
+
+    def delete(self, wa_id):
+        self._data.pop(wa_id, None)
+
+
+class SQLiteThreadStore(ThreadStore):
+    """
+    SQLite store in WAL mode: readers never block, and concurrent writers from
+    several gunicorn workers are serialised by SQLite's own locking.
+    """
+
+    def __init__(self, path="threads.db"):
+        self.path = path
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            "wa_id TEXT PRIMARY KEY, thread_id TEXT NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, wa_id):
+        row = self._connection().execute(
+            "SELECT thread_id FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, wa_id, thread_id):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO threads (wa_id, thread_id) VALUES (?, ?)",
+            (wa_id, thread_id),
+        )
+
+    def set_many(self, items):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO threads (wa_id, thread_id) VALUES (?, ?)",
+                items,
+            )
+
+    def delete(self, wa_id):
+        self._connection().execute("DELETE FROM threads WHERE wa_id = ?", (wa_id,))
+
+
+class RedisThreadStore(ThreadStore):
+    """
+    Store backed by any Redis-compatible server. Pass `client` to use an existing
+    connection or a local stand-in such as fakeredis.
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="thread:", client=None):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, wa_id):
+        value = self.client.get(self.prefix + wa_id)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    def set(self, wa_id, thread_id):
+        self.client.set(self.prefix + wa_id, thread_id)
+
+    def delete(self, wa_id):
+        self.client.delete(self.prefix + wa_id)
+
+
+class CachedThreadStore(ThreadStore):
+    """
+    In-memory LRU in front of a durable backend. Thread IDs never change once
+    assigned, so cached entries only go stale through `delete`.
+    """
+
+    def __init__(self, backend, maxsize=10000):
+        self.backend = backend
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, wa_id, thread_id):
+        with self._lock:
+            self._cache[wa_id] = thread_id
+            self._cache.move_to_end(wa_id)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def get(self, wa_id):
+        with self._lock:
+            thread_id = self._cache.get(wa_id)
+            if thread_id is not None:
+                self._cache.move_to_end(wa_id)
+                return thread_id
+        thread_id = self.backend.get(wa_id)
+        if thread_id is not None:
+            self._remember(wa_id, thread_id)
+        return thread_id
+
+    def set(self, wa_id, thread_id):
+        self.backend.set(wa_id, thread_id)
+        self._remember(wa_id, thread_id)
+
+    def delete(self, wa_id):
+        self.backend.delete(wa_id)
+        with self._lock:
+            self._cache.pop(wa_id, None)
+
+
+def create_thread_store(url, cache_size=10000):
+    """
+    Build a store from a URL: "sqlite:///path.db", "redis://host:port/db" or
+    "memory://". Durable backends get an LRU cache in front.
+    """
+    if url.startswith("sqlite:///"):
+        backend = SQLiteThreadStore(url[len("sqlite:///") :])
+    elif url.startswith(("redis://", "rediss://")):
+        backend = RedisThreadStore(url)
+    elif url.startswith("memory://"):
+        return MemoryThreadStore()
+    else:
+        raise ValueError(f"Unsupported thread store URL: {url}")
+    if cache_size:
+        return CachedThreadStore(backend, maxsize=cache_size)
+    return backend
+
+
+def migrate_from_shelve(shelf_path, store):
+    """
+    Copy every wa_id -> thread_id pair from the old shelve file into `store`.
+    """
+    with shelve.open(shelf_path, flag="r") as shelf:
+        items = [(wa_id, shelf[wa_id]) for wa_id in shelf.keys()]
+    target = getattr(store, "backend", store)
+    if hasattr(target, "set_many"):
+        target.set_many(items)
+    else:
+        for wa_id, thread_id in items:
+            target.set(wa_id, thread_id)
+    logging.info(f"Migrated {len(items)} threads from {shelf_path}")
+    return len(items)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m app.services.thread_store SHELF_PATH STORE_URL")
+    migrate_from_shelve(sys.argv[1], create_thread_store(sys.argv[2], cache_size=0))
@@ -0,0 +1,226 @@
+import bisect
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Fine enough to tell a 1ms signature check from a 5s assistant run
+STAGE_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+
+class LatencyHistogram:
+    """
+    Thread-safe fixed-bucket latency histogram (seconds).
+    """
+
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile (0 < q <= 1).
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= rank:
+                    return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def cumulative(self):
+        """
+        (upper bound, cumulative count) pairs ending with +Inf, plus the sum.
+        """
+        with self._lock:
+            counts, total = list(self.counts), self.total
+        pairs, seen = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            seen += n
+            pairs.append((bound, seen))
+        return pairs, total
+
+    def snapshot(self):
+        with self._lock:
+            count, total = self.count, self.total
+        return {
+            "count": count,
+            "mean": total / count if count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{value}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _flatten(prefix, stats, out):
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            _flatten(name, value, out)
+        elif isinstance(value, bool):
+            out[name] = int(value)
+        elif isinstance(value, (int, float)):
+            out[name] = value
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms, rendered in the Prometheus
+    text exposition format. Cheap enough to leave on in the hot path: an
+    increment or observation is one lock and an addition.
+    """
+
+    def __init__(self, namespace="whatsapp"):
+        self.namespace = namespace
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def histogram(self, name, buckets=STAGE_BUCKETS, **labels):
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram(buckets))
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the block into the stage_seconds histogram, labelled by stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def snapshot(self):
+        """
+        Counters and stage summaries as a plain dict, for logs and benchmarks.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        return {
+            "counters": {
+                name + _format_labels(key): value for (name, key), value in counters.items()
+            },
+            "histograms": {
+                name + _format_labels(key): histogram.snapshot()
+                for (name, key), histogram in histograms.items()
+            },
+        }
+
+    def render(self, gauges=None):
+        """
+        Prometheus text format. `gauges` maps a component name to its
+        `metrics()` dict; numeric values are exported as gauges.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        lines = []
+
+        seen = set()
+        for (name, key), value in counters:
+            metric = f"{self.namespace}_{name}_total"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} counter")
+                seen.add(metric)
+            lines.append(f"{metric}{_format_labels(key)} {_format_value(value)}")
+
+        for (name, key), histogram in histograms:
+            metric = f"{self.namespace}_{name}"
+            if metric not in seen:
+                lines.append(f"# TYPE {metric} histogram")
+                seen.add(metric)
+            pairs, total = histogram.cumulative()
+            for bound, count in pairs:
+                labels = _format_labels(key, [("le", _format_value(bound))])
+                lines.append(f"{metric}_bucket{labels} {count}")
+            lines.append(f"{metric}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{metric}_count{_format_labels(key)} {pairs[-1][1]}")
+
+        flat = {}
+        for component, stats in (gauges or {}).items():
+            _flatten(f"{self.namespace}_{component}", stats, flat)
+        for metric, value in sorted(flat.items()):
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+stage_timer = metrics.timer
+
+
+def sample(rate):
+    """
+    True for roughly `rate` of calls; used to log bodies without logging all of them.
+    """
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def component_metrics(components):
+    """
+    `metrics()` of each component that is enabled, plus the OpenAI service's
+    call savings, assistant metadata cache, response cache and conversation
+    history once that module has been loaded.
+    """
+    gauges = {name: c.metrics() for name, c in components.items() if c is not None}
+    openai_service = sys.modules.get("app.services.openai_service")
+    if openai_service is not None:
+        gauges["openai_calls"] = dict(openai_service.api_call_stats)
+        gauges["assistant_cache"] = openai_service.metadata_cache.metrics()
+        if openai_service.response_cache is not None:
+            gauges["response_cache"] = openai_service.response_cache.metrics()
+        if openai_service._history is not None:
+            gauges["history"] = openai_service._history.metrics()
+    return gauges
@@ -0,0 +1,128 @@
+import re
+
+# WhatsApp rejects text message bodies longer than this
+WHATSAPP_MAX_TEXT_LENGTH = 4096
+
+# Cut points end each match: sentence ends followed by whitespace (closing
+# quotes and brackets stay with their sentence) and paragraph breaks
+_BOUNDARY = re.compile(r"[.!?][\"')\]]*(?=\s)|(?=\n[ \t]*\n)")
+# Fallbacks for text that has to be cut before a proper boundary
+_LINE_BREAK = re.compile(r"(?=\n)")
+_WHITESPACE = re.compile(r"(?=\s)")
+# Words whose period does not end a sentence
+_ABBREVIATIONS = frozenset({"mr", "mrs", "ms", "dr", "st", "vs", "approx"})
+
+
+def _outside_code_block(text, end):
+    return text.count("```", 0, end) % 2 == 0
+
+
+def _sentence_end(text, match):
+    """
+    False for periods that end a list marker ("1.", "a.") or an abbreviation
+    ("e.g.", "Dr.") rather than a sentence.
+    """
+    start = match.start()
+    if text[start] != ".":
+        return True
+    word_start = max(text.rfind(c, 0, start) for c in " \t\n") + 1
+    word = text[word_start:start].lstrip("(\"'[")
+    if len(word) == 1 and word.isalpha() or "." in word or word.lower() in _ABBREVIATIONS:
+        return False
+    line_start = text.rfind("\n", 0, word_start) + 1
+    return bool(word) and not (word.isdigit() and not text[line_start:word_start].strip())
+
+
+def _boundary(text, match):
+    return _sentence_end(text, match) and _outside_code_block(text, match.end())
+
+
+def _forced_cut(text, limit):
+    """
+    Best place to cut `text` at or before `limit` characters: the last
+    paragraph or sentence end, else the last line break, else the last space.
+    """
+    for pattern in (_BOUNDARY, _LINE_BREAK, _WHITESPACE):
+        cut = None
+        for match in pattern.finditer(text, 0, limit):
+            if match.end() > 0 and (pattern is not _BOUNDARY or _boundary(text, match)):
+                cut = match.end()
+        if cut is not None:
+            return cut
+    return limit
+
+
+class ReplyChunker:
+    """
+    Cuts a streamed reply into WhatsApp-sized messages as the text arrives.
+
+    The first chunk is released at the first sentence or paragraph end after
+    `first_min_length` characters, so the guest sees something as soon as
+    possible without getting a lone "Sure!". Later chunks wait for at least
+    `min_length` characters so a long answer does not turn into dozens of
+    one-line messages. Chunks never exceed `max_length` and are not cut inside
+    a ``` code block unless they have to be.
+    """
+
+    def __init__(self, max_length=WHATSAPP_MAX_TEXT_LENGTH, min_length=300, first_min_length=40):
+        self.max_length = max_length
+        self.min_length = min_length
+        self.first_min_length = first_min_length
+        self.buffer = ""
+        self.chunks_sent = 0
+
+    def _next_cut(self):
+        text = self.buffer
+        if len(text) > self.max_length:
+            return _forced_cut(text, self.max_length)
+        minimum = self.min_length if self.chunks_sent else self.first_min_length
+        for match in _BOUNDARY.finditer(text, max(minimum, 1)):
+            if _boundary(text, match):
+                return match.end()
+        return None
+
+    def _take(self, cut):
+        chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:].lstrip()
+        if chunk:
+            self.chunks_sent += 1
+        return chunk
+
+    def feed(self, text):
+        """
+        Add streamed text and return the chunks that are now complete.
+        """
+        self.buffer += text
+        chunks = []
+        cut = self._next_cut()
+        while cut is not None:
+            chunk = self._take(cut)
+            if chunk:
+                chunks.append(chunk)
+            cut = self._next_cut()
+        return chunks
+
+    def close(self):
+        """
+        Return whatever is left once the stream has ended.
+        """
+        chunks = split_message(self.buffer, self.max_length)
+        self.buffer = ""
+        self.chunks_sent += len(chunks)
+        return chunks
+
+
+def split_message(text, max_length=WHATSAPP_MAX_TEXT_LENGTH):
+    """
+    Split `text` into messages of at most `max_length` characters, preferring
+    paragraph and sentence ends, then line breaks, then spaces.
+    """
+    chunks = []
+    while len(text) > max_length:
+        cut = _forced_cut(text, max_length)
+        chunk, text = text[:cut].strip(), text[cut:].lstrip()
+        if chunk:
+            chunks.append(chunk)
+    text = text.strip()
+    if text:
+        chunks.append(text)
+    return chunks
@@ -0,0 +1,115 @@
+# Message types whose payload is a media object ({"id", "mime_type", "sha256", ...})
+MEDIA_TYPES = frozenset(("image", "audio", "video", "document", "sticker"))
+
+
+class ContactEvent:
+    __slots__ = ("wa_id", "name", "phone_number_id")
+
+    def __init__(self, wa_id, name, phone_number_id):
+        self.wa_id = wa_id
+        self.name = name
+        self.phone_number_id = phone_number_id
+
+
+class MessageEvent:
+    __slots__ = (
+        "id",
+        "wa_id",
+        "name",
+        "type",
+        "timestamp",
+        "text",
+        "phone_number_id",
+        "raw",
+        "media",
+    )
+
+    def __init__(
+        self, id, wa_id, name, type, timestamp, text, phone_number_id, raw, media=None
+    ):
+        self.id = id
+        self.wa_id = wa_id
+        self.name = name
+        self.type = type
+        self.timestamp = timestamp
+        self.text = text
+        self.phone_number_id = phone_number_id
+        self.raw = raw
+        self.media = media
+
+
+class StatusEvent:
+    __slots__ = ("id", "recipient_id", "status", "timestamp", "phone_number_id", "raw")
+
+    def __init__(self, id, recipient_id, status, timestamp, phone_number_id, raw):
+        self.id = id
+        self.recipient_id = recipient_id
+        self.status = status
+        self.timestamp = timestamp
+        self.phone_number_id = phone_number_id
+        self.raw = raw
+
+
+def _items(value):
+    # A payload list, or nothing; its non-object items are skipped by the caller
+    return value if type(value) is list else ()
+
+
+def iter_events(body):
+    """
+    Walk every entry, change, contact, message and status of a webhook payload
+    once, yielding ContactEvent, MessageEvent and StatusEvent objects in order.
+    A body that is not a JSON object yields nothing.
+    """
+    if type(body) is not dict:
+        return
+    for entry in _items(body.get("entry")):
+        if type(entry) is not dict:
+            continue
+        for change in _items(entry.get("changes")):
+            value = change.get("value") if type(change) is dict else None
+            if not value or type(value) is not dict:
+                continue
+            phone_number_id = (value.get("metadata") or {}).get("phone_number_id")
+
+            names = {}
+            for contact in _items(value.get("contacts")):
+                if type(contact) is not dict:
+                    continue
+                wa_id = contact.get("wa_id")
+                name = (contact.get("profile") or {}).get("name")
+                names[wa_id] = name
+                yield ContactEvent(wa_id, name, phone_number_id)
+
+            for message in _items(value.get("messages")):
+                if type(message) is not dict:
+                    continue
+                wa_id = message.get("from")
+                if wa_id is None and len(names) == 1:
+                    wa_id = next(iter(names))
+                message_type = message.get("type", "text")
+                text = (message.get("text") or {}).get("body")
+                media = message.get(message_type) if message_type in MEDIA_TYPES else None
+                yield MessageEvent(
+                    message.get("id"),
+                    wa_id,
+                    names.get(wa_id),
+                    message_type,
+                    message.get("timestamp"),
+                    text,
+                    phone_number_id,
+                    message,
+                    media,
+                )
+
+            for status in _items(value.get("statuses")):
+                if type(status) is not dict:
+                    continue
+                yield StatusEvent(
+                    status.get("id"),
+                    status.get("recipient_id"),
+                    status.get("status"),
+                    status.get("timestamp"),
+                    phone_number_id,
+                    status,
+                )
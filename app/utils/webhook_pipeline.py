@@ -0,0 +1,116 @@
+"""
+Webhook handling shared by the Flask app and the ASGI app.
+
+The functions here take the components they use as arguments instead of
+reading them from the Flask app. Some of them block on SQLite-backed
+components (dedup, admission, status flushes), so the ASGI app calls them
+through `asyncio.to_thread`.
+"""
+
+import json
+import logging
+import re
+
+from app.services.admission import ADMITTED
+from app.utils.metrics import metrics, stage_timer
+from app.utils.reply_chunker import split_message
+from app.utils.webhook_parser import MessageEvent, StatusEvent, iter_events
+from app.utils.whatsapp_formatter import format_basic, format_for_whatsapp
+
+# Kinds of webhook returned by parse_webhook
+STATUS = "status"
+MESSAGES = "messages"
+NOT_WHATSAPP = "not_whatsapp"
+
+# "field": "messages" is in every payload, a messages array is not
+_HAS_MESSAGES = re.compile(rb'"messages"\s*:')
+
+
+class InvalidWebhook(ValueError):
+    """
+    A webhook body that is not a JSON object; answered with 400.
+    """
+
+
+def parse_webhook(raw):
+    """
+    Parse a signed webhook body into (kind, events). Status updates, most of
+    the webhook traffic, are spotted in the raw bytes so that they skip
+    message handling entirely.
+    """
+    try:
+        with stage_timer("json_parse"):
+            body = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        logging.error("Failed to decode JSON")
+        metrics.inc("errors", kind="invalid_json")
+        raise InvalidWebhook("Invalid JSON provided")
+    if not isinstance(body, dict):
+        logging.error("Webhook body is not a JSON object")
+        metrics.inc("errors", kind="invalid_json")
+        raise InvalidWebhook("Expected a JSON object")
+    # A single POST can batch several entries, messages and statuses
+    events = list(iter_events(body))
+    if b'"statuses"' in raw and not _HAS_MESSAGES.search(raw):
+        return STATUS, events
+    if body.get("object") and any(isinstance(event, MessageEvent) for event in events):
+        return MESSAGES, events
+    return NOT_WHATSAPP, events
+
+
+def record_statuses(aggregator, events):
+    if aggregator is None:
+        return
+    for event in events:
+        if isinstance(event, StatusEvent):
+            aggregator.record(event.id, event.recipient_id, event.status, event.timestamp)
+
+
+def screen_message(event, dedup, admission, tenants, media_enabled):
+    """
+    Decide whether a message event gets answered: it is not a redelivery
+    (pass `dedup=None` for events deduplicated upstream), it has text or
+    processable media, and it is within the admission limits.
+
+    Returns (accepted, notice). `notice` is (tenant, text) when a shed sender
+    is owed the canned reply for its limit, which the caller sends.
+    """
+    # Skip redeliveries before doing any work
+    if dedup is not None and dedup.check_and_add(event.id):
+        logging.info(f"Skipping duplicate message {event.id}")
+        return False, None
+
+    if event.text is None and not (event.media is not None and media_enabled):
+        logging.info(f"Ignoring unsupported {event.type} message {event.id}")
+        return False, None
+
+    # Shed over-limit messages before any download or assistant run
+    if admission is None:
+        return True, None
+    decision = admission.admit(event.wa_id)
+    if decision == ADMITTED:
+        return True, None
+    logging.info(f"Shedding message {event.id} from {event.wa_id}: {decision}")
+    tenant = tenants.get(event.phone_number_id)
+    # Unless the sender was told recently
+    reply = tenant is not None and admission.notice(event.wa_id, decision)
+    notice = (tenant, reply) if reply else None
+    return False, notice
+
+
+def process_text_for_whatsapp(text, markdown=True):
+    # Markdown from the model -> WhatsApp formatting, citations removed. The
+    # basic fallback (REPLY_MARKDOWN=false) only handles citations and **bold**
+    if markdown:
+        return format_for_whatsapp(text)
+    return format_basic(text)
+
+
+def reply_parts(text, markdown=True):
+    """
+    A generated reply as the WhatsApp messages to send: formatted, and split
+    when it is over WhatsApp's length limit.
+    """
+    with stage_timer("text_processing"):
+        text = process_text_for_whatsapp(text, markdown)
+    return split_message(text)
@@ -0,0 +1,120 @@
+import re
+
+from app.utils.reply_chunker import WHATSAPP_MAX_TEXT_LENGTH, split_message
+
+# Every markdown construct the assistant emits, as one alternation so a reply
+# is converted in a single scan. Each branch starts with a literal character
+# (line-start constructs with the preceding newline), which lets the regex
+# engine skip straight to the next candidate instead of trying every branch
+# at every position. Code is matched before the inline markers it may
+# contain, bold before italic.
+_MARKDOWN = re.compile(
+    r"""
+    \n(?:
+        (?P<fence>[ \t]*```[^\n]*\n(?P<fence_body>.*?)\n[ \t]*```[ \t]*)(?=\n|\Z)
+        |(?P<heading>[ \t]{0,3}\#{1,6}[ \t]+(?P<heading_text>[^\n]*?)[ \t\#]*)(?=\n|\Z)
+        |(?P<rule>[ \t]*(?:-[ \t]*-[ \t]*-[- \t]*|\*[ \t]*\*[ \t]*\*[* \t]*|_[ \t]*_[ \t]*_[_ \t]*)
+            (?=\n|\Z)(?:\n[ \t]*(?=\n))*)
+        |(?P<bullet>(?P<bullet_indent>[ \t]*)[*+•][ \t]+)
+    )
+    |`(?P<code>[^`\n]+)`
+    |【(?P<citation>[^】]*)】
+    |!\[(?P<image>(?P<image_alt>[^\]\n]*)\]\((?P<image_url>[^)\s]+)(?:[ \t]+"[^"\n]*")?)\)
+    |\[(?P<link>(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^)\s]+)(?:[ \t]+"[^"\n]*")?)\)
+    |\*\*(?P<bold>[^*\n]+(?:\*(?!\*)[^*\n]*)*)\*\*
+    |__(?<!\w__)(?!\w+__)(?P<bold_alt>[^\n]+?)__(?!\w)
+    |~~(?P<strike>[^\n]+?)~~
+    |\*(?<![\w*]\*)(?P<italic>[^*\s](?:[^*\n]*[^*\s])?)\*(?![\w*])
+    """,
+    re.DOTALL | re.VERBOSE,
+)
+# Any character that can start an inline construct
+_INLINE_MARKER = re.compile(r"[`【!\[*_~]")
+
+# The basic conversion: 【…】 file citations dropped, **bold** made *bold*
+_CITATION = re.compile(r"【.*?】")
+_BOLD = re.compile(r"\*\*(.*?)\*\*")
+
+
+def _strip_markers(text):
+    return text.replace("*", "")
+
+
+def _replace(match):
+    # The outer token group closes last, so it is always lastgroup
+    return _TOKENS[match.lastgroup](match)
+
+
+def _link(match):
+    text, url = _format_inline(match.group("link_text")), match.group("link_url")
+    if text == url or url.startswith("mailto:") and text == url[7:]:
+        return text
+    return f"{text} ({url})"
+
+
+def _image(match):
+    alt = match.group("image_alt").strip()
+    return f"{alt}: {match.group('image_url')}" if alt else match.group("image_url")
+
+
+def _bold(match):
+    # WhatsApp has no nested bold; drop markers left inside
+    return f"*{_strip_markers(_format_inline(match.group(match.lastgroup)))}*"
+
+
+_TOKENS = {
+    # WhatsApp shows ``` blocks as monospace but has no language tags
+    "fence": lambda m: f"\n```\n{m.group('fence_body')}\n```",
+    "heading": lambda m: f"\n*{_strip_markers(_format_inline(m.group('heading_text')))}*",
+    "rule": lambda m: "",
+    "bullet": lambda m: f"\n{m.group('bullet_indent')}- ",
+    "code": lambda m: m.group(0),
+    "citation": lambda m: "",
+    "image": _image,
+    "link": _link,
+    "bold": _bold,
+    "bold_alt": _bold,
+    "strike": lambda m: f"~{_format_inline(m.group('strike'))}~",
+    "italic": lambda m: f"_{m.group('italic')}_",
+}
+
+
+def _format_inline(text):
+    # Most bold and link texts hold no markdown; skip rescanning them
+    if _INLINE_MARKER.search(text) is None:
+        return text
+    return _MARKDOWN.sub(_replace, text)
+
+
+def format_for_whatsapp(text):
+    """
+    Convert the markdown the assistant writes into WhatsApp formatting.
+
+    Headings and **bold** become *bold*, *italic* becomes _italic_, ~~strike~~
+    becomes ~strike~, links become "text (url)", `*`/`+` bullets become "- ",
+    fenced code loses its language tag, and horizontal rules and 【…】 file
+    citations are dropped. A bare identifier between double underscores, such
+    as __init__, is left as written.
+    """
+    # The leading newline lets the first line match line-start constructs
+    return _MARKDOWN.sub(_replace, "\n" + text).strip()
+
+
+def _basic_bold(match):
+    return f"*{match.group(1)}*"
+
+
+def format_basic(text):
+    """
+    Drop 【…】 file citations and turn **bold** into *bold*, leaving any other
+    markdown as written. The REPLY_MARKDOWN=false fallback, several times
+    cheaper than `format_for_whatsapp`.
+    """
+    return _BOLD.sub(_basic_bold, _CITATION.sub("", text).strip())
+
+
+def format_and_split(text, max_length=WHATSAPP_MAX_TEXT_LENGTH):
+    """
+    Format a reply and split it into messages WhatsApp will accept.
+    """
+    return split_message(format_for_whatsapp(text), max_length)
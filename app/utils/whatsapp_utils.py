@@ -1,16 +1,23 @@
 import logging
 from flask import current_app, jsonify
 import json
+import time
 import requests
 
 # from app.services.openai_service import generate_response
-import re
+
+from app.utils.metrics import metrics, sample, stage_timer
+from app.utils.reply_chunker import ReplyChunker, split_message
+from app.utils.webhook_parser import MessageEvent, iter_events
+from app.utils.webhook_pipeline import process_text_for_whatsapp, reply_parts, screen_message
 
 
 def log_http_response(response):
     logging.info(f"Status: {response.status_code}")
-    logging.info(f"Content-type: {response.headers.get('content-type')}")
-    logging.info(f"Body: {response.text}")
+    # Decoding and logging every body costs throughput; log a sample of them
+    if sample(current_app.config["LOG_BODY_SAMPLE_RATE"]):
+        logging.info(f"Content-type: {response.headers.get('content-type')}")
+        logging.info(f"Body: {response.text}")
 
 
 def get_text_message_input(recipient, text):
@@ -30,78 +37,207 @@ def generate_response(response):
     return response.upper()
 
 
-def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {current_app.config['ACCESS_TOKEN']}",
-    }
+def send_message(data, tenant=None):
+    tenants = current_app.extensions["tenants"]
+    tenant = tenant or tenants.default
+
+    # Hand the reply to the durable outbox when enabled; it retries on its own
+    outbox = current_app.extensions.get("outbox")
+    if outbox is not None:
+        try:
+            return outbox.enqueue(data, sender_id=tenant.phone_number_id)
+        except RuntimeError as e:
+            logging.error(f"Could not queue message, sending directly: {e}")
+            metrics.inc("errors", kind="outbox_enqueue")
 
-    url = f"https://graph.facebook.com/{current_app.config['VERSION']}/{current_app.config['PHONE_NUMBER_ID']}/messages"
+    graph_client = tenants.graph_client(tenant)
 
     try:
-        response = requests.post(
-            url, data=data, headers=headers, timeout=10
-        )  # 10 seconds timeout as an example
+        with stage_timer("send"):
+            response = graph_client.send_message(data)
         response.raise_for_status()  # Raises an HTTPError if the HTTP request returned an unsuccessful status code
     except requests.Timeout:
         logging.error("Timeout occurred while sending message")
+        metrics.inc("errors", kind="send_timeout")
         return jsonify({"status": "error", "message": "Request timed out"}), 408
     except (
         requests.RequestException
     ) as e:  # This will catch any general request exception
         logging.error(f"Request failed due to: {e}")
+        metrics.inc("errors", kind="send_failed")
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     else:
         # Process the response as normal
+        metrics.inc("messages_sent")
         log_http_response(response)
         return response
 
 
-def process_text_for_whatsapp(text):
-    # Remove brackets
-    pattern = r"\【.*?\】"
-    # Substitute the pattern with an empty string
-    text = re.sub(pattern, "", text).strip()
+def process_whatsapp_message(body):
+    process_events(iter_events(body))
+
+
+def process_events(events, from_broker=False):
+    """
+    Handle every message event of a parsed webhook payload, in order.
 
-    # Pattern to find double asterisks including the word(s) in between
-    pattern = r"\*\*(.*?)\*\*"
+    Events `from_broker` were deduplicated when they were published, and are
+    answered before this returns (no coalescing, media processed inline), so
+    the broker only acknowledges an event once it has been answered.
+    """
+    for event in events:
+        if isinstance(event, MessageEvent):
+            process_message_event(event, from_broker)
+
+
+def process_message_event(event, from_broker=False):
+    extensions = current_app.extensions
+    accepted, notice = screen_message(
+        event,
+        None if from_broker else extensions.get("dedup"),
+        extensions.get("admission"),
+        extensions["tenants"],
+        extensions.get("media") is not None,
+    )
+    if notice is not None:
+        tenant, reply = notice
+        send_message(get_text_message_input(event.wa_id, reply), tenant)
+    if not accepted:
+        return
 
-    # Replacement pattern with single asterisks
-    replacement = r"*\1*"
+    if from_broker:
+        text = event.text if event.text is not None else media_text(event)
+        if text:
+            respond_to_message(event.wa_id, event.name, text, event.phone_number_id)
+        return
 
-    # Substitute occurrences of the pattern with the replacement
-    whatsapp_style_text = re.sub(pattern, replacement, text)
+    if event.text is None:
+        submit_media(event)
+        return
 
-    return whatsapp_style_text
+    answer_message(event, event.text)
 
 
-def process_whatsapp_message(body):
-    wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-    name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+def answer_message(event, text):
+    # Merge bursts of short messages into one assistant turn
+    coalescer = current_app.extensions.get("coalescer")
+    if coalescer is not None:
+        coalescer.submit(event.wa_id, event.name, text, event.phone_number_id)
+        return
 
-    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
-    message_body = message["text"]["body"]
+    respond_to_message(event.wa_id, event.name, text, event.phone_number_id)
 
-    # TODO: implement custom function here
-    response = generate_response(message_body)
 
-    # OpenAI Integration
-    # response = generate_response(message_body, wa_id, name)
-    # response = process_text_for_whatsapp(response)
+def media_text(event):
+    """
+    Text of a media message, processed on the calling thread, or None.
+    """
+    tenants = current_app.extensions["tenants"]
+    tenant = tenants.get(event.phone_number_id)
+    if tenant is None:
+        logging.warning(f"No tenant configured for phone number ID {event.phone_number_id}")
+        metrics.inc("errors", kind="unknown_tenant")
+        return None
+    text = current_app.extensions["media"].process(
+        event.type, event.media, tenants.graph_client(tenant)
+    )
+    if not text:
+        logging.info(f"No text in {event.type} message {event.id}")
+    return text
+
+
+def submit_media(event):
+    """
+    Hand a media message to the media pipeline. Its text (a transcript,
+    extracted document text or caption) is answered like a typed message once
+    it is ready, so the webhook worker does not wait on the download.
+    """
+    tenants = current_app.extensions["tenants"]
+    tenant = tenants.get(event.phone_number_id)
+    if tenant is None:
+        logging.warning(f"No tenant configured for phone number ID {event.phone_number_id}")
+        metrics.inc("errors", kind="unknown_tenant")
+        return
+    app = current_app._get_current_object()
+
+    def handle(text):
+        if not text:
+            logging.info(f"No text in {event.type} message {event.id}")
+            return
+        with app.app_context():
+            answer_message(event, text)
+
+    media = current_app.extensions["media"]
+    if not media.submit(event.type, event.media, tenants.graph_client(tenant), handle):
+        logging.warning(f"Media pipeline full, dropping {event.type} message {event.id}")
+        metrics.inc("errors", kind="media_busy")
+
+
+def send_streamed_reply(recipient, pieces, tenant=None):
+    """
+    Send a reply that arrives in pieces as a series of WhatsApp messages, each
+    sent as soon as the chunker has a complete sentence or paragraph.
+    """
+    chunker = ReplyChunker(min_length=current_app.config["REPLY_CHUNK_MIN_CHARS"])
+
+    def chunks():
+        for piece in pieces:
+            yield from chunker.feed(piece)
+        yield from chunker.close()
+
+    start = time.perf_counter()
+    first = True
+    for chunk in chunks():
+        with stage_timer("text_processing"):
+            text = process_text_for_whatsapp(chunk, current_app.config["REPLY_MARKDOWN"])
+        if not text:
+            continue
+        if first:
+            metrics.observe("first_chunk_seconds", time.perf_counter() - start)
+            first = False
+        send_message(get_text_message_input(recipient, text), tenant)
+
+
+def respond_to_message(wa_id, name, message_body, phone_number_id=None):
+    # Answer from the business number the message was sent to
+    tenant = current_app.extensions["tenants"].get(phone_number_id)
+    if tenant is None:
+        logging.warning(f"No tenant configured for phone number ID {phone_number_id}")
+        metrics.inc("errors", kind="unknown_tenant")
+        return
+    recipient = wa_id
+    if (
+        current_app.config["RESPONSE_BACKEND"] == "openai"
+        and current_app.config["REPLY_STREAMING"]
+    ):
+        from app.services.openai_service import generate_response_stream
+
+        send_streamed_reply(
+            recipient, generate_response_stream(message_body, wa_id, name, tenant), tenant
+        )
+        return
+
+    if current_app.config["RESPONSE_BACKEND"] == "openai":
+        # OpenAI Integration
+        from app.services.openai_service import generate_response as openai_response
+
+        parts = reply_parts(
+            openai_response(message_body, wa_id, name, tenant),
+            current_app.config["REPLY_MARKDOWN"],
+        )
+    else:
+        # TODO: implement custom function here
+        parts = split_message(generate_response(message_body))
 
-    data = get_text_message_input(current_app.config["RECIPIENT_WAID"], response)
-    send_message(data)
+    # Replies over WhatsApp's length limit go out as several messages
+    for part in parts:
+        send_message(get_text_message_input(recipient, part), tenant)
 
 
 def is_valid_whatsapp_message(body):
     """
-    Check if the incoming webhook event has a valid WhatsApp message structure.
+    Check if the incoming webhook event contains at least one WhatsApp message.
     """
-    return (
-        body.get("object")
-        and body.get("entry")
-        and body["entry"][0].get("changes")
-        and body["entry"][0]["changes"][0].get("value")
-        and body["entry"][0]["changes"][0]["value"].get("messages")
-        and body["entry"][0]["changes"][0]["value"]["messages"][0]
+    return isinstance(body, dict) and bool(body.get("object")) and any(
+        isinstance(event, MessageEvent) for event in iter_events(body)
     )
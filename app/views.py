@@ -1,15 +1,20 @@
 import logging
-import json
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app
 
 from .decorators.security import signature_required
-from .utils.whatsapp_utils import (
-    process_whatsapp_message,
-    is_valid_whatsapp_message,
+from .utils.metrics import component_metrics, metrics
+from .utils.whatsapp_utils import process_events
+from .utils.webhook_pipeline import (
+    NOT_WHATSAPP,
+    STATUS,
+    InvalidWebhook,
+    parse_webhook,
+    record_statuses,
 )
 
 webhook_blueprint = Blueprint("webhook", __name__)
+metrics_blueprint = Blueprint("metrics", __name__)
 
 
 def handle_message():
@@ -26,32 +31,34 @@ def handle_message():
     Returns:
         response: A tuple containing a JSON response and an HTTP status code.
     """
-    body = request.get_json()
-    # logging.info(f"request body: {body}")
-
-    # Check if it's a WhatsApp status update
-    if (
-        body.get("entry", [{}])[0]
-        .get("changes", [{}])[0]
-        .get("value", {})
-        .get("statuses")
-    ):
-        logging.info("Received a WhatsApp status update.")
+    try:
+        kind, events = parse_webhook(request.get_data())
+    except InvalidWebhook as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    record_statuses(current_app.extensions.get("status_metrics"), events)
+
+    if kind == STATUS:
+        metrics.inc("webhooks", kind="status")
+        logging.debug("Received a WhatsApp status update.")
         return jsonify({"status": "ok"}), 200
 
-    try:
-        if is_valid_whatsapp_message(body):
-            process_whatsapp_message(body)
-            return jsonify({"status": "ok"}), 200
-        else:
-            # if the request is not a WhatsApp API event, return an error
-            return (
-                jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
-                404,
-            )
-    except json.JSONDecodeError:
-        logging.error("Failed to decode JSON")
-        return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
+    if kind == NOT_WHATSAPP:
+        # if the request is not a WhatsApp API event, return an error
+        return (
+            jsonify({"status": "error", "message": "Not a WhatsApp API event"}),
+            404,
+        )
+
+    metrics.inc("webhooks", kind="message")
+    webhook_queue = current_app.extensions.get("webhook_queue")
+    if webhook_queue is None:
+        process_events(events)
+    elif not webhook_queue.submit(events):
+        # Queue is full: let Meta retry later instead of blocking
+        metrics.inc("errors", kind="queue_full")
+        return jsonify({"status": "error", "message": "Busy"}), 503
+    return jsonify({"status": "ok"}), 200
 
 
 # Required webhook verifictaion for WhatsApp
@@ -87,3 +94,23 @@ def webhook_post():
     return handle_message()
 
 
+@metrics_blueprint.route("/metrics", methods=["GET"])
+def metrics_get():
+    """
+    Counters, stage timings and component stats in Prometheus text format.
+    Registered only when METRICS_ENABLED is true.
+    """
+    extensions = current_app.extensions
+    gauges = component_metrics(
+        {
+            "ingestion": extensions.get("webhook_queue"),
+            "dedup": extensions.get("dedup"),
+            "admission": extensions.get("admission"),
+            "status": extensions.get("status_metrics"),
+            "coalescer": extensions.get("coalescer"),
+            "outbox": extensions.get("outbox"),
+            "tenants": extensions.get("tenants"),
+            "media": extensions.get("media"),
+        }
+    )
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
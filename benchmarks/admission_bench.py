@@ -0,0 +1,99 @@
+"""
+Benchmark of webhook admission control.
+
+Usage:
+    python -m benchmarks.admission_bench [--seconds 60] [--db admission.db]
+
+First times one admission decision with the in-memory and the SQLite bucket
+store. Then replays `--seconds` of simulated overload against a global limit
+of 5 messages/s: one spammer at 20 messages/s, 40 ongoing conversations at one
+message per 10 s each, and a flash crowd of 15 brand-new senders per second.
+It prints the share of each group's messages that would reach the assistant,
+with and without capacity reserved for ongoing conversations.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from app.services.admission import (
+    ADMITTED,
+    AdmissionController,
+    MemoryBucketStore,
+    SQLiteBucketStore,
+)
+
+TICK = 0.1
+
+
+def time_decisions(store, n):
+    controller = AdmissionController(
+        sender_rate=1e9, sender_burst=1e9, global_rate=1e9, global_burst=1e9, store=store
+    )
+    start = time.perf_counter()
+    for i in range(n):
+        controller.admit(f"3161{i % 5000:07d}")
+    return (time.perf_counter() - start) / n
+
+
+def simulate(seconds, reserved_share):
+    controller = AdmissionController(
+        sender_rate=6 / 60,
+        sender_burst=10,
+        global_rate=5,
+        global_burst=20,
+        reserved_share=reserved_share,
+    )
+    conversations = [f"ongoing-{i}" for i in range(40)]
+    start = 1_000_000.0
+    # Each ongoing conversation was answered a while ago
+    for i, wa_id in enumerate(conversations):
+        controller.admit(wa_id, now=start - 3600 + i)
+    sent = {"spammer": 0, "ongoing": 0, "new": 0}
+    admitted = dict.fromkeys(sent, 0)
+    new_sender = 0
+    for step in range(int(seconds / TICK)):
+        now = start + step * TICK
+        arrivals = [("spammer", "spammer")] * 2
+        # One of the 40 conversations every 0.25 s, so each one every 10 s
+        if step % 2 == 0:
+            wa_id = conversations[(step // 2) % len(conversations)]
+            arrivals.append(("ongoing", wa_id))
+        # Flash crowd of 15 new senders per second
+        for _ in range(15 * (step + 1) // 10 - 15 * step // 10):
+            new_sender += 1
+            arrivals.append(("new", f"new-{new_sender}"))
+        for group, wa_id in arrivals:
+            sent[group] += 1
+            if controller.admit(wa_id, now=now) == ADMITTED:
+                admitted[group] += 1
+    return sent, admitted
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--db", help="SQLite file for the shared store (default: temporary)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = args.db or os.path.join(directory, "admission.db")
+        for label, store, n in (
+            ("memory store", MemoryBucketStore(), 100000),
+            ("sqlite store", SQLiteBucketStore(db), 10000),
+        ):
+            print(f"{label:<13} {time_decisions(store, n) * 1e6:8.2f} us/decision")
+
+    print(f"\n{args.seconds:.0f} s of overload, 5 messages/s global limit")
+    for reserved_share in (0.0, 0.3):
+        sent, admitted = simulate(args.seconds, reserved_share)
+        shares = "  ".join(
+            f"{group} {admitted[group]}/{sent[group]} ({admitted[group] / sent[group]:.0%})"
+            for group in sent
+        )
+        print(f"reserved {reserved_share:.0%}: {shares}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Benchmark of clustered ingestion: throughput, per-conversation ordering and
+failover when a node dies.
+
+Usage:
+    python -m benchmarks.cluster_bench [--nodes 3] [--requests 600] \
+        [--senders 30] [--latency 0.1] [--lease 3] [--kill-after 0.5] \
+        [--server flask]
+
+Starts the fake Graph API and fake OpenAI API from `benchmarks.fakes`, then
+`--nodes` Flask or uvicorn servers with INGESTION_MODE=cluster sharing one
+SQLite broker, dedup database and thread store in a temporary directory. Each
+sender posts its messages one after another to a random node, moving on to
+another node when one does not answer, like Meta retrying. Once `--kill-after`
+of the requests are acknowledged the first node is killed with SIGKILL, so its
+partitions are only taken over when their leases expire after `--lease` seconds.
+
+Reports acknowledged requests/sec, reply latency (the maximum shows the
+failover stall), and replies missing, duplicated or out of order per sender.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.fakes import FakeGraphAPI, FakeOpenAI
+from benchmarks.load_test import FLASK, UVICORN, percentile, wait_until_up
+from benchmarks.payloads import message_payload, sign
+
+APP_SECRET = "cluster-secret"
+GRAPH_PORT = 8907
+OPENAI_PORT = 8908
+NODE_PORT = 8930
+_MARKER = re.compile(r"#(\d+)")
+
+SERVERS = {"flask": FLASK, "asgi": UVICORN}
+
+
+def node_env(workdir, args):
+    return dict(
+        os.environ,
+        APP_SECRET=APP_SECRET,
+        ACCESS_TOKEN="cluster",
+        VERSION="v18.0",
+        PHONE_NUMBER_ID="1234",
+        VERIFY_TOKEN="cluster",
+        RESPONSE_BACKEND="openai",
+        GRAPH_API_BASE_URL=f"http://127.0.0.1:{GRAPH_PORT}",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{OPENAI_PORT}/v1",
+        OPENAI_API_KEY="cluster",
+        OPENAI_ASSISTANT_ID="asst_cluster",
+        INGESTION_MODE="cluster",
+        BROKER_URL=f"sqlite:///{workdir}/broker.db",
+        BROKER_PARTITIONS=str(args.partitions),
+        BROKER_CONSUMERS=str(args.consumers),
+        BROKER_LEASE_SECONDS=str(args.lease),
+        DEDUP_DB_PATH=f"{workdir}/dedup.db",
+        THREAD_STORE_URL=f"sqlite:///{workdir}/threads.db",
+    )
+
+
+async def fire(urls, killed, args, on_progress):
+    sent_at, errors = {}, 0
+    acknowledged = 0
+
+    async with aiohttp.ClientSession() as session:
+
+        async def post(i, wa_id):
+            nonlocal errors
+            raw, headers = sign(message_payload(i, wa_id=wa_id), APP_SECRET)
+            while True:
+                url = random.choice([u for u in urls if u not in killed])
+                try:
+                    async with session.post(url, data=raw, headers=headers) as response:
+                        await response.read()
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                errors += 1
+                await asyncio.sleep(0.05)
+
+        async def sender(s):
+            nonlocal acknowledged
+            wa_id = f"3161234{s:04d}"
+            # One message at a time, so the sender's order is the publish order
+            for i in range(s, args.requests, args.senders):
+                sent_at[i] = time.monotonic()
+                await post(i, wa_id)
+                acknowledged += 1
+                on_progress(acknowledged)
+
+        start = time.monotonic()
+        await asyncio.gather(*(sender(s) for s in range(args.senders)))
+        elapsed = time.monotonic() - start
+    return sent_at, errors, elapsed
+
+
+def check_replies(graph, sent_at, args):
+    latencies, seen, duplicates, out_of_order = [], set(), 0, 0
+    last = {}
+    for received_at, data in graph.received:
+        match = _MARKER.search(data.get("text", {}).get("body", ""))
+        if not match or int(match.group(1)) not in sent_at:
+            continue
+        i = int(match.group(1))
+        if i in seen:
+            duplicates += 1
+            continue
+        seen.add(i)
+        latencies.append(received_at - sent_at[i])
+        sender = i % args.senders
+        if i < last.get(sender, -1):
+            out_of_order += 1
+        last[sender] = max(i, last.get(sender, -1))
+    return latencies, args.requests - len(seen), duplicates, out_of_order
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--senders", type=int, default=30)
+    parser.add_argument("--partitions", type=int, default=32)
+    parser.add_argument("--consumers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--lease", type=float, default=3)
+    parser.add_argument("--kill-after", type=float, default=0.5)
+    parser.add_argument("--reply-timeout", type=float, default=60)
+    parser.add_argument("--server", choices=SERVERS, default="flask")
+    args = parser.parse_args()
+
+    graph = FakeGraphAPI(latency=args.latency / 4)
+    openai = FakeOpenAI(latency=args.latency)
+    await graph.start(GRAPH_PORT)
+    await openai.start(OPENAI_PORT)
+    processes, killed = [], set()
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            urls = []
+            for n in range(args.nodes):
+                port = NODE_PORT + n
+                command = [part.format(port=port) for part in SERVERS[args.server]]
+                processes.append(
+                    subprocess.Popen(
+                        command,
+                        env=node_env(workdir, args),
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    )
+                )
+                urls.append(f"http://127.0.0.1:{port}/webhook")
+            for url in urls:
+                await wait_until_up(url)
+            # Let the consumers heartbeat and split the partitions
+            await asyncio.sleep(args.lease)
+
+            kill_at = int(args.requests * args.kill_after) if args.nodes > 1 else -1
+            killed_at = None
+
+            def on_progress(acknowledged):
+                nonlocal killed_at
+                if acknowledged == kill_at:
+                    processes[0].kill()
+                    killed.add(urls[0])
+                    killed_at = time.monotonic()
+
+            sent_at, errors, elapsed = await fire(urls, killed, args, on_progress)
+            deadline = time.monotonic() + args.reply_timeout
+            while len(graph.received) < args.requests and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            # Give late duplicates a moment to show up
+            await asyncio.sleep(args.lease)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+            await graph.stop()
+            await openai.stop()
+
+    latencies, missing, duplicates, out_of_order = check_replies(graph, sent_at, args)
+    print(
+        f"{args.nodes} {args.server} nodes, {args.partitions} partitions, "
+        f"{args.consumers} consumers per node, lease {args.lease:g} s"
+    )
+    print(f"acknowledged     {args.requests / elapsed:7.1f} req/s  ({errors} retried posts)")
+    print(
+        f"reply latency    p50 {percentile(latencies, 0.5) * 1000:7.1f}"
+        f"  p99 {percentile(latencies, 0.99) * 1000:7.1f}"
+        f"  max {max(latencies, default=float('nan')) * 1000:7.1f} ms"
+    )
+    if killed_at is not None:
+        print(f"node 0 killed    after {kill_at} acknowledged requests")
+    print(
+        f"replies          {args.requests - missing}/{args.requests}"
+        f"  missing {missing}  duplicates {duplicates}  out of order {out_of_order}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
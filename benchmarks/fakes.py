@@ -0,0 +1,333 @@
+"""
+Local stand-ins for the Meta Graph API and the OpenAI Assistants API.
+
+Usage (standalone):
+    python -m benchmarks.fakes --graph-port 8901 --openai-port 8902 --latency 0.2
+
+Point the app at them with GRAPH_API_BASE_URL=http://127.0.0.1:8901 and
+OPENAI_BASE_URL=http://127.0.0.1:8902/v1. Both servers add `latency` seconds
+to every call (plus up to `jitter`) and fail a fraction `error_rate` of calls
+with a 500, so retry paths get exercised too.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeServer:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+    async def _delay(self, scale=1.0):
+        await asyncio.sleep((self.latency + random.uniform(0, self.jitter)) * scale)
+
+    def _should_fail(self):
+        self.requests += 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def routes(self, app):
+        raise NotImplementedError
+
+    async def start(self, port, host="127.0.0.1"):
+        app = web.Application()
+        self.routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeGraphAPI(FakeServer):
+    """
+    Accepts outbound messages and records when each one arrived, so a load test
+    can measure end-to-end reply latency. Serves inbound media added with
+    `add_media`: the media URL lookup and a chunked download.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.received = []  # (monotonic time, request JSON)
+        self.media = {}  # media ID -> (content, MIME type)
+        self.media_downloads = 0
+        self._ids = itertools.count()
+        self._base_url = None
+
+    def routes(self, app):
+        app.router.add_post("/{version}/{phone_number_id}/messages", self.messages)
+        app.router.add_get("/media/{media_id}", self.download_media)
+        app.router.add_get("/{version}/{media_id}", self.get_media)
+
+    async def start(self, port, host="127.0.0.1"):
+        self._base_url = f"http://{host}:{port}"
+        await super().start(port, host)
+
+    def add_media(self, media_id, content, mime_type):
+        self.media[media_id] = (content, mime_type)
+
+    async def get_media(self, request):
+        media_id = request.match_info["media_id"]
+        if media_id not in self.media:
+            return web.json_response({"error": {"message": "Unknown media"}}, status=404)
+        content, mime_type = self.media[media_id]
+        return web.json_response(
+            {
+                "messaging_product": "whatsapp",
+                "url": f"{self._base_url}/media/{media_id}",
+                "mime_type": mime_type,
+                "sha256": hashlib.sha256(content).hexdigest(),
+                "file_size": len(content),
+                "id": media_id,
+            }
+        )
+
+    async def download_media(self, request):
+        content, mime_type = self.media[request.match_info["media_id"]]
+        await self._delay()
+        self.media_downloads += 1
+        response = web.StreamResponse(headers={"Content-Type": mime_type})
+        await response.prepare(request)
+        for start in range(0, len(content), 64 * 1024):
+            await response.write(content[start : start + 64 * 1024])
+        await response.write_eof()
+        return response
+
+    async def messages(self, request):
+        data = await request.json()
+        await self._delay()
+        if self._should_fail():
+            return web.json_response({"error": {"message": "Fake failure"}}, status=500)
+        self.received.append((time.monotonic(), data))
+        return web.json_response(
+            {
+                "messaging_product": "whatsapp",
+                "contacts": [{"input": data.get("to"), "wa_id": data.get("to")}],
+                "messages": [{"id": f"wamid.fake.{next(self._ids)}"}],
+            }
+        )
+
+
+class FakeOpenAI(FakeServer):
+    """
+    Minimal Assistants API: threads, messages and runs, polled or streamed.
+    A run takes `latency` seconds and answers "Answer: <last user message>".
+    Chat completions answer the same way, optionally streamed, and record the
+    size of each prompt in `chat_prompt_chars`.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.threads = {}
+        self.runs = {}
+        self.chat_prompt_chars = []
+        self._ids = itertools.count()
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids)}"
+
+    def routes(self, app):
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run)
+        app.router.add_post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run)
+        app.router.add_post("/v1/chat/completions", self.chat_completion)
+
+    def _message(self, thread_id, role, text):
+        return {
+            "id": self._id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "status": "completed",
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "attachments": [],
+            "metadata": {},
+        }
+
+    def _run(self, run_id, thread_id, assistant_id, status):
+        return {
+            "id": run_id,
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": status,
+            "model": "fake-model",
+            "instructions": "",
+            "tools": [],
+            "metadata": {},
+            "parallel_tool_calls": True,
+        }
+
+    def _answer(self, thread_id):
+        messages = self.threads.get(thread_id, [])
+        last = next((m for m in reversed(messages) if m["role"] == "user"), None)
+        question = last["content"][0]["text"]["value"] if last else ""
+        return f"Answer: {question}"
+
+    async def create_thread(self, request):
+        if self._should_fail():
+            return web.json_response({"error": {"message": "Fake failure"}}, status=500)
+        thread_id = self._id("thread")
+        self.threads[thread_id] = []
+        return web.json_response(
+            {"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}}
+        )
+
+    async def create_message(self, request):
+        thread_id = request.match_info["thread_id"]
+        data = await request.json()
+        message = self._message(thread_id, "user", data["content"])
+        self.threads.setdefault(thread_id, []).append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request):
+        thread_id = request.match_info["thread_id"]
+        data = list(reversed(self.threads.get(thread_id, [])))
+        limit = int(request.query.get("limit", 20))
+        return web.json_response({"object": "list", "data": data[:limit], "has_more": False})
+
+    async def create_run(self, request):
+        thread_id = request.match_info["thread_id"]
+        data = await request.json()
+        if self._should_fail():
+            return web.json_response({"error": {"message": "Fake failure"}}, status=500)
+        run_id = self._id("run")
+        assistant_id = data.get("assistant_id")
+        finishes_at = time.monotonic() + self.latency + random.uniform(0, self.jitter)
+        self.runs[run_id] = (thread_id, assistant_id, finishes_at)
+        if not data.get("stream"):
+            return web.json_response(self._run(run_id, thread_id, assistant_id, "queued"))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def emit(event, payload):
+            await response.write(f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode())
+
+        await emit("thread.run.created", self._run(run_id, thread_id, assistant_id, "queued"))
+        await emit("thread.run.in_progress", self._run(run_id, thread_id, assistant_id, "in_progress"))
+        answer = self._answer(thread_id)
+        message = self._message(thread_id, "assistant", answer)
+        created = dict(message, status="in_progress", content=[])
+        await emit("thread.message.created", created)
+        # Stream the answer word by word over the run's duration
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(max(0.0, finishes_at - time.monotonic()) / (len(words) - i))
+            delta = {
+                "id": message["id"],
+                "object": "thread.message.delta",
+                "delta": {
+                    "content": [
+                        {"index": 0, "type": "text", "text": {"value": word if i == 0 else f" {word}"}}
+                    ]
+                },
+            }
+            await emit("thread.message.delta", delta)
+        self.threads[thread_id].append(message)
+        await emit("thread.message.completed", message)
+        await emit("thread.run.completed", self._run(run_id, thread_id, assistant_id, "completed"))
+        await response.write(b"event: done\ndata: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def retrieve_run(self, request):
+        run_id = request.match_info["run_id"]
+        thread_id, assistant_id, finishes_at = self.runs[run_id]
+        if time.monotonic() < finishes_at:
+            return web.json_response(self._run(run_id, thread_id, assistant_id, "in_progress"))
+        if not any(m["role"] == "assistant" and m.get("run_id") == run_id for m in self.threads[thread_id]):
+            message = self._message(thread_id, "assistant", self._answer(thread_id))
+            message["run_id"] = run_id
+            self.threads[thread_id].append(message)
+        return web.json_response(self._run(run_id, thread_id, assistant_id, "completed"))
+
+    async def cancel_run(self, request):
+        run_id = request.match_info["run_id"]
+        thread_id, assistant_id, _ = self.runs[run_id]
+        return web.json_response(self._run(run_id, thread_id, assistant_id, "cancelled"))
+
+    async def chat_completion(self, request):
+        data = await request.json()
+        await self._delay()
+        if self._should_fail():
+            return web.json_response({"error": {"message": "Fake failure"}}, status=500)
+        self.chat_prompt_chars.append(sum(len(m["content"]) for m in data["messages"]))
+        answer = f"Answer: {data['messages'][-1]['content']}"
+        if data.get("max_tokens"):
+            answer = " ".join(answer.split(" ")[: data["max_tokens"]])
+        completion = {
+            "id": self._id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", "fake-model"),
+        }
+        if not data.get("stream"):
+            completion["choices"] = [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": answer},
+                }
+            ]
+            return web.json_response(completion)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        completion["object"] = "chat.completion.chunk"
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            chunk = dict(
+                completion,
+                choices=[
+                    {
+                        "index": 0,
+                        "finish_reason": "stop" if i == len(words) - 1 else None,
+                        "delta": {"content": word if i == 0 else f" {word}"},
+                    }
+                ],
+            )
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+async def serve(args):
+    graph = FakeGraphAPI(latency=args.latency, error_rate=args.error_rate)
+    openai = FakeOpenAI(latency=args.latency, error_rate=args.error_rate)
+    await graph.start(args.graph_port)
+    await openai.start(args.openai_port)
+    print(f"Fake Graph API on http://127.0.0.1:{args.graph_port}")
+    print(f"Fake OpenAI API on http://127.0.0.1:{args.openai_port}/v1")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--graph-port", type=int, default=8901)
+    parser.add_argument("--openai-port", type=int, default=8902)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,97 @@
+"""
+Benchmark and golden-output check for the WhatsApp formatter.
+
+Usage:
+    python -m benchmarks.formatter_bench [--iterations 20000] [--update]
+
+Every `benchmarks/formatter_corpus/*.md` is a reply as the assistant writes it,
+and the matching `.txt` is the expected WhatsApp text. The run fails if any
+output differs from its golden file; `--update` rewrites the golden files
+after a deliberate change. `format_basic`, the REPLY_MARKDOWN=false fallback,
+must give exactly the output of the old two-pass `re.sub` version, which only
+handled citations and **bold**. It then times all three. The same checks run
+as tests in tests/test_whatsapp_formatter.py.
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+from app.utils.whatsapp_formatter import format_and_split, format_basic, format_for_whatsapp
+
+CORPUS = Path(__file__).parent / "formatter_corpus"
+
+
+def legacy_process_text_for_whatsapp(text):
+    pattern = r"\【.*?\】"
+    text = re.sub(pattern, "", text).strip()
+    pattern = r"\*\*(.*?)\*\*"
+    replacement = r"*\1*"
+    return re.sub(pattern, replacement, text)
+
+
+def check_golden(update=False):
+    failures = 0
+    for source in sorted(CORPUS.glob("*.md")):
+        golden = source.with_suffix(".txt")
+        output = format_for_whatsapp(source.read_text(encoding="utf-8")) + "\n"
+        if update:
+            golden.write_text(output, encoding="utf-8")
+        elif not golden.exists() or golden.read_text(encoding="utf-8") != output:
+            failures += 1
+            print(f"MISMATCH {source.name}:\n{output}")
+    return failures
+
+
+def check_basic(texts):
+    failures = 0
+    for text in texts:
+        if format_basic(text) != legacy_process_text_for_whatsapp(text):
+            failures += 1
+            print(f"BASIC MISMATCH:\n{format_basic(text)}")
+    return failures
+
+
+def check_split():
+    text = " ".join(f"Sentence number {i} about the apartment." for i in range(400))
+    parts = format_and_split(text)
+    assert all(len(part) <= 4096 for part in parts), "part over the length limit"
+    assert " ".join(parts) == text, "splitting lost or changed text"
+    return len(parts)
+
+
+def bench(function, texts, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            function(text)
+    return (time.perf_counter() - start) / (iterations * len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--update", action="store_true")
+    args = parser.parse_args()
+
+    failures = check_golden(args.update)
+    texts = [path.read_text(encoding="utf-8") for path in sorted(CORPUS.glob("*.md"))]
+    print(f"golden outputs: {len(texts) - failures}/{len(texts)} match")
+    basic_failures = check_basic(texts)
+    print(f"basic outputs: {len(texts) - basic_failures}/{len(texts)} match the old version")
+    print(f"split check: {check_split()} messages, all within 4096 chars")
+
+    legacy = bench(legacy_process_text_for_whatsapp, texts, args.iterations)
+    basic = bench(format_basic, texts, args.iterations)
+    markdown = bench(format_for_whatsapp, texts, args.iterations)
+    print(f"legacy two-pass re.sub   {legacy * 1e6:7.2f} us/reply")
+    print(f"format_basic             {basic * 1e6:7.2f} us/reply")
+    print(f"format_for_whatsapp      {markdown * 1e6:7.2f} us/reply")
+    if failures or basic_failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
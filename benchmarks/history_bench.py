@@ -0,0 +1,76 @@
+"""
+Benchmark of the budgeted conversation history against an ever-growing thread.
+
+Usage:
+    python -m benchmarks.history_bench [--turns 1000] [--budget 3000]
+
+Plays one long guest conversation through `ConversationHistory` with a local
+summarizer that keeps the last words of the previous summary and new turns, so
+no API is needed. At checkpoints it prints the prompt tokens a full thread
+would send next to the budgeted context, and the time to record a turn and
+build the next context from SQLite.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from app.services.conversation_history import (
+    ConversationHistory,
+    HistoryStore,
+    estimate_tokens,
+)
+
+QUESTION = "Turn {i}: could you remind me how the heating works and where the spare keys are?"
+ANSWER = (
+    "The thermostat is in the hallway next to the front door; turn the dial to 20 "
+    "degrees and give it half an hour. The spare keys are in the lockbox by the "
+    "mailboxes, code 4512."
+)
+
+
+def local_summarizer(words):
+    def summarize(summary, turns):
+        text = " ".join([summary] + [content for _, content in turns])
+        return " ".join(text.split()[-words:])
+
+    return summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--budget", type=int, default=3000)
+    args = parser.parse_args()
+    checkpoints = {10, 50, 100, 500, args.turns}
+
+    with tempfile.TemporaryDirectory() as directory:
+        history = ConversationHistory(
+            HistoryStore(os.path.join(directory, "history.db")),
+            local_summarizer(args.budget // 5),
+            budget_tokens=args.budget,
+        )
+        full_tokens = 0
+        print(f"{'turn':>6} {'full thread':>12} {'budgeted':>9} {'record+context':>15}")
+        for i in range(1, args.turns + 1):
+            question = QUESTION.format(i=i)
+            start = time.perf_counter()
+            summary, turns = history.context("31612345678")
+            history.record("31612345678", question, ANSWER)
+            elapsed = time.perf_counter() - start
+            budgeted = estimate_tokens(summary) + sum(
+                estimate_tokens(content) for _, content in turns
+            )
+            full_tokens += estimate_tokens(question) + estimate_tokens(ANSWER)
+            if i in checkpoints:
+                # Let the background summary land so checkpoints are comparable
+                while history.metrics()["summaries_pending"]:
+                    time.sleep(0.001)
+                print(f"{i:>6} {full_tokens:>12} {budgeted:>9} {elapsed * 1e3:>12.2f} ms")
+        history.shutdown()
+        print(history.metrics())
+
+
+if __name__ == "__main__":
+    main()
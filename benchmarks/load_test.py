@@ -0,0 +1,191 @@
+"""
+Offline load test of the webhook: throughput and end-to-end reply latency.
+
+Usage:
+    python -m benchmarks.load_test [--requests 500] [--concurrency 50] \
+        [--latency 0.2] [--error-rate 0.0] [--modes flask-sync,asgi-queue]
+
+Starts the fake Graph API and fake OpenAI Assistants API from
+`benchmarks.fakes`, then runs each server mode as a subprocess pointed at them
+with RESPONSE_BACKEND=openai, and fires correctly signed webhook POSTs. For each
+mode it reports acknowledged requests/sec, webhook ack latency, and end-to-end
+reply latency: from the POST being sent to the reply reaching the fake Graph API.
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from benchmarks.fakes import FakeGraphAPI, FakeOpenAI
+from benchmarks.payloads import message_payload, sign
+
+APP_SECRET = "load-test-secret"
+GRAPH_PORT = 8901
+OPENAI_PORT = 8902
+_MARKER = re.compile(r"#(\d+)")
+
+FLASK = [
+    sys.executable,
+    "-c",
+    "from app import create_app; create_app().run(port={port}, threaded=True)",
+]
+UVICORN = [
+    sys.executable,
+    "-m",
+    "uvicorn",
+    "--factory",
+    "app.asgi:create_asgi_app",
+    "--port",
+    "{port}",
+    "--log-level",
+    "warning",
+]
+
+MODES = {
+    "flask-sync": (FLASK, {"INGESTION_MODE": "sync"}),
+    "flask-queue": (FLASK, {"INGESTION_MODE": "queue", "INGESTION_WORKERS": "32"}),
+    "asgi-sync": (UVICORN, {"INGESTION_MODE": "sync"}),
+    "asgi-queue": (UVICORN, {"INGESTION_MODE": "queue"}),
+}
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def wait_until_up(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+async def fire(url, total, concurrency, senders):
+    sent_at, ack_latencies, errors = {}, [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def one(i):
+            nonlocal errors
+            raw, headers = sign(message_payload(i, wa_id=f"3161234{i % senders:04d}"), APP_SECRET)
+            async with semaphore:
+                start = time.monotonic()
+                sent_at[i] = start
+                try:
+                    async with session.post(url, data=raw, headers=headers) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                ack_latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.monotonic() - start
+    return sent_at, ack_latencies, errors, elapsed
+
+
+async def wait_for_replies(graph, total, timeout):
+    deadline = time.monotonic() + timeout
+    while len(graph.received) < total and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+
+
+def server_env(extra):
+    env = dict(os.environ)
+    env.update(
+        APP_SECRET=APP_SECRET,
+        ACCESS_TOKEN="load-test-token",
+        VERSION="v18.0",
+        PHONE_NUMBER_ID="1234",
+        RECIPIENT_WAID="31612345678",
+        VERIFY_TOKEN="load-test",
+        RESPONSE_BACKEND="openai",
+        GRAPH_API_BASE_URL=f"http://127.0.0.1:{GRAPH_PORT}",
+        GRAPH_POOL_SIZE="100",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{OPENAI_PORT}/v1",
+        OPENAI_API_KEY="load-test-key",
+        OPENAI_ASSISTANT_ID="asst_load_test",
+        THREAD_STORE_URL="memory://",
+    )
+    env.update(extra)
+    return env
+
+
+async def run_mode(name, port, graph, args):
+    command, extra = MODES[name]
+    command = [part.format(port=port) for part in command]
+    process = subprocess.Popen(
+        command,
+        env=server_env(extra),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    graph.received.clear()
+    try:
+        url = f"http://127.0.0.1:{port}/webhook"
+        await wait_until_up(url)
+        sent_at, acks, errors, elapsed = await fire(
+            url, args.requests, args.concurrency, args.senders
+        )
+        await wait_for_replies(graph, args.requests, args.reply_timeout)
+    finally:
+        process.terminate()
+        process.wait()
+
+    replies = []
+    for received_at, data in graph.received:
+        match = _MARKER.search(data.get("text", {}).get("body", ""))
+        if match and int(match.group(1)) in sent_at:
+            replies.append(received_at - sent_at[int(match.group(1))])
+    print(
+        f"{name:<12} {args.requests / elapsed:7.1f} req/s"
+        f"  ack p50 {percentile(acks, 0.5) * 1000:7.1f} ms"
+        f" | reply p50 {percentile(replies, 0.5) * 1000:7.1f}"
+        f"  p95 {percentile(replies, 0.95) * 1000:7.1f}"
+        f"  p99 {percentile(replies, 0.99) * 1000:7.1f} ms"
+        f" | replies {len(replies)}/{args.requests}  errors {errors}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--senders", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reply-timeout", type=float, default=60)
+    parser.add_argument("--modes", default=",".join(MODES))
+    args = parser.parse_args()
+
+    graph = FakeGraphAPI(latency=args.latency / 4, error_rate=args.error_rate)
+    openai = FakeOpenAI(latency=args.latency, error_rate=args.error_rate)
+    await graph.start(GRAPH_PORT)
+    await openai.start(OPENAI_PORT)
+    try:
+        for offset, name in enumerate(args.modes.split(",")):
+            await run_mode(name, 8910 + offset, graph, args)
+    finally:
+        await graph.stop()
+        await openai.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
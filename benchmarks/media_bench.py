@@ -0,0 +1,97 @@
+"""
+Benchmark of the inbound media pipeline against the fake Graph API.
+
+Usage:
+    python -m benchmarks.media_bench [--size-mb 20] [--deliveries 16]
+
+Downloads one `--size-mb` file through `MediaPipeline.fetch` and reports the
+time and peak Python heap (tracemalloc) next to a buffered `response.content`
+download of the same file. It then redelivers the media and sends
+`--deliveries` concurrent deliveries of a new media ID to check that each file
+is fetched from the fake Graph API only once.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from app.services.graph_client import GraphAPIClient
+from app.services.media import MediaPipeline
+from benchmarks.fakes import FakeGraphAPI
+
+GRAPH_PORT = 8903
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--deliveries", type=int, default=16)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    graph = FakeGraphAPI()
+    asyncio.run_coroutine_threadsafe(graph.start(GRAPH_PORT), loop).result()
+    content = os.urandom(args.size_mb * 1024 * 1024)
+    graph.add_media("bench-1", content, "application/pdf")
+    graph.add_media("bench-2", content[::-1], "application/pdf")
+
+    client = GraphAPIClient(
+        access_token="bench",
+        phone_number_id="1234",
+        version="v18.0",
+        base_url=f"http://127.0.0.1:{GRAPH_PORT}",
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        pipeline = MediaPipeline(
+            cache_dir, processors={}, workers=1, max_bytes=len(content) + 1
+        )
+        media = {"id": "bench-1", "mime_type": "application/pdf"}
+
+        def buffered():
+            url = client.get_media("bench-1").json()["url"]
+            return len(client.request("GET", url).content)
+
+        _, buffered_time, buffered_peak = measure(buffered)
+        _, stream_time, stream_peak = measure(lambda: pipeline.fetch(media, client))
+        _, hit_time, _ = measure(lambda: pipeline.fetch(media, client))
+        for label, elapsed, peak in (
+            ("buffered download", buffered_time, buffered_peak),
+            ("streamed fetch", stream_time, stream_peak),
+        ):
+            print(f"{label:<18} {elapsed * 1e3:8.1f} ms  peak heap {peak / 2**20:7.2f} MiB")
+        print(f"{'cached refetch':<18} {hit_time * 1e3:8.3f} ms  ({args.size_mb} MiB file)")
+
+        downloads = graph.media_downloads
+        duplicate = {"id": "bench-2", "mime_type": "application/pdf"}
+        with concurrent.futures.ThreadPoolExecutor(args.deliveries) as executor:
+            paths = set(
+                executor.map(
+                    lambda _: pipeline.fetch(duplicate, client), range(args.deliveries)
+                )
+            )
+        print(
+            f"{args.deliveries} concurrent deliveries: "
+            f"{graph.media_downloads - downloads} download, {len(paths)} cached file"
+        )
+        pipeline.shutdown()
+    asyncio.run_coroutine_threadsafe(graph.stop(), loop).result()
+
+
+if __name__ == "__main__":
+    main()
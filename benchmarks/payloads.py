@@ -0,0 +1,66 @@
+"""
+Generator of correctly signed WhatsApp webhook payloads.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+
+
+def message_payload(i, wa_id="31612345678", text=None, phone_number_id="1234"):
+    """
+    A single-message webhook body. The text carries a `#<i>` marker so replies
+    can be matched back to the request that caused them.
+    """
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "id": "1",
+                "changes": [
+                    {
+                        "field": "messages",
+                        "value": {
+                            "messaging_product": "whatsapp",
+                            "metadata": {
+                                "display_phone_number": "15550000000",
+                                "phone_number_id": phone_number_id,
+                            },
+                            "contacts": [{"profile": {"name": "Guest"}, "wa_id": wa_id}],
+                            "messages": [
+                                {
+                                    "from": wa_id,
+                                    "id": f"wamid.bench.{time.time_ns()}.{i}",
+                                    "timestamp": str(int(time.time())),
+                                    "text": {"body": text or f"What's the check in time? #{i}"},
+                                    "type": "text",
+                                }
+                            ],
+                        },
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def media_payload(i, media, message_type="audio", wa_id="31612345678", phone_number_id="1234"):
+    """
+    A single media message webhook body; `media` is the {"id", "mime_type", ...} object.
+    """
+    body = message_payload(i, wa_id, phone_number_id=phone_number_id)
+    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+    del message["text"]
+    message["type"] = message_type
+    message[message_type] = media
+    return body
+
+
+def sign(body, app_secret):
+    """
+    Serialise `body` and return (raw bytes, headers) as Meta would send them.
+    """
+    raw = json.dumps(body).encode("utf-8")
+    signature = hmac.new(app_secret.encode("latin-1"), raw, hashlib.sha256).hexdigest()
+    return raw, {"X-Hub-Signature-256": f"sha256={signature}", "Content-Type": "application/json"}
@@ -0,0 +1,54 @@
+"""
+Webhook signature verification cost for payloads from 1KB to 1MB: the old
+decode/re-encode path against hashing the raw bytes with a precomputed key.
+
+Usage:
+    python -m benchmarks.signature_bench [--iterations 2000]
+"""
+
+import argparse
+import hashlib
+import hmac
+import os
+import timeit
+
+from flask import Flask
+
+from app.decorators.security import validate_signature
+
+SECRET = "benchmark-app-secret"
+
+
+def old_validate(raw, signature):
+    payload = raw.decode("utf-8")
+    expected = hmac.new(
+        bytes(SECRET, "latin-1"), msg=payload.encode("utf-8"), digestmod=hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["APP_SECRET"] = SECRET
+    app.config["PREVIOUS_APP_SECRETS"] = []
+
+    with app.app_context():
+        for size in (1 << 10, 16 << 10, 256 << 10, 1 << 20):
+            raw = os.urandom(size // 2).hex().encode("utf-8")
+            signature = hmac.new(SECRET.encode(), raw, hashlib.sha256).hexdigest()
+            assert old_validate(raw, signature) and validate_signature(raw, signature)
+            iterations = max(10, args.iterations * 1024 // size)
+            old = timeit.timeit(lambda: old_validate(raw, signature), number=iterations)
+            new = timeit.timeit(lambda: validate_signature(raw, signature), number=iterations)
+            print(
+                f"{size // 1024:>5} KB  decode/encode {old / iterations * 1e6:9.1f} us"
+                f"  raw bytes {new / iterations * 1e6:9.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark of worker cold start: app factory time, memory and first request.
+
+Usage:
+    python -m benchmarks.startup_bench [--runs 5] [--backend openai]
+
+Starts the fake Graph API and fake OpenAI API from `benchmarks.fakes`, then
+launches `--runs` fresh interpreters. Each one times `import app` and
+`create_app()`, reads its resident memory (VmRSS) after the factory and after
+the first request, and times the first and second signed webhook POSTs through
+the Flask test client with RESPONSE_BACKEND=`--backend`. Medians are reported.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+
+from benchmarks.fakes import FakeGraphAPI, FakeOpenAI
+
+APP_SECRET = "startup-secret"
+GRAPH_PORT = 8905
+OPENAI_PORT = 8906
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+
+
+def rss_mib():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+rss_app = rss_mib()
+from benchmarks.payloads import message_payload, sign
+
+client = flask_app.test_client()
+requests = []
+for i in range(2):
+    raw, headers = sign(message_payload(i, "31612345678", "What's the wifi password?"), {secret!r})
+    before = time.perf_counter()
+    assert client.post("/webhook", data=raw, headers=headers).status_code == 200
+    requests.append(time.perf_counter() - before)
+print(json.dumps({{
+    "import_app": imported - start,
+    "create_app": created - imported,
+    "rss_after_create_app": rss_app,
+    "first_request": requests[0],
+    "second_request": requests[1],
+    "rss_after_first_request": rss_mib(),
+}}))
+"""
+
+
+def run_child(backend):
+    env = dict(
+        os.environ,
+        APP_SECRET=APP_SECRET,
+        ACCESS_TOKEN="startup",
+        PHONE_NUMBER_ID="1234",
+        VERSION="v18.0",
+        RESPONSE_BACKEND=backend,
+        GRAPH_API_BASE_URL=f"http://127.0.0.1:{GRAPH_PORT}",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{OPENAI_PORT}/v1",
+        OPENAI_API_KEY="startup",
+        OPENAI_ASSISTANT_ID="asst_startup",
+        THREAD_STORE_URL="memory://",
+        DEDUP_ENABLED="false",
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(secret=APP_SECRET)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", choices=["echo", "openai"], default="openai")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    graph, openai = FakeGraphAPI(), FakeOpenAI()
+    asyncio.run_coroutine_threadsafe(graph.start(GRAPH_PORT), loop).result()
+    asyncio.run_coroutine_threadsafe(openai.start(OPENAI_PORT), loop).result()
+
+    runs = [run_child(args.backend) for _ in range(args.runs)]
+    print(f"{args.runs} cold starts, RESPONSE_BACKEND={args.backend} (medians)")
+    for key in runs[0]:
+        value = statistics.median(run[key] for run in runs)
+        if key.startswith("rss"):
+            print(f"{key:<24} {value:8.1f} MiB")
+        else:
+            print(f"{key:<24} {value * 1e3:8.1f} ms")
+
+    asyncio.run_coroutine_threadsafe(graph.stop(), loop).result()
+    asyncio.run_coroutine_threadsafe(openai.stop(), loop).result()
+
+
+if __name__ == "__main__":
+    main()
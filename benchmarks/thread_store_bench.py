@@ -0,0 +1,61 @@
+"""
+Lookup latency of the thread stores against the old per-call shelve.open.
+
+Usage:
+    python -m benchmarks.thread_store_bench [--keys 1000] [--lookups 5000]
+"""
+
+import argparse
+import os
+import random
+import shelve
+import tempfile
+import time
+
+from app.services.thread_store import (
+    CachedThreadStore,
+    SQLiteThreadStore,
+    migrate_from_shelve,
+)
+
+
+def shelve_lookup(path):
+    def get(wa_id):
+        with shelve.open(path) as shelf:
+            return shelf.get(wa_id, None)
+
+    return get
+
+
+def bench(name, get, keys, lookups):
+    start = time.perf_counter()
+    for _ in range(lookups):
+        get(random.choice(keys))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<22} {elapsed / lookups * 1e6:>9.1f} us/lookup")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    args = parser.parse_args()
+
+    keys = [f"3161234{i:05d}" for i in range(args.keys)]
+    with tempfile.TemporaryDirectory() as tmp:
+        shelf_path = os.path.join(tmp, "threads_db")
+        with shelve.open(shelf_path) as shelf:
+            for wa_id in keys:
+                shelf[wa_id] = f"thread_{wa_id}"
+
+        sqlite_store = SQLiteThreadStore(os.path.join(tmp, "threads.db"))
+        migrate_from_shelve(shelf_path, sqlite_store)
+        cached_store = CachedThreadStore(sqlite_store)
+
+        bench("shelve (per call)", shelve_lookup(shelf_path), keys, args.lookups)
+        bench("sqlite wal", sqlite_store.get, keys, args.lookups)
+        bench("lru + sqlite wal", cached_store.get, keys, args.lookups)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Single-pass webhook parsing against the old repeated `[0]` dict-chain lookups.
+
+Usage:
+    python -m benchmarks.webhook_parser_bench [--iterations 100000]
+"""
+
+import argparse
+import timeit
+
+from app.utils.webhook_parser import MessageEvent, iter_events
+
+
+def make_payload(messages=1, statuses=0):
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": "1234"},
+        "contacts": [{"profile": {"name": "Guest"}, "wa_id": "31612345678"}],
+        "messages": [
+            {
+                "from": "31612345678",
+                "id": f"wamid.{i}",
+                "timestamp": "1700000000",
+                "text": {"body": "What's the check in time?"},
+                "type": "text",
+            }
+            for i in range(messages)
+        ],
+    }
+    if statuses:
+        value["statuses"] = [
+            {"id": f"wamid.s{i}", "status": "delivered", "timestamp": "1700000001", "recipient_id": "31612345678"}
+            for i in range(statuses)
+        ]
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "1", "changes": [{"value": value, "field": "messages"}]}],
+    }
+
+
+def dict_chain(body):
+    # What is_valid_whatsapp_message, the status check in handle_message and
+    # process_whatsapp_message used to do for every request.
+    body.get("entry", [{}])[0].get("changes", [{}])[0].get("value", {}).get("statuses")
+    (
+        body.get("object")
+        and body.get("entry")
+        and body["entry"][0].get("changes")
+        and body["entry"][0]["changes"][0].get("value")
+        and body["entry"][0]["changes"][0]["value"].get("messages")
+        and body["entry"][0]["changes"][0]["value"]["messages"][0]
+    )
+    message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+    wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
+    name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+    return [(wa_id, name, message["text"]["body"])]
+
+
+def single_pass(body):
+    return [
+        (e.wa_id, e.name, e.text)
+        for e in iter_events(body)
+        if isinstance(e, MessageEvent)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    for label, payload in [
+        ("1 message", make_payload(1)),
+        ("5 messages", make_payload(5)),
+        ("5 messages + 10 statuses", make_payload(5, 10)),
+    ]:
+        for name, parse in (("dict chain", dict_chain), ("single pass", single_pass)):
+            seconds = timeit.timeit(lambda: parse(payload), number=args.iterations)
+            handled = len(parse(payload))
+            print(
+                f"{label:<26} {name:<12} {seconds / args.iterations * 1e6:6.2f} us"
+                f"  ({handled} message(s) handled)"
+            )
+
+
+if __name__ == "__main__":
+    main()
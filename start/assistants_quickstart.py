@@ -1,3 +1,4 @@
+from functools import cache
 from openai import OpenAI
 import shelve
 from dotenv import load_dotenv
@@ -6,7 +7,12 @@ import time
 
 load_dotenv()
 OPEN_AI_API_KEY = os.getenv("OPEN_AI_API_KEY")
-client = OpenAI(api_key=OPEN_AI_API_KEY)
+
+
+@cache
+def get_client():
+    # Created on first use, so importing this module makes no API client
+    return OpenAI(api_key=OPEN_AI_API_KEY)
 
 
 # --------------------------------------------------------------
@@ -14,11 +20,12 @@ client = OpenAI(api_key=OPEN_AI_API_KEY)
 # --------------------------------------------------------------
 def upload_file(path):
     # Upload a file with an "assistants" purpose
-    file = client.files.create(file=open(path, "rb"), purpose="assistants")
+    file = get_client().files.create(file=open(path, "rb"), purpose="assistants")
     return file
 
 
-file = upload_file("../data/airbnb-faq.pdf")
+if __name__ == "__main__":
+    file = upload_file("../data/airbnb-faq.pdf")
 
 
 # --------------------------------------------------------------
@@ -28,7 +35,7 @@ def create_assistant(file):
     """
     You currently cannot set the temperature for Assistant via the API.
     """
-    assistant = client.beta.assistants.create(
+    assistant = get_client().beta.assistants.create(
         name="WhatsApp AirBnb Assistant",
         instructions="You're a helpful WhatsApp assistant that can assist guests that are staying in our Paris AirBnb. Use your knowledge base to best respond to customer queries. If you don't know the answer, say simply that you cannot help with question and advice to contact the host directly. Be friendly and funny.",
         tools=[{"type": "retrieval"}],
@@ -38,7 +45,8 @@ def create_assistant(file):
     return assistant
 
 
-assistant = create_assistant(file)
+if __name__ == "__main__":
+    assistant = create_assistant(file)
 
 
 # --------------------------------------------------------------
@@ -64,17 +72,17 @@ def generate_response(message_body, wa_id, name):
     # If a thread doesn't exist, create one and store it
     if thread_id is None:
         print(f"Creating new thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.create()
+        thread = get_client().beta.threads.create()
         store_thread(wa_id, thread.id)
         thread_id = thread.id
 
     # Otherwise, retrieve the existing thread
     else:
         print(f"Retrieving existing thread for {name} with wa_id {wa_id}")
-        thread = client.beta.threads.retrieve(thread_id)
+        thread = get_client().beta.threads.retrieve(thread_id)
 
     # Add message to thread
-    message = client.beta.threads.messages.create(
+    message = get_client().beta.threads.messages.create(
         thread_id=thread_id,
         role="user",
         content=message_body,
@@ -91,10 +99,10 @@ def generate_response(message_body, wa_id, name):
 # --------------------------------------------------------------
 def run_assistant(thread):
     # Retrieve the Assistant
-    assistant = client.beta.assistants.retrieve("asst_7Wx2nQwoPWSf710jrdWTDlfE")
+    assistant = get_client().beta.assistants.retrieve("asst_7Wx2nQwoPWSf710jrdWTDlfE")
 
     # Run the assistant
-    run = client.beta.threads.runs.create(
+    run = get_client().beta.threads.runs.create(
         thread_id=thread.id,
         assistant_id=assistant.id,
     )
@@ -103,10 +111,10 @@ def run_assistant(thread):
     while run.status != "completed":
         # Be nice to the API
         time.sleep(0.5)
-        run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
+        run = get_client().beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
 
     # Retrieve the Messages
-    messages = client.beta.threads.messages.list(thread_id=thread.id)
+    messages = get_client().beta.threads.messages.list(thread_id=thread.id)
     new_message = messages.data[0].content[0].text.value
     print(f"Generated message: {new_message}")
     return new_message
@@ -116,10 +124,11 @@ def run_assistant(thread):
 # Test assistant
 # --------------------------------------------------------------
 
-new_message = generate_response("What's the check in time?", "123", "John")
+if __name__ == "__main__":
+    new_message = generate_response("What's the check in time?", "123", "John")
 
-new_message = generate_response("What's the pin for the lockbox?", "456", "Sarah")
+    new_message = generate_response("What's the pin for the lockbox?", "456", "Sarah")
 
-new_message = generate_response("What was my previous question?", "123", "John")
+    new_message = generate_response("What was my previous question?", "123", "John")
 
-new_message = generate_response("What was my previous question?", "456", "Sarah")
+    new_message = generate_response("What was my previous question?", "456", "Sarah")
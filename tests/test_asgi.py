@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from app import config
+from app.asgi import create_asgi_app
+
+APP_SECRET = "test-secret"
+
+
+@pytest.fixture
+def app(monkeypatch):
+    for name, value in {
+        "APP_SECRET": APP_SECRET,
+        "ACCESS_TOKEN": "test-token",
+        "VERSION": "v18.0",
+        "PHONE_NUMBER_ID": "1234",
+        "VERIFY_TOKEN": "test",
+        "RESPONSE_BACKEND": "echo",
+        "INGESTION_MODE": "sync",
+    }.items():
+        monkeypatch.setenv(name, value)
+    # Read the settings again, and restore the cached ones afterwards
+    monkeypatch.setattr(config, "_settings", None)
+    return create_asgi_app()
+
+
+def post(app, body, headers=()):
+    """
+    POST `body` to /webhook, signed, and return (status, JSON response).
+    """
+    signature = hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/webhook",
+        "query_string": b"",
+        "headers": [(b"x-hub-signature-256", f"sha256={signature}".encode()), *headers],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+@pytest.mark.parametrize("value", [b"abc", b"-1", b""])
+def test_malformed_content_length_is_rejected(app, value):
+    status, body = post(app, b"{}", [(b"content-length", value)])
+    assert status == 400
+    assert body["message"] == "Invalid Content-Length"
+
+
+def test_oversized_content_length_is_rejected(app):
+    status, _ = post(app, b"{}", [(b"content-length", b"999999999")])
+    assert status == 413
+
+
+@pytest.mark.parametrize(
+    "raw, message",
+    [(b"{not json", "Invalid JSON provided"), (b"[1, 2]", "Expected a JSON object")],
+)
+def test_invalid_json_is_rejected(app, raw, message):
+    assert post(app, raw) == (400, {"status": "error", "message": message})
+
+
+def test_status_update_is_acknowledged(app):
+    body = {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "changes": [
+                    {
+                        "field": "messages",
+                        "value": {
+                            "metadata": {"phone_number_id": "1234"},
+                            "statuses": [
+                                {
+                                    "id": "wamid.1",
+                                    "recipient_id": "31612345678",
+                                    "status": "delivered",
+                                    "timestamp": "1700000000",
+                                }
+                            ],
+                        },
+                    }
+                ]
+            }
+        ],
+    }
+    assert post(app, json.dumps(body).encode()) == (200, {"status": "ok"})
+    assert app.status_metrics.counts["delivered"] == 1
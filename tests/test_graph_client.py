@@ -0,0 +1,166 @@
+import asyncio
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+import requests
+
+from app.services.graph_client import AsyncGraphAPIClient, GraphAPIClient
+
+
+class StubGraphAPI(ThreadingHTTPServer):
+    """
+    Local Graph API that answers each request with the next (status, delay)
+    from `responses`, then 200 without delay.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responses):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.responses = list(responses)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def next_response(self, method, path):
+        with self._lock:
+            self.requests.append((method, path))
+            return self.responses.pop(0) if self.responses else (200, 0)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        status, delay = self.server.next_response(self.command, self.path)
+        time.sleep(delay)
+        body = b'{"messages": [{"id": "wamid.1"}]}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # the client gave up on this response
+
+    do_GET = do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(*responses):
+        server = StubGraphAPI(responses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def client_for(url, **kwargs):
+    kwargs.setdefault("timeout", 0.3)
+    return GraphAPIClient("token", "123", "v18.0", base_url=url, backoff_base=0.01, **kwargs)
+
+
+def closed_port_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+def test_post_is_retried_on_retryable_status(stub):
+    server = stub((503, 0), (429, 0))
+    client = client_for(server.url)
+    response = client.send_message('{"to": "1"}')
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+    assert client.retries == 2
+
+
+def test_post_is_not_retried_after_read_timeout(stub):
+    server = stub((200, 1.0))
+    client = client_for(server.url)
+    with pytest.raises(requests.ReadTimeout):
+        client.send_message('{"to": "1"}')
+    # The message may have been delivered; sending it again would duplicate it
+    assert len(server.requests) == 1
+    assert client.retries == 0
+
+
+def test_get_is_retried_after_read_timeout(stub):
+    server = stub((200, 1.0))
+    client = client_for(server.url)
+    assert client.get_media("media_1").status_code == 200
+    assert len(server.requests) == 2
+
+
+def test_post_is_retried_when_it_cannot_connect():
+    client = client_for(closed_port_url(), max_retries=2)
+    with pytest.raises(requests.ConnectionError):
+        client.send_message('{"to": "1"}')
+    assert client.retries == 2
+
+
+def test_async_post_is_not_retried_after_timeout(stub):
+    server = stub((200, 1.0))
+
+    async def send():
+        client = AsyncGraphAPIClient(
+            "token", "123", "v18.0", base_url=server.url, timeout=0.3, backoff_base=0.01
+        )
+        try:
+            return await client.send_message('{"to": "1"}')
+        finally:
+            await client.close()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(send())
+    assert len(server.requests) == 1
+
+
+def test_async_post_is_retried_on_retryable_status(stub):
+    server = stub((502, 0))
+
+    async def send():
+        client = AsyncGraphAPIClient(
+            "token", "123", "v18.0", base_url=server.url, timeout=1, backoff_base=0.01
+        )
+        try:
+            return await client.send_message('{"to": "1"}'), client.retries
+        finally:
+            await client.close()
+
+    (status, _), retries = asyncio.run(send())
+    assert status == 200
+    assert retries == 1
+
+
+def test_async_post_is_retried_when_it_cannot_connect():
+    async def send():
+        client = AsyncGraphAPIClient(
+            "token", "123", "v18.0", base_url=closed_port_url(), max_retries=2, backoff_base=0.01
+        )
+        try:
+            with pytest.raises(aiohttp.ClientConnectorError):
+                await client.send_message('{"to": "1"}')
+            return client.retries
+        finally:
+            await client.close()
+
+    assert asyncio.run(send()) == 2
@@ -0,0 +1,31 @@
+import os
+import threading
+
+from app.services.media import MediaPipeline
+
+
+def test_forked_child_starts_its_own_pool(tmp_path):
+    pipeline = MediaPipeline(str(tmp_path), processors={}, workers=1)
+    pipeline.start()
+    try:
+        # Another thread holds the pipeline's lock while the process forks
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            with pipeline._lock:
+                locked.set()
+                release.wait()
+
+        threading.Thread(target=hold, daemon=True).start()
+        locked.wait()
+        pid = os.fork()
+        if pid == 0:
+            ok = pipeline._pid == os.getpid() and pipeline._pool.submit(os.getppid).result(
+                timeout=10
+            ) == os.getpid()
+            os._exit(0 if ok else 1)
+        release.set()
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+    finally:
+        pipeline.shutdown()
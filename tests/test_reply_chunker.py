@@ -0,0 +1,57 @@
+import pytest
+
+from app.utils.reply_chunker import ReplyChunker, split_message
+
+
+def chunk_stream(pieces, **kwargs):
+    chunker = ReplyChunker(**kwargs)
+    chunks = []
+    for piece in pieces:
+        chunks += chunker.feed(piece)
+    return chunks + chunker.close()
+
+
+def test_list_markers_are_not_sentence_ends():
+    text = "1. Check in is at 3pm.\n2. Check out is at 11am.\n3. Keys are in the lockbox."
+    chunks = chunk_stream([text], min_length=1000, first_min_length=1)
+    assert chunks[0] == "1. Check in is at 3pm."
+    assert all(chunk not in ("1.", "2.", "3.") for chunk in chunks)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Bring an adapter, e.g. the European kind, for the kettle in the kitchen.",
+        "Ask Dr. Martin upstairs if the door sticks, she has a spare key for it.",
+        "Options:\na. take the RER B from the airport, then the metro line 4.",
+    ],
+)
+def test_abbreviations_are_not_sentence_ends(text):
+    assert chunk_stream([text + " Thanks!"], min_length=1000, first_min_length=1) == [
+        text,
+        "Thanks!",
+    ]
+
+
+def test_first_chunk_waits_for_minimum_length():
+    chunks = chunk_stream(
+        ["Sure! ", "The Wi-Fi network is called Paris-Loft. ", "The password is on the fridge."],
+        min_length=1000,
+    )
+    assert chunks == [
+        "Sure! The Wi-Fi network is called Paris-Loft.",
+        "The password is on the fridge.",
+    ]
+
+
+def test_later_chunks_wait_for_min_length():
+    sentence = "The metro station is two minutes away on foot. "
+    chunks = chunk_stream([sentence] * 20, min_length=300)
+    assert all(len(chunk) >= 300 for chunk in chunks[1:-1])
+
+
+def test_split_message_respects_max_length():
+    text = "Lorem ipsum dolor sit amet. " * 400
+    chunks = split_message(text, 4096)
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert " ".join(chunks) == text.strip()
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import openai_service
+from app.services.response_cache import ResponseCache
+
+
+def test_exact_and_semantic_hits():
+    cache = ResponseCache(similarity=0.6)
+    cache.put("What's the Wi-Fi password?", "It's on the fridge.")
+    assert cache.get("whats the wifi password") == "It's on the fridge."
+    assert cache.get("what is the wifi password please") == "It's on the fridge."
+    assert cache.stats["exact_hits"] == 1
+    assert cache.stats["semantic_hits"] == 1
+
+
+def test_semantic_scan_is_bounded_to_recent_entries():
+    cache = ResponseCache(similarity=0.6, scan_limit=10)
+    cache.put("What's the Wi-Fi password?", "It's on the fridge.")
+    for i in range(10):
+        cache.put(f"unrelated question number {i}", "no")
+    assert cache.get("what is the wifi password please") is None
+    # Exact matches are found however old they are
+    assert cache.get("What's the Wi-Fi password?") == "It's on the fridge."
+
+
+class FakeThreads:
+    def __init__(self):
+        self.messages = SimpleNamespace(create=lambda **kwargs: None)
+
+    def create(self):
+        return SimpleNamespace(id="thread_new")
+
+
+@pytest.fixture
+def assistant_backend(monkeypatch):
+    cache = ResponseCache()
+    threads = {}
+    client = SimpleNamespace(beta=SimpleNamespace(threads=FakeThreads()))
+    monkeypatch.setattr(openai_service, "CONVERSATION_BACKEND", "assistants")
+    monkeypatch.setattr(openai_service, "local_index", None)
+    monkeypatch.setattr(openai_service, "response_cache", cache)
+    monkeypatch.setattr(openai_service, "get_client", lambda: client)
+    monkeypatch.setattr(openai_service, "check_if_thread_exists", threads.get)
+    monkeypatch.setattr(openai_service, "store_thread", threads.__setitem__)
+    monkeypatch.setattr(
+        openai_service, "run_assistant", lambda thread_id, name, assistant_id: f"reply in {thread_id}"
+    )
+    return cache, threads
+
+
+def test_answers_in_a_new_thread_are_cached(assistant_backend):
+    cache, _ = assistant_backend
+    reply = openai_service.generate_response("Where are the spare towels?", "111", "Ann")
+    assert cache.get("Where are the spare towels?") == reply
+
+
+def test_answers_in_an_ongoing_conversation_are_not_cached(assistant_backend):
+    cache, threads = assistant_backend
+    threads["222"] = "thread_old"
+    openai_service.generate_response("Where are the spare towels?", "222", "Bob")
+    assert cache.get("Where are the spare towels?") is None
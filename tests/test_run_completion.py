@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.run_completion import (
+    RunFailed,
+    async_stream_run_text,
+    complete_run,
+    stream_run_text,
+)
+
+
+def delta(text):
+    block = SimpleNamespace(type="text", text=SimpleNamespace(value=text))
+    return SimpleNamespace(
+        event="thread.message.delta",
+        data=SimpleNamespace(delta=SimpleNamespace(content=[block])),
+    )
+
+
+class StalledStream:
+    """
+    Sends `events` one `interval` apart, then stalls until closed.
+    """
+
+    def __init__(self, events, interval):
+        self.events = events
+        self.interval = interval
+        self.current_run = SimpleNamespace(id="run_1")
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        for event in self.events:
+            if self.closed.wait(self.interval):
+                raise ConnectionError("response closed")
+            yield event
+        self.closed.wait()
+        raise ConnectionError("response closed")
+
+    def until_done(self):
+        for _ in self:
+            pass
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeRuns:
+    def __init__(self, stream=None, run=None):
+        self._stream = stream
+        self._run = run
+        self.cancelled = []
+
+    def stream(self, thread_id, assistant_id, timeout):
+        return self._stream
+
+    def create(self, thread_id, assistant_id):
+        return self._run
+
+    def cancel(self, thread_id, run_id):
+        self.cancelled.append(run_id)
+
+
+def fake_client(runs):
+    return SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+
+
+def test_stream_deadline_covers_the_whole_run():
+    # Each event arrives well within the deadline, the run as a whole does not
+    runs = FakeRuns(stream=StalledStream([delta("a")] * 100, interval=0.05))
+    start = time.monotonic()
+    with pytest.raises(RunFailed) as failure:
+        list(stream_run_text(fake_client(runs), "thread_1", "asst_1", deadline=0.3))
+    assert failure.value.status == "deadline_exceeded"
+    assert time.monotonic() - start < 1
+    assert runs.cancelled == ["run_1"]
+
+
+def test_complete_run_deadline_while_stalled():
+    runs = FakeRuns(stream=StalledStream([], interval=0))
+    start = time.monotonic()
+    with pytest.raises(RunFailed) as failure:
+        complete_run(fake_client(runs), "thread_1", "asst_1", mode="stream", deadline=0.2)
+    assert failure.value.status == "deadline_exceeded"
+    assert time.monotonic() - start < 1
+    assert runs.cancelled == ["run_1"]
+
+
+def test_requires_action_is_cancelled():
+    run = SimpleNamespace(id="run_2", status="requires_action")
+    runs = FakeRuns(run=run)
+    with pytest.raises(RunFailed) as failure:
+        complete_run(fake_client(runs), "thread_1", "asst_1", mode="poll", deadline=1)
+    assert failure.value.status == "requires_action"
+    assert runs.cancelled == ["run_2"]
+
+
+class AsyncStalledStream:
+    def __init__(self, events, interval):
+        self.events = events
+        self.interval = interval
+        self.current_run = SimpleNamespace(id="run_3")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def __aiter__(self):
+        for event in self.events:
+            await asyncio.sleep(self.interval)
+            yield event
+        await asyncio.Event().wait()
+
+
+class AsyncFakeRuns(FakeRuns):
+    async def cancel(self, thread_id, run_id):
+        self.cancelled.append(run_id)
+
+
+def test_async_stream_deadline_covers_the_whole_run():
+    runs = AsyncFakeRuns(stream=AsyncStalledStream([delta("a")] * 100, interval=0.05))
+
+    async def consume():
+        return [
+            text
+            async for text in async_stream_run_text(
+                fake_client(runs), "thread_1", "asst_1", deadline=0.3
+            )
+        ]
+
+    start = time.monotonic()
+    with pytest.raises(RunFailed) as failure:
+        asyncio.run(consume())
+    assert failure.value.status == "deadline_exceeded"
+    assert time.monotonic() - start < 1
+    assert runs.cancelled == ["run_3"]
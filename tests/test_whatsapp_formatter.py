@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+from app.utils.reply_chunker import WHATSAPP_MAX_TEXT_LENGTH
+from app.utils.whatsapp_formatter import format_and_split, format_basic, format_for_whatsapp
+
+CORPUS = Path(__file__).parent.parent / "benchmarks" / "formatter_corpus"
+
+
+@pytest.mark.parametrize(
+    "source", sorted(CORPUS.glob("*.md")), ids=lambda path: path.stem
+)
+def test_corpus_matches_golden_output(source):
+    golden = source.with_suffix(".txt").read_text(encoding="utf-8")
+    assert format_for_whatsapp(source.read_text(encoding="utf-8")) + "\n" == golden
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("## Check-in", "*Check-in*"),
+        ("**3 PM** sharp", "*3 PM* sharp"),
+        ("__very important__", "*very important*"),
+        ("a *quiet* street", "a _quiet_ street"),
+        ("~~Orlyval~~", "~Orlyval~"),
+        ("* towels\n+ sheets", "- towels\n- sheets"),
+        ("[guide](https://example.com)", "guide (https://example.com)"),
+        ("![](https://example.com/map.png)", "https://example.com/map.png"),
+        ("Open\n\n---\n\nClose", "Open\n\nClose"),
+        ("Pets welcome【5:1†faq.pdf】.", "Pets welcome."),
+        ("```python\nprint('**hi**')\n```", "```\nprint('**hi**')\n```"),
+        ("Use `**kwargs` here", "Use `**kwargs` here"),
+    ],
+)
+def test_converts_markdown(text, expected):
+    assert format_for_whatsapp(text) == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "class Lock: __init__ sets the code",
+        "__init__() and __repr__()",
+        "my__var__name",
+        "__pycache__/",
+    ],
+)
+def test_leaves_double_underscore_identifiers(text):
+    assert format_for_whatsapp(text) == text
+
+
+def test_basic_only_handles_citations_and_bold():
+    assert format_basic("## Rules\n**No** parties【1:0†faq.pdf】") == "## Rules\n*No* parties"
+
+
+def test_split_keeps_every_part_within_the_limit():
+    text = " ".join(f"Sentence number {i} about the apartment." for i in range(400))
+    parts = format_and_split(text)
+    assert len(parts) > 1
+    assert all(len(part) <= WHATSAPP_MAX_TEXT_LENGTH for part in parts)
+    assert " ".join(parts) == text
+
+
+def test_short_reply_is_not_split():
+    assert format_and_split("**Hi** there") == ["*Hi* there"]